@@ -448,20 +448,8 @@ def performInstallation(answers, ui_package, interactive):
 def configureMCELog(mounts):
     """Disable mcelog on unsupported processors."""
 
-    is_amd = False
-    model = 0
-
-    with open('/proc/cpuinfo', 'r') as f:
-        for line in f:
-            line = line.strip()
-            if re.match('vendor_id\s*:\s*AuthenticAMD$', line):
-                is_amd = True
-                continue
-            m = re.match('cpu family\s*:\s*(\d+)$', line)
-            if m:
-                model = int(m.group(1))
-
-    if is_amd and model >= 16:
+    cpu = hardware.facts().cpu
+    if cpu['vendor'] == 'AuthenticAMD' and (cpu['family'] or 0) >= 16:
         util.runCmd2(['chroot', mounts['root'], 'systemctl', 'disable', 'mcelog'])
 
 def rewriteNTPConf(root, ntp_servers):
@@ -1028,8 +1016,8 @@ def buildBootLoaderMenu(mounts, xen_version, xen_kernel_version, boot_config, se
     xen_mem_params = "crashkernel=256M,below=4G"
 
     # CA-103933 - AMD PCI-X Hypertransport Tunnel IOAPIC errata
-    rc, out = util.runCmd2(['lspci', '-n'], with_stdout=True)
-    if rc == 0 and ('1022:7451' in out or '1022:7459' in out):
+    pci_ids = hardware.facts().pci_ids
+    if '1022:7451' in pci_ids or '1022:7459' in pci_ids:
         common_xen_params += " ioapic_ack=old"
 
     if "sched-gran" in host_config:
@@ -0,0 +1,133 @@
+# SPDX-License-Identifier: GPL-2.0-only
+
+"""blockimage - block-level copy of an ext2/3/4 filesystem
+
+Only the blocks the filesystem has in use are copied, as 'e2image -ra'
+would, taking them from its block bitmaps as reported by dumpe2fs.  This
+streams at the speed of the devices whatever the number of files, and is
+used to back up the dom0 root filesystem and to restore it."""
+
+import concurrent.futures
+import os
+import threading
+import time
+
+import constants
+import util
+from xcp import logger
+
+# present in the root of a backup made by imaging the root filesystem
+MARKER = '.xen-backup-image'
+
+# largest amount of data copied by one system call
+CHUNK_SIZE = 8 * 1024 * 1024
+
+MB = 1024.0 * 1024.0
+
+def usedExtents(device):
+    """ Return the size in bytes of the ext2/3/4 filesystem on device, and
+    the (offset, length) byte ranges of the blocks it has in use. """
+    rc, out = util.runCmd2(['dumpe2fs', device], with_stdout=True)
+    if rc != 0:
+        raise RuntimeError("Failed to read block bitmaps of %s" % device)
+
+    block_size = block_count = None
+    free = []
+    in_groups = False
+    for line in out.splitlines():
+        line = line.strip()
+        if line.startswith('Group '):
+            in_groups = True
+        elif line.startswith('Block size:'):
+            block_size = int(line.split(':', 1)[1])
+        elif line.startswith('Block count:'):
+            block_count = int(line.split(':', 1)[1])
+        elif in_groups and line.startswith('Free blocks:'):
+            # e.g. "Free blocks: 1055-1056, 1060-32767"
+            for r in line.split(':', 1)[1].split(','):
+                r = r.strip()
+                if r:
+                    first, _, last = r.partition('-')
+                    free.append((int(first), int(last or first)))
+    if not block_size or not block_count:
+        raise RuntimeError("Failed to read geometry of filesystem on %s" % device)
+
+    extents = []
+    block = 0
+    for first, last in sorted(free) + [(block_count, block_count)]:
+        if first > block:
+            extents.append((block * block_size, (first - block) * block_size))
+        block = max(block, last + 1)
+    return block_count * block_size, extents
+
+def _deviceSize(fd):
+    return os.lseek(fd, 0, os.SEEK_END)
+
+def imageFilesystem(src, dst, progress_callback=lambda x: (), workers=constants.COPY_WORKERS):
+    """ Copy the ext2/3/4 filesystem on src to dst block by block, skipping
+    unused blocks, then check the copy and give it a new UUID and no label
+    so that it cannot be mistaken for the original.  progress_callback is
+    given the percentage of the used blocks copied. """
+    size, extents = usedExtents(src)
+    total = sum(length for _, length in extents)
+    logger.log("Imaging %s to %s: %d of %d bytes in use" % (src, dst, total, size))
+
+    chunks = []
+    for offset, length in extents:
+        for start in range(offset, offset + length, CHUNK_SIZE):
+            chunks.append((start, min(CHUNK_SIZE, offset + length - start)))
+
+    lock = threading.Lock()
+    local = threading.local()
+    copied = [0]
+
+    def copy_chunk(offset, length):
+        buf = getattr(local, 'buf', None)
+        if buf is None:
+            buf = local.buf = bytearray(CHUNK_SIZE)
+        view = memoryview(buf)[:length]
+        done = 0
+        while done < length:
+            n = os.preadv(infd, [view[done:]], offset + done)
+            if n == 0:
+                raise IOError("Unexpected end of %s at %d" % (src, offset + done))
+            done += n
+        done = 0
+        while done < length:
+            done += os.pwrite(outfd, view[done:], offset + done)
+        with lock:
+            copied[0] += length
+
+    start = time.time()
+    infd = os.open(src, os.O_RDONLY)
+    try:
+        outfd = os.open(dst, os.O_WRONLY)
+        try:
+            if _deviceSize(outfd) < size:
+                raise RuntimeError("%s is too small to hold the filesystem on %s" % (dst, src))
+            with concurrent.futures.ThreadPoolExecutor(max_workers=workers) as executor:
+                pending = [executor.submit(copy_chunk, offset, length) for offset, length in chunks]
+                while pending:
+                    done, pending = concurrent.futures.wait(pending, timeout=0.5,
+                                                            return_when=concurrent.futures.FIRST_EXCEPTION)
+                    for f in done:
+                        if f.exception():
+                            for p in pending:
+                                p.cancel()
+                            raise f.exception()
+                    with lock:
+                        progress_callback((copied[0] * 100) // total if total else 100)
+            os.fsync(outfd)
+        finally:
+            os.close(outfd)
+    finally:
+        os.close(infd)
+    elapsed = time.time() - start
+    logger.log("Imaged %s to %s: %d bytes in %.1fs (%.1f MB/s)" %
+               (src, dst, total, elapsed, total / MB / elapsed if elapsed > 0 else 0.0))
+
+    if util.runCmd2(['e2fsck', '-f', '-y', dst]) not in (0, 1):
+        raise RuntimeError("Filesystem imaged to %s is not consistent" % dst)
+    if util.runCmd2(['tune2fs', '-U', 'random', '-L', '', dst]) != 0:
+        raise RuntimeError("Failed to set a new UUID on %s" % dst)
+    progress_callback(100)
@@ -160,6 +160,76 @@ BOOT_MENU_TIMEOUT = 50
 # timeout used for multipath iscsi
 MPATH_ISCSI_TIMEOUT = 15
 
+# package verification: number of packages checked concurrently for local
+# (filesystem, device, NFS) and remote (HTTP, FTP) sources, and the size of
+# the buffer each worker reads into
+VERIFY_WORKERS = 4
+VERIFY_URL_STREAMS = 4
+VERIFY_BUFSIZE = 1024 * 1024
+
+# record of packages which passed verification, so that verifying the same
+# unchanged source again can skip them.  By default it is kept on the
+# ramdisk, which is lost at reboot, so only repeated checks within one run
+# are spared; --verify-cache keeps it on persistent media instead (a
+# directory, a block device or nfs://server:/path), as VERIFY_CACHE_NAME
+VERIFY_CACHE = '/tmp'
+VERIFY_CACHE_NAME = 'verify-cache.json'
+
+# HTTP(S) sources: maximum number of concurrent connections to one server,
+# and the socket timeout in seconds
+HTTP_MAX_CONNECTIONS = 8
+HTTP_TIMEOUT = 60
+
+# packages for remote (HTTP, FTP, NFS) sources are downloaded into a staging
+# directory on the target before dnf runs, using this many parallel streams;
+# the share of the package installation progress bar given to the download
+PREFETCH_STREAMS = 4
+PREFETCH_PROGRESS_SHARE = 40
+
+# install dom0 from the prebuilt root filesystem image of the main
+# repository, if it has one, rather than from its packages; the image is
+# copied in blocks of IMAGE_BUFSIZE, and takes IMAGE_PROGRESS_SHARE of the
+# progress bar when packages from other repositories follow
+IMAGE_INSTALL = False
+IMAGE_BUFSIZE = 4 * 1024 * 1024
+IMAGE_PROGRESS_SHARE = 60
+
+# content-addressed package store shared between installs (a directory, a
+# block device or nfs://server:/path), and its size limit in bytes
+PACKAGE_CACHE = None
+PACKAGE_CACHE_SIZE = 16 * 1024 * 1024 * 1024
+
+# packages are installed through the dnf Python API when it is available:
+# the number of packages dnf downloads in parallel, and the share of the
+# progress bar given to downloading rather than installing
+DNF_PARALLEL_DOWNLOADS = 8
+DNF_DOWNLOAD_PROGRESS_SHARE = 30
+
+# aggregate download and install throughput of each package installation
+# phase is appended here, and collected with the other logs
+TIMING_SUMMARY_LOG = '/tmp/timing-summary-log'
+
+# number of local devices probed for repositories at once
+MEDIA_PROBE_WORKERS = 8
+
+# the dom0 root filesystem is backed up by copying the data of this many
+# files at once
+COPY_WORKERS = 8
+
+# bring an existing backup partition up to date rather than reformatting it
+# and copying everything, when it holds a complete backup of the same root
+INCREMENTAL_BACKUP = True
+
+# back up by imaging the used blocks of the root filesystem onto the backup
+# partition, rather than copying its files
+BLOCK_BACKUP = False
+
+# record the sha256 of each file in the backup manifest so that the backup
+# can be verified.  The data then has to be read through userspace to be
+# hashed, rather than copied by copy_file_range, which makes the backup
+# slower
+BACKUP_CHECKSUMS = True
+
 ISCSI_NODES = 'var/lib/iscsi/nodes'
 
 # prepare configuration for common criteria security
@@ -46,7 +46,10 @@ import stat
 import errno
 import time
 import struct
+import binascii
 import copy
+import io
+import concurrent.futures
 
 if sys.platform == 'mac':
     # This module needs work for MacOS9, especially in the area of pathname
@@ -60,6 +63,9 @@ try:
 except ImportError:
     grp = pwd = None
 
+# open is rebound to CpioFile.open at the end of the module
+bltn_open = open
+
 # from cpiofile import *
 __all__ = ["CpioFile", "CpioInfo", "is_cpiofile", "CpioError"]
 
@@ -67,11 +73,21 @@ __all__ = ["CpioFile", "CpioInfo", "is_cpiofile", "CpioError"]
 # cpio constants
 #---------------------------------------------------------
 MAGIC_NEWC      = 0x070701           # magic for SVR4 portable format (no CRC)
+GZ_MAGIC        = b"\037\213\010"
+BZ2_MAGIC       = b"BZh91"
+XZ_MAGIC        = b"\3757zXZ\000"
+ZSTD_MAGIC      = b"\050\265\057\375"
 TRAILER_NAME    = "TRAILER!!!"       # filename in final member
 WORDSIZE        = 4                  # pad size
-NUL             = "\0"               # the null character
+NUL             = b"\0"              # the null character
 BLOCKSIZE       = 512                # length of processing blocks
+STREAM_BUFSIZE  = 256 * 1024         # default buffer size of streams
+COPY_BUFSIZE    = 1024 * 1024        # buffer size for copying member data
+EXTRACT_WORKERS = 4                  # files written at once by extractall
 HEADERSIZE_SVR4 = 110                # length of fixed header
+ENCODING        = sys.getfilesystemencoding()
+HEADER_FIELDS   = struct.Struct(">13I")  # the fixed header after the magic,
+                                         # as binary
 
 #---------------------------------------------------------
 # Bits used in the mode field, values in octal.
@@ -108,10 +124,10 @@ def copyfileobj(src, dst, length=None):
     if length == 0:
         return
     if length is None:
-        shutil.copyfileobj(src, dst)
+        shutil.copyfileobj(src, dst, COPY_BUFSIZE)
         return
 
-    BUFSIZE = 16 * 1024
+    BUFSIZE = COPY_BUFSIZE
     blocks, remainder = divmod(length, BUFSIZE)
     for b in range(blocks):
         buf = src.read(BUFSIZE)
@@ -126,6 +142,34 @@ def copyfileobj(src, dst, length=None):
         dst.write(buf)
     return
 
+def copyrange(src_fd, offset, size, dst_fd):
+    """Copy size bytes at offset in file descriptor src_fd to the start
+       of dst_fd, in the kernel where the filesystems allow it.
+    """
+    done = 0
+    if hasattr(os, "copy_file_range"):
+        try:
+            while done < size:
+                n = os.copy_file_range(src_fd, dst_fd, size - done,
+                                       offset + done, done)
+                if n == 0:
+                    raise IOError("end of file reached")
+                done += n
+            return
+        except OSError as e:
+            if e.errno not in (errno.EXDEV, errno.ENOSYS, errno.EINVAL,
+                               errno.EOPNOTSUPP):
+                raise
+
+    buf = bytearray(min(COPY_BUFSIZE, size - done))
+    view = memoryview(buf)
+    while done < size:
+        n = os.preadv(src_fd, [view[:size - done]], offset + done)
+        if n == 0:
+            raise IOError("end of file reached")
+        os.pwrite(dst_fd, view[:n], done)
+        done += n
+
 filemode_table = (
     ((S_IFLNK,      "l"),
      (S_IFREG,      "-"),
@@ -189,6 +233,15 @@ class StreamError(CpioError):
     """Exception for unsupported operations on stream-like CpioFiles."""
     pass
 
+def _zstd():
+    """Return the zstandard module, which is optional.
+    """
+    try:
+        import zstandard
+    except ImportError:
+        raise CompressionError("zstandard module is not available")
+    return zstandard
+
 #---------------------------
 # internal stream interface
 #---------------------------
@@ -216,18 +269,76 @@ class _LowLevelFile:
     def write(self, s):
         os.write(self.fd, s)
 
+class _Buffer(object):
+    """First-in first-out byte buffer. Data is appended to a bytearray
+       and consumed from the front by advancing an offset; the consumed
+       prefix is only dropped once it makes up half of the buffer, so
+       that consuming data costs amortised O(1) per byte.
+    """
+
+    def __init__(self):
+        self.data = bytearray()
+        self.start = 0
+
+    def __len__(self):
+        return len(self.data) - self.start
+
+    def append(self, s):
+        self.data += s
+
+    def _consume(self, size):
+        self.start += size
+        if self.start >= len(self.data) // 2:
+            del self.data[:self.start]
+            self.start = 0
+
+    def peek(self, size):
+        """Return up to size bytes without removing them.
+        """
+        return bytes(self.data[self.start:self.start + size])
+
+    def take(self, size):
+        """Remove and return up to size bytes.
+        """
+        size = min(size, len(self))
+        buf = bytes(self.data[self.start:self.start + size])
+        self._consume(size)
+        return buf
+
+    def takeinto(self, b):
+        """Remove up to len(b) bytes into the writable buffer b and
+           return their number.
+        """
+        size = min(len(b), len(self))
+        with memoryview(self.data) as view:
+            b[:size] = view[self.start:self.start + size]
+        self._consume(size)
+        return size
+
+    def writeblocks(self, fileobj, blocksize, flush=False):
+        """Write the buffered data to fileobj in blocks of blocksize,
+           keeping back the last partial block unless flush is set.
+        """
+        with memoryview(self.data) as view:
+            while len(self) > blocksize or (flush and len(self) > 0):
+                size = min(blocksize, len(self))
+                fileobj.write(view[self.start:self.start + size])
+                self.start += size
+        self._consume(0)
+
 class _Stream:
     """Class that serves as an adapter between CpioFile and
        a stream-like object.  The stream-like object only
        needs to have a read() or write() method and is accessed
-       blockwise.  Use of gzip or bzip2 compression is possible.
+       blockwise.  Use of gzip, bzip2, xz or zstd compression is
+       possible.
        A stream-like object could be for example: sys.stdin,
        sys.stdout, a socket, a tape device etc.
 
        _Stream is intended to be used only internally.
     """
 
-    def __init__(self, name, mode, comptype, fileobj, bufsize):
+    def __init__(self, name, mode, comptype, fileobj, bufsize=STREAM_BUFSIZE):
         """Construct a _Stream object.
         """
         self._extfileobj = True
@@ -246,7 +357,8 @@ class _Stream:
         self.comptype = comptype
         self.fileobj  = fileobj
         self.bufsize  = bufsize
-        self.buf      = b""
+        self.buf      = _Buffer()     # raw data
+        self.dbuf     = _Buffer()     # decompressed data
         self.pos      = 0
         self.closed   = False
 
@@ -268,11 +380,30 @@ class _Stream:
             except ImportError:
                 raise CompressionError("bz2 module is not available")
             if mode == "r":
-                self.dbuf = b""
+                self._check_magic(BZ2_MAGIC, "not a bzip2 file")
                 self.cmp = bz2.BZ2Decompressor()
             else:
                 self.cmp = bz2.BZ2Compressor()
 
+        if comptype == "xz":
+            try:
+                import lzma
+            except ImportError:
+                raise CompressionError("lzma module is not available")
+            if mode == "r":
+                self._check_magic(XZ_MAGIC, "not an xz file")
+                self.cmp = lzma.LZMADecompressor()
+            else:
+                self.cmp = lzma.LZMACompressor(lzma.FORMAT_XZ)
+
+        if comptype == "zst":
+            zstd = _zstd()
+            if mode == "r":
+                self._check_magic(ZSTD_MAGIC, "not a zstd file")
+                self.cmp = zstd.ZstdDecompressor().decompressobj()
+            else:
+                self.cmp = zstd.ZstdCompressor().compressobj()
+
     def __del__(self):
         if hasattr(self, "closed") and not self.closed:
             self.close()
@@ -285,10 +416,10 @@ class _Stream:
                                             self.zlib.DEF_MEM_LEVEL,
                                             0)
         timestamp = struct.pack("<L", int(time.time()))
-        self.__write("\037\213\010\010%s\002\377" % timestamp)
+        self.__write(b"\037\213\010\010" + timestamp + b"\002\377")
         if self.name.endswith(".gz"):
             self.name = self.name[:-3]
-        self.__write(self.name + NUL)
+        self.__write(os.fsencode(self.name) + NUL)
 
     def write(self, s):
         """Write string s to the stream.
@@ -304,10 +435,9 @@ class _Stream:
         """Write string s to the stream if a whole new block
            is ready to be written.
         """
-        self.buf += s
-        while len(self.buf) > self.bufsize:
-            self.fileobj.write(self.buf[:self.bufsize])
-            self.buf = self.buf[self.bufsize:]
+        self.buf.append(s)
+        if len(self.buf) > self.bufsize:
+            self.buf.writeblocks(self.fileobj, self.bufsize)
 
     def close(self):
         """Close the _Stream object. No operation should be
@@ -317,11 +447,10 @@ class _Stream:
             return
 
         if self.mode == "w" and self.comptype != "cpio":
-            self.buf += self.cmp.flush()
+            self.buf.append(self.cmp.flush())
 
-        if self.mode == "w" and self.buf:
-            self.fileobj.write(self.buf)
-            self.buf = ""
+        if self.mode == "w" and len(self.buf):
+            self.buf.writeblocks(self.fileobj, self.bufsize, flush=True)
             if self.comptype == "gz":
                 # The native zlib crc is an unsigned 32-bit integer, but
                 # the Python wrapper implicitly casts that to a signed C
@@ -337,11 +466,21 @@ class _Stream:
 
         self.closed = True
 
+    def _check_magic(self, magic, error):
+        """Check that the stream starts with magic, without consuming it.
+        """
+        while len(self.buf) < len(magic):
+            data = self.fileobj.read(self.bufsize)
+            if not data:
+                break
+            self.buf.append(data)
+        if self.buf.peek(len(magic)) != magic:
+            raise ReadError(error)
+
     def _init_read_gz(self):
         """Initialize for reading a gzip compressed fileobj.
         """
         self.cmp = self.zlib.decompressobj(-self.zlib.MAX_WBITS)
-        self.dbuf = b""
 
         # taken from gzip.GzipFile with some alterations
         if self.__read(2) != b"\037\213":
@@ -354,7 +493,7 @@ class _Stream:
 
         if flag & 4:
             xlen = ord(self.__read(1)) + 256 * ord(self.__read(1))
-            self.read(xlen)
+            self.__read(xlen)
         if flag & 8:
             while True:
                 s = self.__read(1)
@@ -378,10 +517,10 @@ class _Stream:
            is forbidden.
         """
         if pos - self.pos >= 0:
-            blocks, remainder = divmod(pos - self.pos, self.bufsize)
-            for i in range(blocks):
-                self.read(self.bufsize)
-            self.read(remainder)
+            while self.pos < pos:
+                if not self._fill(min(pos - self.pos, self.bufsize)):
+                    break
+                self.pos += len(self._buffer().take(pos - self.pos))
         else:
             raise StreamError("seeking backwards is not allowed")
         return self.pos
@@ -392,52 +531,72 @@ class _Stream:
            up to EOF.
         """
         if size is None:
-            t = []
+            # _fill stops short of what is asked for only at the end
+            # of the stream
             while True:
-                buf = self._read(self.bufsize)
-                if not buf:
+                size = len(self._buffer())
+                self._fill(size + self.bufsize)
+                if len(self._buffer()) == size:
                     break
-                t.append(buf)
-            buf = b"".join(t)
-        else:
-            buf = self._read(size)
+        self._fill(size)
+        buf = self._buffer().take(size)
         self.pos += len(buf)
         return buf
 
-    def _read(self, size):
-        """Return size bytes from the stream.
+    def readinto(self, b):
+        """Read up to len(b) bytes into the writable buffer b and
+           return their number.
         """
-        if self.comptype == "cpio":
-            return self.__read(size)
+        with memoryview(b) as view:
+            view = view.cast("B")
+            self._fill(len(view))
+            n = self._buffer().takeinto(view)
+        self.pos += n
+        return n
 
-        c = len(self.dbuf)
-        t = [self.dbuf]
-        while c < size:
-            buf = self.__read(self.bufsize)
-            if not buf:
-                break
-            buf = self.cmp.decompress(buf)
-            t.append(buf)
-            c += len(buf)
-        t = b"".join(t)
-        self.dbuf = t[size:]
-        return t[:size]
+    def _buffer(self):
+        """Return the buffer data is read from.
+        """
+        if self.comptype == "cpio":
+            return self.buf
+        return self.dbuf
+
+    def _fill(self, size):
+        """Read (and decompress) from the stream until at least size bytes
+           are buffered, or the end of the stream is reached. Return
+           whether any data is buffered.
+        """
+        buf = self._buffer()
+        while len(buf) < size:
+            if self.comptype == "cpio":
+                data = self.fileobj.read(self.bufsize)
+                if not data:
+                    break
+                self.buf.append(data)
+            else:
+                if len(self.buf):
+                    data = self.buf.take(len(self.buf))
+                else:
+                    data = self.fileobj.read(self.bufsize)
+                if not data or self.cmp.eof:
+                    # ignore data after the end of the compressed stream
+                    break
+                try:
+                    self.dbuf.append(self.cmp.decompress(data))
+                except EOFError:
+                    break
+        return len(buf) > 0
 
     def __read(self, size):
         """Return size bytes from stream. If internal buffer is empty,
            read another block from the stream.
         """
-        c = len(self.buf)
-        t = [self.buf]
-        while c < size:
-            buf = self.fileobj.read(self.bufsize)
-            if not buf:
+        while len(self.buf) < size:
+            data = self.fileobj.read(self.bufsize)
+            if not data:
                 break
-            t.append(buf)
-            c += len(buf)
-        t = b"".join(t)
-        self.buf = t[size:]
-        return t[:size]
+            self.buf.append(data)
+        return self.buf.take(size)
 # class _Stream
 
 class _StreamProxy(object):
@@ -454,10 +613,14 @@ class _StreamProxy(object):
         return self.buf
 
     def getcomptype(self):
-        if self.buf.startswith("\037\213\010"):
+        if self.buf.startswith(GZ_MAGIC):
             return "gz"
-        if self.buf.startswith("BZh91"):
+        if self.buf.startswith(BZ2_MAGIC):
             return "bz2"
+        if self.buf.startswith(XZ_MAGIC):
+            return "xz"
+        if self.buf.startswith(ZSTD_MAGIC):
+            return "zst"
         return "cpio"
 
     def close(self):
@@ -485,7 +648,7 @@ class _BZ2Proxy(object):
         if self.mode == "r":
             self.bz2obj = bz2.BZ2Decompressor()
             self.fileobj.seek(0)
-            self.buf = ""
+            self.buf = b""
         else:
             self.bz2obj = bz2.BZ2Compressor()
 
@@ -500,7 +663,7 @@ class _BZ2Proxy(object):
             except EOFError:
                 break
             x += len(data)
-        self.buf = "".join(b)
+        self.buf = b"".join(b)
 
         buf = self.buf[:size]
         self.buf = self.buf[size:]
@@ -583,7 +746,7 @@ class _FileInFile(object):
                 break
             size -= len(buf)
             data.append(buf)
-        return "".join(data)
+        return b"".join(data)
 
     def readsparsesection(self, size):
         """Read a single section of a sparse file.
@@ -591,7 +754,7 @@ class _FileInFile(object):
         section = self.sparse.find(self.position)
 
         if section is None:
-            return ""
+            return b""
 
         size = min(size, section.offset + section.size - self.position)
 
@@ -626,7 +789,7 @@ class ExFileObject(object):
         self.size = cpioinfo.size
 
         self.position = 0
-        self.buffer = ""
+        self.buffer = b""
 
     def read(self, size=None):
         """Read at most size bytes from the file. If size is not
@@ -635,11 +798,11 @@ class ExFileObject(object):
         if self.closed:
             raise ValueError("I/O operation on closed file")
 
-        buf = ""
+        buf = b""
         if self.buffer:
             if size is None:
                 buf = self.buffer
-                self.buffer = ""
+                self.buffer = b""
             else:
                 buf = self.buffer[:size]
                 self.buffer = self.buffer[size:]
@@ -660,16 +823,16 @@ class ExFileObject(object):
         if self.closed:
             raise ValueError("I/O operation on closed file")
 
-        if "\n" in self.buffer:
-            pos = self.buffer.find("\n") + 1
+        if b"\n" in self.buffer:
+            pos = self.buffer.find(b"\n") + 1
         else:
             buffers = [self.buffer]
             while True:
                 buf = self.fileobj.read(self.blocksize)
                 buffers.append(buf)
-                if not buf or "\n" in buf:
-                    self.buffer = "".join(buffers)
-                    pos = self.buffer.find("\n") + 1
+                if not buf or b"\n" in buf:
+                    self.buffer = b"".join(buffers)
+                    pos = self.buffer.find(b"\n") + 1
                     if pos == 0:
                         # no newline found.
                         pos = len(self.buffer)
@@ -719,7 +882,7 @@ class ExFileObject(object):
         else:
             raise ValueError("Invalid argument")
 
-        self.buffer = ""
+        self.buffer = b""
         self.fileobj.seek(self.position)
 
     def close(self):
@@ -779,28 +942,26 @@ class CpioInfo(object):
     def frombuf(cls, buf):
         """Construct a CpioInfo object from a string buffer.
         """
+        if len(buf) != HEADERSIZE_SVR4:
+            raise ValueError("truncated header")
         cpioinfo = cls()
         cpioinfo.buf = buf
 
-        cpioinfo.ino = int(buf[6:14], 16)
-        cpioinfo.mode = int(buf[14:22], 16)
-        cpioinfo.uid = int(buf[22:30], 16)
-        cpioinfo.gid = int(buf[30:38], 16)
-        cpioinfo.nlink = int(buf[38:46], 16)
-        cpioinfo.mtime = int(buf[46:54], 16)
-        cpioinfo.size = int(buf[54:62], 16)
-        cpioinfo.devmajor = int(buf[62:70], 16)
-        cpioinfo.devminor = int(buf[70:78], 16)
-        cpioinfo.rdevmajor = int(buf[78:86], 16)
-        cpioinfo.rdevminor = int(buf[86:94], 16)
-        cpioinfo.namesize = int(buf[94:102], 16)
-        cpioinfo.check = int(buf[102:110], 16)
+        # The thirteen 8-digit hex fields decode to big-endian words.
+        (cpioinfo.ino, cpioinfo.mode, cpioinfo.uid, cpioinfo.gid,
+         cpioinfo.nlink, cpioinfo.mtime, cpioinfo.size,
+         cpioinfo.devmajor, cpioinfo.devminor,
+         cpioinfo.rdevmajor, cpioinfo.rdevminor,
+         cpioinfo.namesize, cpioinfo.check) = \
+            HEADER_FIELDS.unpack(binascii.unhexlify(buf[6:HEADERSIZE_SVR4]))
 
         return cpioinfo
 
     def tobuf(self):
         """Return a cpio header as a string.
         """
+        name = self.name.encode(ENCODING, "surrogateescape")
+        linkname = self.linkname.encode(ENCODING, "surrogateescape")
         buf = "%06X" % MAGIC_NEWC
         buf += "%08X" % self.ino
         buf += "%08X" % self.mode
@@ -808,22 +969,22 @@ class CpioInfo(object):
         buf += "%08X" % self.gid
         buf += "%08X" % self.nlink
         buf += "%08X" % self.mtime
-        buf += "%08X" % (self.linkname == '' and self.size or len(self.linkname))
+        buf += "%08X" % (self.linkname == '' and self.size or len(linkname))
         buf += "%08X" % self.devmajor
         buf += "%08X" % self.devminor
         buf += "%08X" % self.rdevmajor
         buf += "%08X" % self.rdevminor
-        buf += "%08X" % (len(self.name)+1)
+        buf += "%08X" % (len(name)+1)
         buf += "%08X" % self.check
 
-        buf += self.name + NUL
+        buf = buf.encode("ascii") + name + NUL
         words, remainder = divmod(len(buf), WORDSIZE)
         if remainder != 0:
             # pad to next word
             buf += (WORDSIZE - remainder) * NUL
 
         if self.linkname != '':
-            buf += self.linkname
+            buf += linkname
             words, remainder = divmod(len(buf), WORDSIZE)
             if remainder != 0:
                 # pad to next word
@@ -887,7 +1048,7 @@ class CpioFile(object):
         self.mode = {"r": "rb", "a": "r+b", "w": "wb"}[mode]
 
         if not fileobj:
-            fileobj = file(name, self.mode)
+            fileobj = bltn_open(name, self.mode)
             self._extfileobj = False
         else:
             if name is None and hasattr(fileobj, "name"):
@@ -903,7 +1064,12 @@ class CpioFile(object):
         # Init datastructures
         self.closed = False
         self.members = []       # list of members as CpioInfo objects
+        self._names = {}        # name -> members with that name, in order
+        self._datamembers = {}  # (devmajor, devminor, ino) -> member
+                                # holding the data of a hard link
         self._loaded = False    # flag if all members have been read
+        self._streaming = False # flag if members are not kept, see
+                                # iterstream()
         self.offset = 0         # current position in the archive file
         self.inodes = {}        # dictionary caching the inodes of
                                 # archive members already added
@@ -944,7 +1110,7 @@ class CpioFile(object):
     # by adding it to the mapping in OPEN_METH.
 
     @classmethod
-    def open(cls, name=None, mode="r", fileobj=None, bufsize=20*512):
+    def open(cls, name=None, mode="r", fileobj=None, bufsize=STREAM_BUFSIZE):
         """Open a cpio archive for reading, writing or appending. Return
            an appropriate CpioFile class.
 
@@ -953,18 +1119,27 @@ class CpioFile(object):
            'r:'         open for reading exclusively uncompressed
            'r:gz'       open for reading with gzip compression
            'r:bz2'      open for reading with bzip2 compression
+           'r:xz'       open for reading with xz compression
+           'r:zst'      open for reading with zstd compression (forward
+                        only, as for streams)
            'a' or 'a:'  open for appending
            'w' or 'w:'  open for writing without compression
            'w:gz'       open for writing with gzip compression
            'w:bz2'      open for writing with bzip2 compression
+           'w:xz'       open for writing with xz compression
+           'w:zst'      open for writing with zstd compression
 
            'r|*'        open a stream of cpio blocks with transparent compression
            'r|'         open an uncompressed stream of cpio blocks for reading
            'r|gz'       open a gzip compressed stream of cpio blocks
            'r|bz2'      open a bzip2 compressed stream of cpio blocks
+           'r|xz'       open an xz compressed stream of cpio blocks
+           'r|zst'      open a zstd compressed stream of cpio blocks
            'w|'         open an uncompressed stream for writing
            'w|gz'       open a gzip compressed stream for writing
            'w|bz2'      open a bzip2 compressed stream for writing
+           'w|xz'       open an xz compressed stream for writing
+           'w|zst'      open a zstd compressed stream for writing
         """
 
         if not name and not fileobj:
@@ -1038,7 +1213,7 @@ class CpioFile(object):
             raise CompressionError("gzip module is not available")
 
         if fileobj is None:
-            fileobj = file(name, mode + "b")
+            fileobj = bltn_open(name, mode + "b")
 
         try:
             t = cls.cpioopen(name, mode,
@@ -1073,11 +1248,51 @@ class CpioFile(object):
         t._extfileobj = False
         return t
 
+    @classmethod
+    def xzopen(cls, name, mode="r", fileobj=None, preset=None):
+        """Open xz compressed cpio archive name for reading or writing.
+           Appending is not allowed.
+        """
+        if len(mode) > 1 or mode not in "rw":
+            raise ValueError("mode must be 'r' or 'w'")
+
+        try:
+            import lzma
+        except ImportError:
+            raise CompressionError("lzma module is not available")
+
+        try:
+            t = cls.cpioopen(name, mode,
+                lzma.LZMAFile(fileobj or name, mode, preset=preset))
+        except (IOError, lzma.LZMAError, EOFError):
+            raise ReadError("not an xz file")
+        t._extfileobj = False
+        return t
+
+    @classmethod
+    def zstopen(cls, name, mode="r", fileobj=None):
+        """Open zstd compressed cpio archive name for reading or writing.
+           Appending is not allowed. The archive is read as a stream, so
+           members can only be accessed in order.
+        """
+        if len(mode) > 1 or mode not in "rw":
+            raise ValueError("mode must be 'r' or 'w'")
+
+        zstd = _zstd()
+        try:
+            t = cls(name, mode, _Stream(name, mode, "zst", fileobj, STREAM_BUFSIZE))
+        except zstd.ZstdError:
+            raise ReadError("not a zstd file")
+        t._extfileobj = False
+        return t
+
     # All *open() methods are registered here.
     OPEN_METH = {
         "cpio": "cpioopen",   # uncompressed cpio
         "gz":  "gzopen",    # gzip compressed cpio
-        "bz2": "bz2open"    # bzip2 compressed cpio
+        "bz2": "bz2open",   # bzip2 compressed cpio
+        "xz":  "xzopen",    # xz compressed cpio
+        "zst": "zstopen"    # zstd compressed cpio
     }
 
     #--------------------------------------------------------------------------
@@ -1122,6 +1337,8 @@ class CpioFile(object):
            list has the same order as the members in the archive.
         """
         self._check()
+        if self._streaming:
+            raise StreamError("members are not kept when streaming")
         if not self._loaded:    # if we want to obtain a list of
             self._load()        # all members, we first have to
                                 # scan the whole archive.
@@ -1180,7 +1397,7 @@ class CpioFile(object):
         cpioinfo.uid = statres.st_uid
         cpioinfo.gid = statres.st_gid
         cpioinfo.nlink = statres.st_nlink
-        cpioinfo.mtime = statres.st_mtime
+        cpioinfo.mtime = int(statres.st_mtime)
         if stat.S_ISREG(stmd):
             cpioinfo.size = statres.st_size
         else:
@@ -1256,7 +1473,7 @@ class CpioFile(object):
 
         # Append the cpio header and data to the archive.
         if cpioinfo.isreg():
-            f = file(name, "rb")
+            f = bltn_open(name, "rb")
             self.addfile(cpioinfo, f)
             f.close()
 
@@ -1303,31 +1520,35 @@ class CpioFile(object):
                 self.fileobj.write((WORDSIZE - remainder) * NUL)
                 self.offset += (WORDSIZE - remainder)
 
-        self.members.append(cpioinfo)
+        self._addmember(cpioinfo)
 
-    def extractall(self, path=".", members=None):
+    def extractall(self, path=".", members=None, workers=EXTRACT_WORKERS):
         """Extract all members from the archive to the current working
            directory and set owner, modification time and permissions on
            directories afterwards. `path' specifies a different directory
            to extract to. `members' is optional and must be a subset of the
-           list returned by getmembers().
+           list returned by getmembers(). Uncompressed archives in regular
+           files have the data of up to `workers' files written at once.
         """
         directories = []
 
         if members is None:
             members = self
 
-        for cpioinfo in members:
-            if cpioinfo.isdir():
-                # Extract directory with a safe mode, so that
-                # all files below can be extracted as well.
-                try:
-                    os.makedirs(os.path.join(path, cpioinfo.name), 0o777)
-                except EnvironmentError:
-                    pass
-                directories.append(cpioinfo)
-            else:
-                self.extract(cpioinfo, path)
+        if workers > 1 and self._seekable() and not self._streaming:
+            directories = self._extractall_parallel(path, members, workers)
+        else:
+            for cpioinfo in members:
+                if cpioinfo.isdir():
+                    # Extract directory with a safe mode, so that
+                    # all files below can be extracted as well.
+                    try:
+                        os.makedirs(os.path.join(path, cpioinfo.name), 0o777)
+                    except EnvironmentError:
+                        pass
+                    directories.append(cpioinfo)
+                else:
+                    self.extract(cpioinfo, path)
 
         # Reverse sort directories.
         directories.sort(key=lambda a: a.name)
@@ -1335,17 +1556,100 @@ class CpioFile(object):
 
         # Set correct owner, mtime and filemode on directories.
         for cpioinfo in directories:
-            path = os.path.join(path, cpioinfo.name)
+            dirpath = os.path.join(path, cpioinfo.name)
             try:
-                self.chown(cpioinfo, path)
-                self.utime(cpioinfo, path)
-                self.chmod(cpioinfo, path)
+                self.chown(cpioinfo, dirpath)
+                self.utime(cpioinfo, dirpath)
+                self.chmod(cpioinfo, dirpath)
             except ExtractError as e:
                 if self.errorlevel > 1:
                     raise
                 else:
                     self._dbg(1, "cpiofile: %s" % e)
 
+    def _seekable(self):
+        """Return whether member data can be read at any offset straight
+           from the archive's file descriptor.
+        """
+        return (self._mode == "r" and
+                isinstance(self.fileobj, (io.FileIO, io.BufferedReader, io.BufferedRandom)))
+
+    def _extractall_parallel(self, path, members, workers):
+        """Extract members, writing the data of regular files from a pool
+           of workers. Hard links and other member types are created once
+           the data is in place. Return the directories for extractall()
+           to fix up.
+        """
+        directories = []
+        datafiles = []      # (cpioinfo, data member)
+        others = []         # extracted afterwards, in archive order
+        firstlinks = {}     # inode -> name of the first link extracted
+
+        for cpioinfo in list(members):
+            if cpioinfo.isdir():
+                try:
+                    os.makedirs(os.path.join(path, cpioinfo.name), 0o777)
+                except EnvironmentError:
+                    pass
+                directories.append(cpioinfo)
+            elif cpioinfo.isreg() and cpioinfo.nlink > 1:
+                key = self._inokey(cpioinfo)
+                if key in firstlinks:
+                    others.append(cpioinfo)
+                else:
+                    firstlinks[key] = cpioinfo.name
+                    datafiles.append((cpioinfo, self._datamember(cpioinfo)))
+            elif cpioinfo.isreg():
+                datafiles.append((cpioinfo, cpioinfo))
+            else:
+                others.append(cpioinfo)
+
+        # The hard links made below refer to the first link of each inode
+        self.inodes.update((key, [name]) for key, name in firstlinks.items())
+
+        fd = self.fileobj.fileno()
+        with concurrent.futures.ThreadPoolExecutor(max_workers=workers) as executor:
+            results = [executor.submit(self._extract_data, cpioinfo, datainfo, fd, path)
+                       for cpioinfo, datainfo in datafiles]
+            for f in results:
+                f.result()
+
+        for cpioinfo in others:
+            self.extract(cpioinfo, path)
+        return directories
+
+    def _extract_data(self, cpioinfo, datainfo, fd, path):
+        """Write the data of datainfo to the file for cpioinfo, reading it
+           from file descriptor fd, and set its owner, mode and mtime.
+        """
+        cpiogetpath = os.path.normpath(os.path.join(path, cpioinfo.name))
+        try:
+            upperdirs = os.path.dirname(cpiogetpath)
+            if upperdirs:
+                os.makedirs(upperdirs, 0o777, exist_ok=True)
+            self._dbg(1, cpioinfo.name)
+            outfd = os.open(cpiogetpath, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+            try:
+                copyrange(fd, datainfo.offset_data, datainfo.size, outfd)
+            finally:
+                os.close(outfd)
+            self.chown(cpioinfo, cpiogetpath)
+            self.chmod(cpioinfo, cpiogetpath)
+            self.utime(cpioinfo, cpiogetpath)
+        except EnvironmentError as e:
+            if self.errorlevel > 0:
+                raise
+            else:
+                if e.filename is None:
+                    self._dbg(1, "cpiofile: %s" % e.strerror)
+                else:
+                    self._dbg(1, "cpiofile: %s %r" % (e.strerror, e.filename))
+        except ExtractError as e:
+            if self.errorlevel > 1:
+                raise
+            else:
+                self._dbg(1, "cpiofile: %s" % e)
+
     def extract(self, member, path=""):
         """Extract a member from the archive to the current working directory,
            using its full name. Its file information is extracted as accurately
@@ -1479,23 +1783,36 @@ class CpioFile(object):
         """Make a file called cpiogetpath.
         """
         extractinfo = None
+        key = self._inokey(cpioinfo)
         if cpioinfo.nlink == 1:
             extractinfo = cpioinfo
         else:
-            if cpioinfo.ino in self.inodes:
+            if key in self.inodes:
                 # actual file exists, create link
                 # FIXME handle platforms that don't support hardlinks
-                os.link(os.path.join(cpioinfo._link_path, self.inodes[cpioinfo.ino][0]), cpiogetpath)
+                os.link(os.path.join(cpioinfo._link_path, self.inodes[key][0]), cpiogetpath)
+                if self._streaming and cpioinfo.size > 0:
+                    extractinfo = cpioinfo
+            elif self._streaming:
+                # The data cannot be read ahead: it follows the last
+                # link. Start with an empty file and write the data
+                # through whichever link carries it.
+                self.inodes[key] = []
+                extractinfo = cpioinfo
             else:
-                self.inodes[cpioinfo.ino] = []
+                self.inodes[key] = []
                 extractinfo = self._datamember(cpioinfo)
 
-        self.inodes[cpioinfo.ino].append(cpioinfo.name)
+        if key in self.inodes:
+            self.inodes[key].append(cpioinfo.name)
+            if self._streaming and len(self.inodes[key]) >= cpioinfo.nlink:
+                # all links are extracted, the inode is not needed again
+                del self.inodes[key]
 
         if extractinfo:
             source = self.extractfile(extractinfo)
-            cpioget = file(cpiogetpath, "wb")
-            copyfileobj(source, cpioget)
+            cpioget = bltn_open(cpiogetpath, "wb")
+            copyfileobj(source, cpioget, extractinfo.size)
             source.close()
             cpioget.close()
 
@@ -1620,7 +1937,7 @@ class CpioFile(object):
             cpioinfo = CpioInfo.frombuf(buf)
             total_header_len = self._word(HEADERSIZE_SVR4 + cpioinfo.namesize)
             name_buf = self.fileobj.read(total_header_len - HEADERSIZE_SVR4)
-            cpioinfo.name = name_buf.rstrip(NUL)
+            cpioinfo.name = name_buf.rstrip(NUL).decode(ENCODING, "surrogateescape")
 
             if cpioinfo.name == TRAILER_NAME:
                 self.offset += total_header_len
@@ -1634,7 +1951,7 @@ class CpioFile(object):
 
             if cpioinfo.issym():
                 linkname_buf = self.fileobj.read(self._word(cpioinfo.size))
-                cpioinfo.linkname = linkname_buf.rstrip(NUL)
+                cpioinfo.linkname = linkname_buf.rstrip(NUL).decode(ENCODING, "surrogateescape")
                 self.offset += self._word(cpioinfo.size)
                 cpioinfo.size = 0
 
@@ -1646,7 +1963,7 @@ class CpioFile(object):
                                 "file: %s" % e)
             return None
 
-        self.members.append(cpioinfo)
+        self._addmember(cpioinfo)
         return cpioinfo
 
     def proc_member(self, cpioinfo):
@@ -1671,16 +1988,41 @@ class CpioFile(object):
             words += 1
         return words * WORDSIZE
 
+    def _inokey(self, cpioinfo):
+        """Return the key identifying the inode of cpioinfo; inode numbers
+           are only unique per device.
+        """
+        return (cpioinfo.devmajor, cpioinfo.devminor, cpioinfo.ino)
+
+    def _addmember(self, cpioinfo):
+        """Append cpioinfo to the members and index it by name and, if it
+           holds the data of a hard link, by inode.
+        """
+        if self._streaming:
+            return
+        cpioinfo._index = len(self.members)
+        self.members.append(cpioinfo)
+        self._names.setdefault(cpioinfo.name, []).append(cpioinfo)
+        if cpioinfo.nlink > 1 and cpioinfo.size > 0 and cpioinfo.isreg():
+            self._datamembers.setdefault(self._inokey(cpioinfo), cpioinfo)
+
     def _datamember(self, cpioinfo):
         """Find the archive member that actually has the data
            for cpioinfo.ino.
         """
-        if cpioinfo.size == 0:
-            # perhaps another member has the data?
-            for info in self:
-                if info.ino == cpioinfo.ino and info.size > 0:
-                    self._dbg(2, "cpiofile: found member %s" % info.name)
-                    return info
+        if cpioinfo.size == 0 and not self._streaming:
+            # perhaps another member has the data? It may not have been
+            # read yet: in newc archives the data follows the last link.
+            key = self._inokey(cpioinfo)
+            info = self._datamembers.get(key)
+            while info is None and not self._loaded:
+                if next(self) is None:
+                    self._loaded = True
+                    break
+                info = self._datamembers.get(key)
+            if info is not None:
+                self._dbg(2, "cpiofile: found member %s" % info.name)
+                return info
 
         return cpioinfo
 
@@ -1689,16 +2031,15 @@ class CpioFile(object):
            If cpioinfo is given, it is used as the starting point.
         """
         # Ensure that all members have been loaded.
-        members = self.getmembers()
+        self.getmembers()
 
+        candidates = self._names.get(name, [])
         if cpioinfo is None:
-            end = len(members)
-        else:
-            end = members.index(cpioinfo)
-
-        for i in range(end - 1, -1, -1):
-            if name == members[i].name:
-                return members[i]
+            return candidates[-1] if candidates else None
+        end = getattr(cpioinfo, "_index", len(self.members))
+        for info in reversed(candidates):
+            if info._index < end:
+                return info
 
     def _load(self):
         """Read through the entire archive file and look for readable
@@ -1719,6 +2060,29 @@ class CpioFile(object):
         if mode is not None and self._mode not in mode:
             raise IOError("bad operation for mode %r" % self._mode)
 
+    def iterstream(self):
+        """Iterate over the members of the archive in a single pass
+           without keeping them, so that an archive of any size is walked
+           in constant memory. Each member must be dealt with (e.g. by
+           extract() or extractfile()) before the next one is read, and the
+           archive cannot be listed or searched by name afterwards. Only
+           hard links still to be extracted are remembered.
+        """
+        self._check("r")
+        self._streaming = True
+        self.members = []
+        self._names = {}
+        self._datamembers = {}
+        return self._iterstream()
+
+    def _iterstream(self):
+        while True:
+            cpioinfo = next(self)
+            if cpioinfo is None:
+                break
+            yield cpioinfo
+        self._loaded = True
+
     def __iter__(self):
         """Provide an iterator object.
         """
@@ -1757,16 +2121,20 @@ class CpioIter:
         # Fix for SF #1100429: Under rare circumstances it can
         # happen that getmembers() is called during iteration,
         # which will cause CpioIter to stop prematurely.
-        if not self.cpiofile._loaded:
+        # Members may also have been read ahead (e.g. to find the data
+        # of a hard link), so walk the member list by index and only
+        # read from the archive past its end.
+        if self.index == 0 and self.cpiofile.firstmember is not None:
+            cpioinfo = next(self.cpiofile)
+        elif self.index < len(self.cpiofile.members):
+            cpioinfo = self.cpiofile.members[self.index]
+        elif not self.cpiofile._loaded:
             cpioinfo = next(self.cpiofile)
             if not cpioinfo:
                 self.cpiofile._loaded = True
                 raise StopIteration
         else:
-            try:
-                cpioinfo = self.cpiofile.members[self.index]
-            except IndexError:
-                raise StopIteration
+            raise StopIteration
         self.index += 1
         return cpioinfo
 
@@ -1807,15 +2175,12 @@ class CpioFileCompat:
     def write(self, filename, arcname=None, compress_type=None):
         self.cpiofile.add(filename, arcname)
     def writestr(self, zinfo, bytes):
-        try:
-            from io import StringIO
-        except ImportError:
-            from io import StringIO
+        from io import BytesIO
         import calendar
         zinfo.name = zinfo.filename
         zinfo.size = zinfo.file_size
         zinfo.mtime = calendar.timegm(zinfo.date_time)
-        self.cpiofile.addfile(zinfo, StringIO(bytes))
+        self.cpiofile.addfile(zinfo, BytesIO(bytes))
     def close(self):
         self.cpiofile.close()
 #class CpioFileCompat
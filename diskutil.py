@@ -360,6 +360,35 @@ def readExtPartitionLabel(partition):
         raise Exception("%s is not ext partition" % partition)
     return label
 
+def readFilesystemUUID(partition):
+    """Return the UUID of the filesystem on partition, or None."""
+    rc, out = util.runCmd2(['blkid', '-s', 'UUID', '-o', 'value', partition], with_stdout=True)
+    if rc != 0:
+        return None
+    return out.strip() or None
+
+# (filesystem type, offset, magic) of the filesystems repositories may be
+# found on; ext2/3/4 are all mounted as ext3
+FS_SIGNATURES = [
+    ('iso9660', 0x8001, b'CD001'),
+    ('vfat', 0x36, b'FAT'),
+    ('vfat', 0x52, b'FAT32'),
+    ('ext3', 0x438, b'\x53\xef'),
+    ]
+
+def filesystemSignature(device):
+    """Return the type of filesystem on device, from its on-disk signature
+    and without mounting it, or None if it is not one of FS_SIGNATURES."""
+    try:
+        with open(device, 'rb') as f:
+            for fstype, offset, magic in FS_SIGNATURES:
+                f.seek(offset)
+                if f.read(len(magic)) == magic:
+                    return fstype
+    except (IOError, OSError) as e:
+        logger.log("Unable to read %s: %s" % (device, e))
+    return None
+
 def getMdDeviceName(disk):
     rv, out = util.runCmd2(['mdadm', '--detail', '--export', disk],
                            with_stdout=True)
@@ -0,0 +1,166 @@
+# SPDX-License-Identifier: GPL-2.0-only
+
+"""dnfapi - drive dnf in-process through its Python API
+
+The dnf module is imported lazily so that callers can fall back to running
+the dnf command if it is not available."""
+
+import os.path
+
+import constants
+from metrics import PackageMetrics
+from xcp import logger
+
+YUM_CONF = '/root/yum.conf'
+
+class TransactionError(Exception):
+    pass
+
+def available():
+    """ Return whether the dnf Python API can be used. """
+    try:
+        import dnf
+    except ImportError:
+        return False
+    return True
+
+def _base(installroot, conf_file=YUM_CONF):
+    """ Return a dnf.Base configured like 'dnf --releasever=/ -c conf_file
+    --installroot installroot'. """
+    import dnf
+    import dnf.conf
+    import dnf.rpm
+
+    base = dnf.Base()
+    conf = base.conf
+    conf.config_file_path = conf_file
+    conf.read(priority=dnf.conf.PRIO_MAINCONFIG)
+    conf.installroot = installroot
+    for opt in ('cachedir', 'logdir', 'persistdir'):
+        conf.prepend_installroot(opt)
+    conf.substitutions['releasever'] = dnf.rpm.detect_releasever('/')
+    base.read_all_repos()
+    return base
+
+def resolve(targets, installroot):
+    """ Resolve targets (package or @group specs) against the configured
+    repositories.  Returns the packages that would be installed as a list
+    of (repository id, location, download size) tuples. """
+    base = _base(installroot)
+    try:
+        base.fill_sack(load_system_repo=True)
+        base.read_comps(arch_filter=True)
+        base.install_specs(targets)
+        base.resolve()
+        pkgs = [(pkg.reponame, pkg.location, pkg.downloadsize)
+                for pkg in base.transaction.install_set]
+        logger.log("Resolved %d packages for %s" % (len(pkgs), ' '.join(targets)))
+        return pkgs
+    finally:
+        base.close()
+
+def _progress_classes():
+    import dnf.callback
+
+    def _name(pkg):
+        location = getattr(pkg, 'location', None)
+        return os.path.basename(location) if location else str(pkg)
+
+    class DownloadProgress(dnf.callback.DownloadProgress):
+        """ Reports the fraction of bytes downloaded across all packages. """
+        def __init__(self, callback, metrics):
+            dnf.callback.DownloadProgress.__init__(self)
+            self.callback = callback
+            self.metrics = metrics
+            self.total_size = 0
+            self.done = {}
+
+        def start(self, total_files, total_size, total_drpms=0):
+            self.total_size = total_size
+            logger.log("Downloading %d packages (%d bytes)" % (total_files, total_size))
+
+        def progress(self, payload, done):
+            if payload not in self.done:
+                self.metrics.download_started(_name(getattr(payload, 'pkg', payload)),
+                                              payload.download_size)
+            self.done[payload] = done
+            if self.total_size > 0:
+                self.callback(min(100, (sum(self.done.values()) * 100) // self.total_size))
+
+        def end(self, payload, status, msg):
+            if status in (dnf.callback.STATUS_FAILED, dnf.callback.STATUS_MIRROR):
+                logger.log("Failed to download %s: %s" % (payload, msg))
+            else:
+                name = _name(getattr(payload, 'pkg', payload))
+                self.metrics.download_started(name, payload.download_size)
+                self.metrics.download_done(name, status == dnf.callback.STATUS_ALREADY_EXISTS)
+
+    class TransactionProgress(dnf.callback.TransactionProgress):
+        """ Reports packages installed, then verified, as separate ranges
+        of the progress bar. """
+        def __init__(self, callback, metrics):
+            dnf.callback.TransactionProgress.__init__(self)
+            self.callback = callback
+            self.metrics = metrics
+
+        def progress(self, package, action, ti_done, ti_total, ts_done, ts_total):
+            if ts_total <= 0:
+                return
+            if action == dnf.callback.PKG_VERIFY:
+                self.callback(90 + (ts_done * 10) // ts_total)
+            elif action in (dnf.callback.PKG_INSTALL, dnf.callback.PKG_UPGRADE,
+                            dnf.callback.PKG_DOWNGRADE, dnf.callback.PKG_REINSTALL):
+                self.metrics.install_started(_name(package))
+                if ti_total and ti_done >= ti_total:
+                    self.metrics.install_done(_name(package))
+                self.callback((ts_done * 90) // ts_total)
+
+        def error(self, message):
+            logger.log("DNF: %s" % message)
+
+    return DownloadProgress, TransactionProgress
+
+def _check_signatures(base, pkgs):
+    """ Check package signatures, importing repository keys as needed, as
+    'dnf install -y' does. """
+    for pkg in pkgs:
+        result, message = base.package_signature_check(pkg)
+        if result == 1:
+            base.package_import_key(pkg, askcb=lambda *args: True)
+            result, message = base.package_signature_check(pkg)
+        if result != 0:
+            raise TransactionError(message)
+
+def install(targets, installroot, progress_callback=lambda x: (), metrics=None):
+    """ Install targets (package or @group specs) into installroot.
+    Progress is reported as resolution, download and transaction phases,
+    the download taking DNF_DOWNLOAD_PROGRESS_SHARE of the range.  Per
+    package times are recorded in metrics, if given. """
+    if metrics is None:
+        metrics = PackageMetrics(' '.join(targets))
+    DownloadProgress, TransactionProgress = _progress_classes()
+    share = constants.DNF_DOWNLOAD_PROGRESS_SHARE
+
+    base = _base(installroot)
+    base.conf.max_parallel_downloads = constants.DNF_PARALLEL_DOWNLOADS
+    base.conf.assumeyes = True
+    try:
+        progress_callback(1)
+        base.fill_sack(load_system_repo=True)
+        base.read_comps(arch_filter=True)
+        base.install_specs(targets)
+        base.resolve()
+        pkgs = base.transaction.install_set
+        logger.log("Installing %d packages for %s" % (len(pkgs), ' '.join(targets)))
+        progress_callback(3)
+
+        download = DownloadProgress(lambda x: progress_callback(3 + (x * (share - 3)) // 100), metrics)
+        base.download_packages(pkgs, download)
+        _check_signatures(base, pkgs)
+        progress_callback(share)
+
+        transaction = TransactionProgress(lambda x: progress_callback(share + (x * (100 - share)) // 100),
+                                          metrics)
+        base.do_transaction(display=transaction)
+    finally:
+        base.close()
@@ -3,6 +3,7 @@
 import re, sys
 import os.path
 import constants
+import hardware
 import util
 import netutil
 from util import dev_null
@@ -24,7 +25,8 @@ def start_lldpad():
         time.sleep(1)
 
 def hw_lldp_capable(intf):
-    return netutil.getDriver(intf) == 'bnx2x'
+    interface, _ = netutil.splitInterfaceVlan(intf)
+    return hardware.facts().nicDriver(interface) == 'bnx2x'
 
 def start_fcoe(interfaces):
     ''' startFCoE takes a list of interfaces
@@ -3,13 +3,24 @@
 import constants
 import util
 import re
+import os
 import os.path
+import threading
 from xcp import logger
 
-import xen.lowlevel.xc as xc
-XC = xc.xc()
-PHYSINFO = XC.physinfo()
-XENINFO = XC.xeninfo()
+_physinfo = None
+_xeninfo = None
+
+def _xcInfo():
+    """ Read physinfo and xeninfo from Xen the first time they are
+    needed. """
+    global _physinfo, _xeninfo
+    if _physinfo is None:
+        import xen.lowlevel.xc as xc
+        handle = xc.xc()
+        _physinfo = handle.physinfo()
+        _xeninfo = handle.xeninfo()
+    return _physinfo, _xeninfo
 
 ################################################################################
 # Functions to get characteristics of the host.  Can work in a VM too, to aid
@@ -44,29 +55,29 @@ def VM_getHostTotalMemoryKB():
     return meminfo['MemTotal']
 
 def PhysHost_getHostTotalMemoryKB():
-
-    if PHYSINFO is None or 'total_memory' not in PHYSINFO:
+    physinfo, _ = _xcInfo()
+    if physinfo is None or 'total_memory' not in physinfo:
         raise RuntimeError("Unable to determine host memory")
 
-    return PHYSINFO['total_memory']
+    return physinfo['total_memory']
 
 def VM_getSerialConfig():
     return None
 
 def PhysHost_getSerialConfig():
-
-    if XENINFO is None or 'xen_commandline' not in XENINFO:
+    _, xeninfo = _xcInfo()
+    if xeninfo is None or 'xen_commandline' not in xeninfo:
         return None
 
-    m = re.match(r'.*(com\d=\S+)', XENINFO['xen_commandline'])
+    m = re.match(r'.*(com\d=\S+)', xeninfo['xen_commandline'])
     return m and m.group(1) or None
 
 def PhysHost_getHostTotalCPUs():
-
-    if PHYSINFO is None or 'nr_cpus' not in PHYSINFO:
+    physinfo, _ = _xcInfo()
+    if physinfo is None or 'nr_cpus' not in physinfo:
         raise RuntimeError("Unable to determine number of CPUs")
 
-    return PHYSINFO['nr_cpus']
+    return physinfo['nr_cpus']
 
 getHostTotalMemoryKB = PhysHost_getHostTotalMemoryKB
 getSerialConfig = PhysHost_getSerialConfig
@@ -77,6 +88,111 @@ def useVMHardwareFunctions():
     getHostTotalMemoryKB = VM_getHostTotalMemoryKB
     getSerialConfig = VM_getSerialConfig
 
+################################################################################
+# Snapshot of the hardware facts used to configure the host, collected once
+# rather than by each of its users.
+
+def _readFile(path):
+    with open(path) as f:
+        return f.read().strip()
+
+class HardwareFacts:
+    """ PCI IDs ('vvvv:dddd'), CPU vendor, family, model and flags, total
+    memory in kB, the drivers of network interfaces by name, and the
+    firmware mode ('uefi' or 'bios'). """
+
+    def __init__(self):
+        self.pci_ids = []
+        self.cpu = {'vendor': None, 'family': None, 'model': None, 'flags': []}
+        self.memory_kb = None
+        self.nic_drivers = {}
+        self.firmware = None
+
+    def collect(self):
+        try:
+            for dev in sorted(os.listdir('/sys/bus/pci/devices')):
+                path = os.path.join('/sys/bus/pci/devices', dev)
+                self.pci_ids.append('%s:%s' % (_readFile(os.path.join(path, 'vendor'))[2:],
+                                               _readFile(os.path.join(path, 'device'))[2:]))
+        except (IOError, OSError) as e:
+            logger.log("Unable to read PCI devices: %s" % e)
+
+        try:
+            with open('/proc/cpuinfo') as f:
+                for line in f:
+                    if not line.strip():
+                        # the first processor is taken as representative
+                        break
+                    k, _, v = line.partition(':')
+                    k, v = k.strip(), v.strip()
+                    if k == 'vendor_id':
+                        self.cpu['vendor'] = v
+                    elif k == 'cpu family':
+                        self.cpu['family'] = int(v)
+                    elif k == 'model':
+                        self.cpu['model'] = int(v)
+                    elif k == 'flags':
+                        self.cpu['flags'] = v.split()
+        except (IOError, ValueError) as e:
+            logger.log("Unable to read CPU information: %s" % e)
+
+        try:
+            self.memory_kb = getHostTotalMemoryKB()
+        except Exception as e:
+            logger.log("Unable to determine host memory: %s" % e)
+
+        self.collectNICs()
+        self.firmware = 'uefi' if os.path.exists('/sys/firmware/efi') else 'bios'
+        return self
+
+    def collectNICs(self):
+        """ (Re)read the drivers of the network interfaces, which change
+        as drivers are loaded. """
+        nic_drivers = {}
+        try:
+            for intf in os.listdir('/sys/class/net'):
+                driver = os.path.join('/sys/class/net', intf, 'device', 'driver')
+                if os.path.exists(driver):
+                    nic_drivers[intf] = os.path.basename(os.path.realpath(driver))
+        except OSError as e:
+            logger.log("Unable to read network interfaces: %s" % e)
+        self.nic_drivers = nic_drivers
+
+    def nicDriver(self, intf):
+        """ Return the driver of the network interface, re-reading the
+        interfaces if it was not present when they were last read. """
+        if intf not in self.nic_drivers:
+            self.collectNICs()
+        return self.nic_drivers.get(intf)
+
+    def toDict(self):
+        return {'pci-ids': self.pci_ids, 'cpu': self.cpu, 'memory-kb': self.memory_kb,
+                'nic-drivers': self.nic_drivers, 'firmware': self.firmware}
+
+_facts = None
+_facts_lock = threading.Lock()
+_facts_thread = None
+
+def collectFactsInBackground():
+    """ Start collecting the hardware facts, so that they are ready when
+    they are first needed. """
+    global _facts_thread
+    with _facts_lock:
+        if _facts is None and _facts_thread is None:
+            _facts_thread = threading.Thread(target=facts, name='hardware-facts')
+            _facts_thread.daemon = True
+            _facts_thread.start()
+
+def facts():
+    """ Return the hardware facts, collecting them if that has not been
+    done yet. """
+    global _facts
+    with _facts_lock:
+        if _facts is None:
+            _facts = HardwareFacts().collect()
+            logger.log("Hardware facts: %s" % _facts.toDict())
+        return _facts
+
 def is_serialConsole(console):
     return console.startswith('hvc') or console.startswith('ttyS')
 
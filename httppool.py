@@ -0,0 +1,409 @@
+# SPDX-License-Identifier: GPL-2.0-only
+
+"""httppool - HTTP/HTTPS client with persistent, pooled connections
+
+Repository access fetches many small files (.treeinfo, repomd.xml,
+primary.xml.gz, packages) from the same server.  Rather than opening a new
+TCP (and TLS) connection for each of them, connections are kept alive and
+reused, and the number of connections per server is bounded.  Proxies
+are taken from the environment (http_proxy, https_proxy and no_proxy), as
+urllib does."""
+
+import base64
+import collections
+import gc
+import http.client
+import ssl
+import threading
+import urllib.parse
+import urllib.request
+
+import constants
+from xcp import logger
+
+REDIRECT_CODES = (301, 302, 303, 307, 308)
+
+class HTTPError(IOError):
+    def __init__(self, url, status, reason):
+        IOError.__init__(self, "HTTP error %d (%s) fetching %s" % (status, reason, url))
+        self.url = url
+        self.status = status
+        self.reason = reason
+
+class PooledResponse(object):
+    """File-like wrapper around an HTTP response.  The connection it was
+    read from goes back to the pool when the response is closed, provided
+    the body was read completely; otherwise the connection is dropped."""
+
+    def __init__(self, pool, key, conn, response, url):
+        self.pool = pool
+        self.key = key
+        self.conn = conn
+        self.response = response
+        self.url = url
+
+    def __getattr__(self, name):
+        return getattr(self.response, name)
+
+    def __iter__(self):
+        return iter(self.response)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def read(self, *params):
+        return self.response.read(*params)
+
+    def readinto(self, b):
+        return self.response.readinto(b)
+
+    def readline(self, *params):
+        return self.response.readline(*params)
+
+    def close(self, reuse=True):
+        conn = self.__dict__.get('conn')
+        if conn is None:
+            return
+        self.conn = None
+        if reuse and self.response.isclosed() and not self.response.will_close:
+            self.pool._release(self.key, conn)
+        else:
+            self.response.close()
+            conn.close()
+            self.pool._release(self.key, None)
+
+    def __del__(self):
+        # A response dropped without being closed must still give its
+        # connection slot back.  When it is collected as part of a cycle,
+        # its socket may already have been finalized, so the connection is
+        # not reused.
+        self.close(reuse=False)
+
+def _basicAuth(username, password):
+    creds = '%s:%s' % (username, password or '')
+    return 'Basic ' + base64.b64encode(creds.encode()).decode()
+
+class ConnectionPool(object):
+    """Pool of keep-alive connections, keyed by (scheme, host, port).  At
+    most max_connections requests are in flight to any one server; further
+    requests wait up to timeout for a connection to be returned."""
+
+    def __init__(self, max_connections=constants.HTTP_MAX_CONNECTIONS,
+                 timeout=constants.HTTP_TIMEOUT):
+        self.max_connections = max_connections
+        self.timeout = timeout
+        self.lock = threading.Lock()
+        self.idle = {}
+        self.slots = {}
+        self.proxies = {}
+        self.ssl_context = ssl.create_default_context()
+
+    def _key(self, url):
+        parts = urllib.parse.urlsplit(url)
+        if parts.scheme not in ('http', 'https'):
+            raise ValueError("Unsupported URL scheme %s" % parts.scheme)
+        port = parts.port or (443 if parts.scheme == 'https' else 80)
+        return (parts.scheme, parts.hostname, port)
+
+    def _proxy(self, key):
+        """Return the (host, port, Proxy-Authorization header or None) of
+        the proxy to reach the server of key through, or None. """
+        with self.lock:
+            if key in self.proxies:
+                return self.proxies[key]
+        scheme, host, _ = key
+        proxy = urllib.request.getproxies().get(scheme)
+        if proxy and not urllib.request.proxy_bypass(host):
+            if '://' not in proxy:
+                proxy = 'http://' + proxy
+            parts = urllib.parse.urlsplit(proxy)
+            auth = None
+            if parts.username is not None:
+                auth = _basicAuth(urllib.parse.unquote(parts.username),
+                                  urllib.parse.unquote(parts.password or ''))
+            proxy = (parts.hostname, parts.port or 80, auth)
+            logger.log("Using proxy %s:%d for %s://%s" % (proxy[0], proxy[1], scheme, host))
+        else:
+            proxy = None
+        with self.lock:
+            self.proxies[key] = proxy
+        return proxy
+
+    def _acquire(self, key, fresh=False):
+        with self.lock:
+            if key not in self.slots:
+                self.slots[key] = threading.BoundedSemaphore(self.max_connections)
+                self.idle[key] = []
+            slots = self.slots[key]
+        if not slots.acquire(timeout=self.timeout):
+            # Responses which were dropped without being closed, but are
+            # kept alive by reference cycles, give their slots back when
+            # collected
+            gc.collect()
+            if not slots.acquire(timeout=self.timeout):
+                raise IOError("Timed out waiting for a connection to %s://%s:%d" % key)
+        with self.lock:
+            if self.idle[key] and not fresh:
+                return self.idle[key].pop(), True
+        scheme, host, port = key
+        proxy = self._proxy(key)
+        if proxy:
+            proxy_host, proxy_port, proxy_auth = proxy
+            if scheme == 'https':
+                conn = http.client.HTTPSConnection(proxy_host, proxy_port, timeout=self.timeout,
+                                                   context=self.ssl_context)
+                conn.set_tunnel(host, port, proxy_auth and {'Proxy-Authorization': proxy_auth})
+            else:
+                conn = http.client.HTTPConnection(proxy_host, proxy_port, timeout=self.timeout)
+        elif scheme == 'https':
+            conn = http.client.HTTPSConnection(host, port, timeout=self.timeout,
+                                               context=self.ssl_context)
+        else:
+            conn = http.client.HTTPConnection(host, port, timeout=self.timeout)
+        return conn, False
+
+    def _release(self, key, conn):
+        with self.lock:
+            if conn is not None:
+                self.idle[key].append(conn)
+            slots = self.slots[key]
+        slots.release()
+
+    def request(self, method, url, username=None, password=None, headers=None,
+                redirects=5):
+        """Issue a request and return a PooledResponse.  Redirects are
+        followed; an HTTPError is raised for error responses."""
+        key = self._key(url)
+        parts = urllib.parse.urlsplit(url)
+        path = parts.path or '/'
+        if parts.query:
+            path += '?' + parts.query
+
+        hdrs = dict(headers or {})
+        if username is not None:
+            hdrs['Authorization'] = _basicAuth(username, password)
+        proxy = self._proxy(key)
+        if proxy and key[0] == 'http':
+            # A plain HTTP proxy is sent the whole URL
+            path = urllib.parse.urlunsplit(parts[:4] + ('',))
+            if proxy[2]:
+                hdrs['Proxy-Authorization'] = proxy[2]
+
+        conn, reused = self._acquire(key)
+        try:
+            try:
+                conn.request(method, path, headers=hdrs)
+                response = conn.getresponse()
+            except (http.client.HTTPException, ConnectionError):
+                # The server may have closed an idle keep-alive connection;
+                # retry once on a fresh one.
+                conn.close()
+                if not reused:
+                    raise
+                self._release(key, None)
+                conn, reused = self._acquire(key, fresh=True)
+                conn.request(method, path, headers=hdrs)
+                response = conn.getresponse()
+        except:
+            conn.close()
+            self._release(key, None)
+            raise
+
+        rv = PooledResponse(self, key, conn, response, url)
+        if response.status in REDIRECT_CODES and redirects > 0:
+            location = response.getheader('Location')
+            response.read()
+            rv.close()
+            if not location:
+                raise HTTPError(url, response.status, response.reason)
+            location = urllib.parse.urljoin(url, location)
+            # Do not leak credentials to another server
+            if self._key(location) != key:
+                username = password = None
+            return self.request(method, location, username, password, headers, redirects - 1)
+        if response.status >= 400:
+            response.read()
+            rv.close()
+            raise HTTPError(url, response.status, response.reason)
+        return rv
+
+    def open(self, url, username=None, password=None, headers=None):
+        """Return a file-like object for the body of url."""
+        return self.request('GET', url, username, password, headers)
+
+    def head(self, url, username=None, password=None):
+        """Return the headers of url, from a HEAD request."""
+        with self.request('HEAD', url, username, password) as rv:
+            rv.read()
+            return rv.headers
+
+    def exists(self, url, username=None, password=None):
+        """Return whether url can be fetched, without transferring it."""
+        try:
+            self.head(url, username, password)
+        except HTTPError as e:
+            if e.status not in (405, 501):
+                return False
+            # HEAD not supported by the server: fall back to a GET
+            try:
+                self.open(url, username, password).close()
+            except Exception:
+                return False
+        except Exception as e:
+            logger.log("Failed to access %s: %s" % (url, e))
+            return False
+        return True
+
+class RangeNotSupported(IOError):
+    pass
+
+class RangeFile(object):
+    """Seekable, read-only view of a remote file, backed by HTTP Range
+    requests.  Recently read blocks are kept in a small LRU cache so that
+    short backward seeks and re-reads do not go back to the server.  If the
+    server stops honouring range requests, the file is read sequentially
+    instead, discarding data up to the offset wanted and starting again
+    from the beginning for backward seeks."""
+
+    blocksize = 256 * 1024
+    cache_blocks = 16
+
+    def __init__(self, pool, url, size, username=None, password=None):
+        self.pool = pool
+        self.url = url
+        self.size = size
+        self.username = username
+        self.password = password
+        self.pos = 0
+        self.closed = False
+        self.cache = collections.OrderedDict()
+        # sequential stream used once range requests are not honoured
+        self.stream = None
+        self.stream_pos = 0
+
+    def _fetch(self, start, end, fallback=True):
+        """Return bytes [start, end) of the remote file."""
+        if self.stream is not None:
+            return self._readStream(start, end)
+        rv = self.pool.request('GET', self.url, self.username, self.password,
+                               {'Range': 'bytes=%d-%d' % (start, end - 1)})
+        if rv.status != 206:
+            if not fallback:
+                rv.close()
+                raise RangeNotSupported("Server ignored range request for %s" % self.url)
+            logger.log("Server ignored range request for %s, reading it sequentially" % self.url)
+            self.stream, self.stream_pos = rv, 0
+            return self._readStream(start, end)
+        try:
+            data = rv.read()
+        finally:
+            rv.close()
+        if len(data) != end - start:
+            raise IOError("Short range read from %s" % self.url)
+        return data
+
+    def _readExactly(self, size):
+        chunks = []
+        while size > 0:
+            chunk = self.stream.read(min(size, self.blocksize))
+            if not chunk:
+                raise IOError("Short read from %s" % self.url)
+            chunks.append(chunk)
+            size -= len(chunk)
+            self.stream_pos += len(chunk)
+        return b''.join(chunks)
+
+    def _readStream(self, start, end):
+        if start < self.stream_pos:
+            self.stream.close()
+            self.stream = self.pool.open(self.url, self.username, self.password)
+            self.stream_pos = 0
+        while self.stream_pos < start:
+            self._readExactly(min(start - self.stream_pos, self.blocksize))
+        return self._readExactly(end - start)
+
+    def _block(self, index, fallback=True):
+        if index in self.cache:
+            self.cache.move_to_end(index)
+            return self.cache[index]
+        start = index * self.blocksize
+        data = self._fetch(start, min(start + self.blocksize, self.size), fallback)
+        self.cache[index] = data
+        if len(self.cache) > self.cache_blocks:
+            self.cache.popitem(last=False)
+        return data
+
+    def probe(self):
+        """Check that the server honours range requests for the file, by
+        fetching the block at the current position into the cache.  Raises
+        RangeNotSupported if it does not."""
+        if self.pos < self.size:
+            self._block(self.pos // self.blocksize, fallback=False)
+
+    def read(self, size=-1):
+        if self.closed:
+            raise ValueError("I/O operation on closed file")
+        if size is None or size < 0:
+            size = self.size - self.pos
+        size = min(size, self.size - self.pos)
+        if size <= 0:
+            return b''
+
+        if size > self.blocksize:
+            # Large reads are fetched in one request, bypassing the cache
+            data = self._fetch(self.pos, self.pos + size)
+        else:
+            chunks = []
+            pos, remaining = self.pos, size
+            while remaining > 0:
+                index, offset = divmod(pos, self.blocksize)
+                chunk = self._block(index)[offset:offset + remaining]
+                chunks.append(chunk)
+                pos += len(chunk)
+                remaining -= len(chunk)
+            data = b''.join(chunks)
+        self.pos += len(data)
+        return data
+
+    def readinto(self, b):
+        data = self.read(len(b))
+        b[:len(data)] = data
+        return len(data)
+
+    def seek(self, offset, whence=0):
+        if whence == 0:
+            pos = offset
+        elif whence == 1:
+            pos = self.pos + offset
+        elif whence == 2:
+            pos = self.size + offset
+        else:
+            raise ValueError("Invalid whence %d" % whence)
+        if pos < 0:
+            raise IOError("Seek before start of file")
+        self.pos = pos
+        return self.pos
+
+    def tell(self):
+        return self.pos
+
+    def close(self):
+        self.closed = True
+        self.cache.clear()
+        if self.stream is not None:
+            self.stream.close()
+            self.stream = None
+
+_pool = None
+_pool_lock = threading.Lock()
+
+def pool():
+    """Return the shared connection pool."""
+    global _pool
+    with _pool_lock:
+        if _pool is None:
+            _pool = ConnectionPool()
+        return _pool
@@ -26,6 +26,7 @@ import hardware
 
 # backend
 import backend
+import product
 import restore
 
 # general
@@ -106,6 +107,7 @@ def go(ui, args, answerfile_address, answerfile_script):
 
     if not xen_control_domain() or '--virtual' in args:
         hardware.useVMHardwareFunctions()
+    hardware.collectFactsInBackground()
 
     for (opt, val) in args.items():
         if opt == "--boot-console":
@@ -128,6 +130,27 @@ def go(ui, args, answerfile_address, answerfile_script):
         elif opt == "--cc-preparations":
             constants.CC_PREPARATIONS = True
             results['network-backend'] = constants.NETWORK_BACKEND_BRIDGE
+        elif opt == "--image-install":
+            constants.IMAGE_INSTALL = True
+        elif opt == "--package-cache":
+            constants.PACKAGE_CACHE = val
+        elif opt == "--verify-cache":
+            constants.VERIFY_CACHE = val
+        elif opt == "--package-cache-size":
+            try:
+                size = int(val)
+                if size <= 0:
+                    raise ValueError(val)
+                constants.PACKAGE_CACHE_SIZE = size * 1024 * 1024
+            except (TypeError, ValueError):
+                logger.log("Ignoring --package-cache-size=%s: expected a positive number of MiB, "
+                           "using %d MiB" % (val, constants.PACKAGE_CACHE_SIZE // (1024 * 1024)))
+        elif opt == "--no-incremental-backup":
+            constants.INCREMENTAL_BACKUP = False
+        elif opt == "--block-backup":
+            constants.BLOCK_BACKUP = True
+        elif opt == "--no-backup-checksums":
+            constants.BACKUP_CHECKSUMS = False
 
     if boot_console and not serial_console:
         serial_console = boot_console
@@ -143,6 +166,10 @@ def go(ui, args, answerfile_address, answerfile_script):
 
     interactive = True
     try:
+        # existing installations and backups are inspected repeatedly
+        # until the installation or restore starts
+        util.beginMountSession()
+
         if os.path.isfile(constants.defaults_data_file):
             data_file = open(constants.defaults_data_file)
             try:
@@ -173,6 +200,7 @@ def go(ui, args, answerfile_address, answerfile_script):
                 if ui and results.get('ui-confirmation-prompt',False):
                     if not ui.init.confirm_proceed():
                         logger.log("User did not confirm installation. Reboot")
+                        util.endMountSession()
                         return constants.EXIT_USER_CANCEL
 
                 if 'extra-repos' in results:
@@ -234,6 +262,14 @@ def go(ui, args, answerfile_address, answerfile_script):
             if uiexit == uicontroller.EXIT:
                 aborted = True
 
+        # the backend may format or mount the partitions of backups that
+        # are not being restored
+        keep = None
+        if not aborted and results['install-type'] == constants.INSTALL_TYPE_RESTORE:
+            keep = results['backup-to-restore']
+        product.cancelBackupVerifiers(results.get('backups', []), keep)
+        util.endMountSession()
+
         if not aborted:
             if results['install-type'] == constants.INSTALL_TYPE_RESTORE:
                 logger.log('INPUT ANSWER DICTIONARY')
@@ -277,6 +313,8 @@ Please remove any local media from the drive, and press Enter to reboot.""")
             logger.log("A fatal exception occurred:")
             logger.log(err)
 
+            util.endMountSession()
+
             # run the user's scripts - an arg of "1" indicates failure
             scripts.run_scripts('installation-complete', '1')
 
@@ -0,0 +1,112 @@
+# SPDX-License-Identifier: GPL-2.0-only
+
+"""metrics - throughput of the package installation phases
+
+Records how long each package took to download and to install, so that it
+can be seen whether installing on a given host is bound by the network or
+by decompression and disk."""
+
+import os.path
+import re
+import threading
+import time
+
+import constants
+from xcp import logger
+
+MB = 1024.0 * 1024.0
+
+def packageKey(name):
+    """ Return the key under which package name is recorded.  Downloads
+    are named by file ('bash-5.1-1.x86_64.rpm') and installs by NEVRA
+    ('bash-5.1-1.x86_64', possibly with an epoch, 'bash-1:5.1-1.x86_64' or
+    '1:bash-5.1-1.x86_64'), so both are reduced to name-version-release.arch. """
+    name = os.path.basename(name)
+    if name.endswith('.rpm'):
+        name = name[:-len('.rpm')]
+    return re.sub(r'(^|-)\d+:', r'\1', name)
+
+def _rate(amount, seconds):
+    return amount / seconds if seconds > 0 else 0.0
+
+class PackageMetrics(object):
+    """ Per-package download and install times for one installation phase
+    (e.g. the main repositories or an update).  Methods may be called from
+    several threads. """
+
+    def __init__(self, phase):
+        self.phase = phase
+        self.lock = threading.Lock()
+        # name -> [size, start, end, cached]
+        self.downloads = {}
+        # name -> [start, end]
+        self.installs = {}
+
+    def download_started(self, name, size):
+        name = packageKey(name)
+        with self.lock:
+            if name not in self.downloads:
+                self.downloads[name] = [size, time.time(), None, False]
+
+    def download_done(self, name, cached=False):
+        name = packageKey(name)
+        with self.lock:
+            if name in self.downloads:
+                self.downloads[name][2] = time.time()
+                self.downloads[name][3] = cached
+
+    def install_started(self, name):
+        name = packageKey(name)
+        with self.lock:
+            if name not in self.installs:
+                self.installs[name] = [time.time(), None]
+
+    def install_done(self, name):
+        name = packageKey(name)
+        with self.lock:
+            if name in self.installs and self.installs[name][1] is None:
+                self.installs[name][1] = time.time()
+
+    def _download_summary(self):
+        done = [d for d in self.downloads.values() if d[2] is not None and not d[3]]
+        cached = len([d for d in self.downloads.values() if d[3]])
+        if not done:
+            return "downloaded 0 packages (%d from cache)" % cached
+        size = sum(d[0] for d in done)
+        elapsed = max(d[2] for d in done) - min(d[1] for d in done)
+        return ("downloaded %d packages (%.1f MB, %d from cache) in %.1fs: %.2f MB/s, %.1f packages/s" %
+                (len(done), size / MB, cached, elapsed, _rate(size / MB, elapsed), _rate(len(done), elapsed)))
+
+    def _install_summary(self):
+        done = [(name, i) for name, i in self.installs.items() if i[1] is not None]
+        if not done:
+            return "installed 0 packages"
+        elapsed = max(i[1] for _, i in done) - min(i[0] for _, i in done)
+        sizes = dict((name, d[0]) for name, d in self.downloads.items())
+        size = sum(sizes.get(name, 0) for name, _ in done)
+        return ("installed %d packages (%.1f MB) in %.1fs: %.2f MB/s, %.1f packages/s" %
+                (len(done), size / MB, elapsed, _rate(size / MB, elapsed), _rate(len(done), elapsed)))
+
+    def report(self):
+        """ Write per-package times to the install log, and the aggregate
+        throughput to the install log and the timing summary. """
+        with self.lock:
+            lines = ["Package metrics for %s:" % self.phase]
+            for name in sorted(set(self.downloads) | set(self.installs)):
+                entry = "  %s:" % name
+                d = self.downloads.get(name)
+                if d and d[2] is not None:
+                    entry += " %s %d bytes in %.2fs" % ('cached' if d[3] else 'downloaded', d[0], d[2] - d[1])
+                i = self.installs.get(name)
+                if i and i[1] is not None:
+                    entry += " installed in %.2fs" % (i[1] - i[0])
+                lines.append(entry)
+            summary = "%s: %s; %s" % (self.phase, self._download_summary(), self._install_summary())
+
+        logger.log("\n".join(lines))
+        logger.log(summary)
+        try:
+            with open(constants.TIMING_SUMMARY_LOG, 'a') as f:
+                f.write(summary + "\n")
+        except IOError as e:
+            logger.log("Failed to write timing summary: %s" % e)
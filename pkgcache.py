@@ -0,0 +1,179 @@
+# SPDX-License-Identifier: GPL-2.0-only
+
+"""pkgcache - content-addressed store of packages shared between installs
+
+Packages are stored as <root>/<sha256[:2]>/<sha256>.rpm, keyed by the
+sha256 recorded for them in the repository metadata, so the same package
+is found again whichever repository or build it came from.  The store can
+be a local directory, a block device (e.g. a partition or USB stick) or an
+NFS export; the least recently used packages are evicted once it grows
+beyond its size limit."""
+
+import hashlib
+import os
+import shutil
+import tempfile
+
+import constants
+import util
+from xcp import logger
+
+# directory used within a mounted device or NFS export
+STORE_DIR = 'xs-package-cache'
+
+def _unlink(path):
+    try:
+        os.unlink(path)
+    except OSError:
+        pass
+
+class PackageCache(object):
+    def __init__(self, root, limit):
+        self.root = root
+        self.limit = limit
+        self.added = 0
+        os.makedirs(root, exist_ok=True)
+
+    def path(self, sha256sum):
+        return os.path.join(self.root, sha256sum[:2], sha256sum + '.rpm')
+
+    def lookup(self, sha256sum):
+        """ Return the path of the package with sha256sum, or None if it is
+        not in the cache.  A hit counts as a use for eviction. """
+        path = self.path(sha256sum)
+        try:
+            os.utime(path)
+        except OSError:
+            return None
+        return path
+
+    def _drop(self, path, reason):
+        logger.log("Dropping cached package %s: %s" % (path, reason))
+        _unlink(path)
+        return False
+
+    def fetch(self, sha256sum, dest, progress_bytes=lambda n: ()):
+        """ Copy the package with sha256sum to dest, checking it on the way.
+        Returns whether the package was copied; a corrupt or unreadable
+        copy is dropped from the cache, and the caller fetches the package
+        from its repository instead.  A failure to write dest leaves the
+        cached copy alone. """
+        path = self.lookup(sha256sum)
+        if not path:
+            return False
+        m = hashlib.sha256()
+        buf = bytearray(constants.VERIFY_BUFSIZE)
+        view = memoryview(buf)
+        copied = 0
+        read_error = None
+        try:
+            infh = open(path, 'rb')
+        except (IOError, OSError) as e:
+            return self._drop(path, e)
+        try:
+            with infh, open(dest, 'wb') as outfh:
+                while True:
+                    try:
+                        n = infh.readinto(buf)
+                    except (IOError, OSError) as e:
+                        read_error = e
+                        break
+                    if not n:
+                        break
+                    m.update(view[:n])
+                    outfh.write(view[:n])
+                    copied += n
+        except (IOError, OSError) as e:
+            logger.log("Unable to copy cached package %s to %s: %s" % (path, dest, e))
+            _unlink(dest)
+            return False
+        if read_error is None and m.hexdigest() == sha256sum:
+            progress_bytes(copied)
+            return True
+        _unlink(dest)
+        return self._drop(path, read_error or "checksum mismatch")
+
+    def add(self, sha256sum, src):
+        """ Add a copy of the (already verified) package file src. """
+        path = self.path(sha256sum)
+        if os.path.exists(path):
+            return
+        try:
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            fd, tmp = tempfile.mkstemp(dir=os.path.dirname(path), suffix='.part')
+            try:
+                with os.fdopen(fd, 'wb') as outfh, open(src, 'rb') as infh:
+                    shutil.copyfileobj(infh, outfh, constants.VERIFY_BUFSIZE)
+                os.rename(tmp, path)
+            except:
+                os.unlink(tmp)
+                raise
+            self.added += os.path.getsize(path)
+        except (IOError, OSError) as e:
+            # A full or read-only cache must not fail the install
+            logger.log("Unable to add %s to package cache: %s" % (src, e))
+
+    def evict(self):
+        """ Remove least recently used packages until the cache is within
+        its size limit. """
+        entries = []
+        total = 0
+        for dirpath, _, filenames in os.walk(self.root):
+            for name in filenames:
+                path = os.path.join(dirpath, name)
+                try:
+                    st = os.stat(path)
+                except OSError:
+                    continue
+                if name.endswith('.part'):
+                    # left behind by an interrupted install
+                    os.unlink(path)
+                    continue
+                entries.append((st.st_mtime, st.st_size, path))
+                total += st.st_size
+        entries.sort()
+        for _, size, path in entries:
+            if total <= self.limit:
+                break
+            os.unlink(path)
+            total -= size
+        logger.log("Package cache %s: %d bytes added, %d bytes in use" % (self.root, self.added, total))
+
+    def close(self):
+        try:
+            self.evict()
+        except OSError as e:
+            logger.log("Failed to evict from package cache: %s" % e)
+
+class MountedPackageCache(PackageCache):
+    def __init__(self, location, limit):
+        if location.startswith('nfs://'):
+            self.mount = util.TempMount(location[len('nfs://'):], 'pkgcache-', ['rw', 'tcp'], 'nfs')
+        else:
+            self.mount = util.TempMount(location, 'pkgcache-', ['rw'])
+        try:
+            PackageCache.__init__(self, os.path.join(self.mount.mount_point, STORE_DIR), limit)
+        except:
+            self.mount.unmount()
+            raise
+
+    def close(self):
+        PackageCache.close(self)
+        self.mount.unmount()
+
+def openCache():
+    """ Return the package cache configured with --package-cache, or None
+    if there is none or it cannot be used.  Callers must close() it. """
+    location = constants.PACKAGE_CACHE
+    if not location:
+        return None
+    try:
+        if location.startswith('nfs://') or location.startswith('/dev/') or '=' in location:
+            cache = MountedPackageCache(location, constants.PACKAGE_CACHE_SIZE)
+        else:
+            cache = PackageCache(location, constants.PACKAGE_CACHE_SIZE)
+    except Exception as e:
+        logger.log("Not using package cache %s: %s" % (location, e))
+        return None
+    logger.log("Using package cache %s" % location)
+    return cache
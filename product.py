@@ -11,6 +11,7 @@ import version
 import re
 import stat
 import repository
+import treecopy
 from disktools import *
 import hardware
 import xcp
@@ -44,9 +45,11 @@ class ExistingInstallation:
         return "%s %s" % (
             self.visual_brand, self.visual_version)
 
-    def mount_state(self):
-        """ Mount main state partition on self.state_fs. """
-        self.state_fs = util.TempMount(self.state_device, 'state-', )
+    def mount_state(self, ro=True):
+        """ Mount main state partition on self.state_fs.  It is shared with
+        other users of the partition, and is only made writable if ro is
+        False. """
+        self.state_fs = util.SessionMount(self.state_device, 'state-', None if ro else ['rw'])
 
     def unmount_state(self):
         self.state_fs.unmount()
@@ -476,9 +479,9 @@ class ExistingRetailInstallation(ExistingInstallation):
         self.boot_fs_mount = None
 
     def readInventory(self):
-        self.mount_root()
+        root_fs = util.SessionMount(self.root_device, 'root-', ['ro'])
         try:
-            self.inventory = util.readKeyValueFile(os.path.join(self.root_fs.mount_point,
+            self.inventory = util.readKeyValueFile(os.path.join(root_fs.mount_point,
                                                                 constants.INVENTORY_FILE),
                                                    strip_quotes=True)
             self.build = self.inventory.get('BUILD_NUMBER', None)
@@ -504,7 +507,7 @@ class ExistingRetailInstallation(ExistingInstallation):
                 self.visual_version = self.inventory['PRODUCT_VERSION_TEXT']
                 self.detailed_version = self.inventory['PRODUCT_VERSION'] + build_suffix
         finally:
-            self.unmount_root()
+            root_fs.unmount()
 
 class XenServerBackup:
     def __init__(self, part, mnt):
@@ -540,6 +543,19 @@ class XenServerBackup:
         else:
             self.root_disk = diskutil.partitionFromId(self.inventory['PRIMARY_DISK'])
             self.root_disk = getMpathMasterOrDisk(self.root_disk)
+        self.verifier = None
+
+    def verifyInBackground(self):
+        """ Start checking the backup against its manifest, so that the
+        result is ready by the time it is restored. """
+        if self.verifier is None:
+            self.verifier = treecopy.BackgroundVerify(self.partition)
+            self.verifier.start()
+
+    def cancelVerify(self):
+        if self.verifier is not None:
+            self.verifier.cancel()
+            self.verifier = None
 
     def __str__(self):
         return "%s %s" % (
@@ -548,6 +564,13 @@ class XenServerBackup:
     def __repr__(self):
         return "<XenServerBackup: %s (%s) on %s>" % (str(self), self.detailed_version, self.partition)
 
+def cancelBackupVerifiers(backups, keep=None):
+    """ Stop checking the backups, other than keep, in the background, and
+    wait for them to be released before their partitions are used. """
+    for b in backups:
+        if b is not keep:
+            b.cancelVerify()
+
 def findXenSourceBackups():
     """Scans the host and find partitions containing backups of XenSource
     products.  Returns a list of device node paths to partitions containing
@@ -558,7 +581,7 @@ def findXenSourceBackups():
     for p in partitions:
         b = None
         try:
-            b = util.TempMount(p, 'backup-', ['ro'], 'ext3')
+            b = util.SessionMount(p, 'backup-', ['ro'])
             if os.path.exists(os.path.join(b.mount_point, '.xen-backup-partition')):
                 backup = XenServerBackup(p, b.mount_point)
                 logger.log("Found a backup: %s" % (repr(backup),))
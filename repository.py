@@ -6,16 +6,26 @@ import glob
 import errno
 import hashlib
 import tempfile
+import io
 import urllib.request, urllib.parse
 import ftplib
 import subprocess
 import re
 import gzip
 import shutil
+import time
+import threading
+import itertools
+import concurrent.futures
+import json
 from xml.dom.minidom import parse
 
 import diskutil
+import dnfapi
 import hardware
+import httppool
+from metrics import PackageMetrics
+import pkgcache
 import version
 import util
 from util import dev_null
@@ -55,27 +65,36 @@ class Repository(object):
     def accessor(self):
         return self._accessor
 
-    def check(self, progress=lambda x: ()):
-        """ Return a list of problematic packages. """
-        def pkg_progress(start, end):
-            def progress_fn(x):
-                progress(start + ((x * (end - start)) / 100))
-            return progress_fn
+    def check(self, progress=lambda x: (), force=False):
+        """ Return a list of problematic packages.  Packages are verified
+        concurrently by a pool of workers sized by the accessor; progress is
+        reported from the calling thread based on the number of bytes
+        hashed so far.  Packages which passed a previous check and have not
+        changed since are skipped unless force is specified. """
+        lock = threading.Lock()
+        total_read = [0]
+
+        def progress_bytes(n):
+            with lock:
+                total_read[0] += n
 
         self._accessor.start()
 
         try:
-            problems = []
-            total_size = sum((p.size for p in self._packages))
-            total_progress = 0
-            for p in self._packages:
-                start = (total_progress * 100) / total_size
-                end = ((total_progress + p.size) * 100) / total_size
-                if not p.check(False, pkg_progress(start, end)):
-                    problems.append(p)
-                total_progress += p.size
+            total_size = sum((p.size for p in self._packages)) or 1
+            workers = max(1, self._accessor.verify_streams)
+            with concurrent.futures.ThreadPoolExecutor(max_workers=workers) as executor:
+                results = [(p, executor.submit(p.check, False, progress_bytes=progress_bytes,
+                                               force=force))
+                           for p in self._packages]
+                pending = set(f for _, f in results)
+                while pending:
+                    _, pending = concurrent.futures.wait(pending, timeout=0.5)
+                    progress(min(100, (total_read[0] * 100) / total_size))
+            problems = [p for p, f in results if not f.result()]
         finally:
             self._accessor.finish()
+            verificationCache().save()
         return problems
 
     def __iter__(self):
@@ -97,7 +116,8 @@ reposdir=/tmp/repos
 history_record=false
 """ % cachedir
 
-_yumRepositoryId = 1
+# next() is atomic, so repositories probed in parallel get distinct ids
+_yumRepositoryIds = itertools.count(1)
 class YumRepository(Repository):
     """ Represents a Yum repository containing packages and associated meta data. """
     REPOMD_FILENAME = "repodata/repomd.xml"
@@ -106,9 +126,7 @@ class YumRepository(Repository):
 
     def __init__(self, accessor):
         super(YumRepository, self).__init__(accessor)
-        global _yumRepositoryId
-        self._identifier = "repo%d" % _yumRepositoryId
-        _yumRepositoryId += 1
+        self._identifier = "repo%d" % next(_yumRepositoryIds)
 
     @property
     def _yum_conf(self):
@@ -132,7 +150,8 @@ class YumRepository(Repository):
         primaryfp = accessor.openAddress(primary_location, mode="rb")
         # Open compressed xml using cpiofile._Stream which is an adapter between CpioFile and a stream-like object.
         # Useful when specifying the URL for HTTP or FTP repository - A simple GzipFile object will not work in this situation.
-        primary_xml = cpiofile._Stream("", "r", "gz", primaryfp, 20*512)
+        # The compression (gzip, bzip2, xz or zstd) is detected from the data.
+        primary_xml = cpiofile._Stream("", "r", "*", primaryfp, cpiofile.STREAM_BUFSIZE)
         primary_dom = parse(primary_xml)
         package_names = primary_dom.getElementsByTagName("location")
         package_sizes = primary_dom.getElementsByTagName("size")
@@ -200,7 +219,11 @@ baseurl=%s
                 yum_conf.write(repo_config)
 
         self.disableInitrdCreation(mounts['root'])
-        installFromYum(self._targets, mounts, progress_callback, self._cachedir)
+        metrics = PackageMetrics(self.name())
+        try:
+            installFromYum(self._targets, mounts, progress_callback, self._cachedir, metrics)
+        finally:
+            metrics.report()
         self.enableInitrdCreation()
 
     def installPackages(self, progress_callback, mounts):
@@ -239,6 +262,7 @@ class MainYumRepository(YumRepositoryWithInfo):
         super(MainYumRepository, self).__init__(accessor)
         self._identifier = MAIN_REPOSITORY_NAME
         self.keyfiles = []
+        self.image = None
 
         def get_name_version(config_parser, section, name_key, vesion_key):
             name, version = None, None
@@ -289,6 +313,12 @@ class MainYumRepository(YumRepositoryWithInfo):
             if treeinfo.has_section('keys'):
                 for _, keyfile in treeinfo.items('keys'):
                     self.keyfiles.append(keyfile)
+            if treeinfo.has_section('image'):
+                self.image = {
+                    'file': treeinfo.get('image', 'file'),
+                    'sha256': treeinfo.get('image', 'sha256'),
+                    'size': treeinfo.getint('image', 'size', fallback=0)
+                }
         except Exception as e:
             accessor.finish()
             logger.logException(e)
@@ -388,6 +418,7 @@ class DriverUpdateYumRepository(UpdateYumRepository):
 
     INFO_FILENAME = "update.xml"
     _cachedir = 'run/yuminstaller'
+    _lock = threading.Lock()
     _yum_conf = """[main]
 cachedir=/%s
 keepcache=0
@@ -411,29 +442,31 @@ history_record=false
 
     @classmethod
     def isRepo(cls, accessor):
-        if UpdateYumRepository.isRepo(accessor):
-            url = accessor.url()
-            with open('/root/yum.conf', 'w') as yum_conf:
-                yum_conf.write(cls._yum_conf)
-                yum_conf.write("""
+        # /root/yum.conf is shared, so check one repository at a time
+        with cls._lock:
+            if UpdateYumRepository.isRepo(accessor):
+                url = accessor.url()
+                with open('/root/yum.conf', 'w') as yum_conf:
+                    yum_conf.write(cls._yum_conf)
+                    yum_conf.write("""
 [driverrepo]
 name=driverrepo
 baseurl=%s
 """ % url.getPlainURL())
-                username = url.getUsername()
-                if username is not None:
-                    yum_conf.write("username=%s\n" % (url.getUsername(),))
-                password = url.getPassword()
-                if password is not None:
-                    yum_conf.write("password=%s\n" % (url.getPassword(),))
-
-            # Check that the drivers group exists in the repo.
-            rv, out = util.runCmd2(['yum', '-c', '/root/yum.conf',
-                                    'group', 'summary', 'drivers'], with_stdout=True)
-            if rv == 0 and 'Groups: 1\n' in out.strip():
-                return True
+                    username = url.getUsername()
+                    if username is not None:
+                        yum_conf.write("username=%s\n" % (url.getUsername(),))
+                    password = url.getPassword()
+                    if password is not None:
+                        yum_conf.write("password=%s\n" % (url.getPassword(),))
+
+                # Check that the drivers group exists in the repo.
+                rv, out = util.runCmd2(['yum', '-c', '/root/yum.conf',
+                                        'group', 'summary', 'drivers'], with_stdout=True)
+                if rv == 0 and 'Groups: 1\n' in out.strip():
+                    return True
 
-        return False
+            return False
 
 class RPMPackage(object):
     def __init__(self, repository, name, size, sha256sum):
@@ -442,34 +475,160 @@ class RPMPackage(object):
         self.size = int(size)
         self.sha256sum = sha256sum
 
-    def check(self, fast=False, progress=lambda x : ()):
+    def check(self, fast=False, progress=lambda x : (), progress_bytes=None, force=False):
         """ Check a package against it's known checksum, or if fast is
-        specified, just check that the package exists. """
+        specified, just check that the package exists.  progress is called
+        with the percentage of this package verified, progress_bytes (if
+        given) with the number of bytes read since the last call.  Unless
+        force is specified, a package that already passed and whose identity
+        (size, mtime, inode or ETag) has not changed is not read again. """
         if fast:
             return self.repository.accessor().access(self.name)
         else:
             try:
+                total_read = [0]
+
+                def report(n):
+                    total_read[0] += n
+                    if progress_bytes:
+                        progress_bytes(n)
+                    if self.size > 0:
+                        progress((total_read[0] * 100) / self.size)
+
+                cache = verificationCache()
+                identity = self.repository.accessor().identity(self.name)
+                if not force and cache.passed(identity, self.sha256sum):
+                    logger.log("Package %s unchanged since last verified" % self.name)
+                    report(self.size)
+                    return True
+
                 logger.log("Validating package %s" % self.name)
-                namefp = self.repository.accessor().openAddress(self.name)
-                m = hashlib.sha256()
-                data = ''
-                total_read = 0
-                while True:
-                    data = namefp.read(10485760)
-                    total_read += len(data)
-                    if data == '':
-                        break
-                    else:
-                        m.update(data)
-                    progress(total_read / (self.size / 100))
-                namefp.close()
-                calculated = m.hexdigest()
+                calculated = self._digest(report)
                 valid = (self.sha256sum == calculated)
+                cache.record(identity, self.sha256sum, valid)
                 return valid
             except Exception as e:
                 return False
 
+    def fetch(self, dest, progress_bytes=lambda n: ()):
+        """ Copy the package to dest, checking its sha256 on the way. """
+        try:
+            with open(dest, 'wb') as out:
+                calculated = self._digest(progress_bytes, out)
+            if calculated != self.sha256sum:
+                raise ErrorInstallingPackage("Checksum mismatch for %s" % self.name)
+        except:
+            if os.path.exists(dest):
+                os.unlink(dest)
+            raise
+
+    def _digest(self, progress_bytes, out=None):
+        """ Return the sha256 of the package, reading it into a reusable
+        buffer so that large packages do not churn memory.  If out is
+        given the package is also written to it. """
+        namefp = self.repository.accessor().openAddress(self.name, mode="rb")
+        try:
+            m = hashlib.sha256()
+            buf = bytearray(VERIFY_BUFSIZE)
+            view = memoryview(buf)
+            while True:
+                n = namefp.readinto(buf)
+                if not n:
+                    break
+                m.update(view[:n])
+                if out:
+                    out.write(view[:n])
+                progress_bytes(n)
+        finally:
+            namefp.close()
+        return m.hexdigest()
+
+class VerificationCache(object):
+    """ Results of previous package verifications, keyed by the identity of
+    the package file as returned by Accessor.identity().  The results are
+    kept in a file in location, which is a directory, a block device or
+    nfs://server:/path. """
+
+    def __init__(self, location):
+        self.location = location
+        self.lock = threading.Lock()
+        self.dirty = False
+        self.entries = {}
+        try:
+            self.entries = self._withPath(self._load)
+        except (IOError, OSError, ValueError, util.MountFailureException) as e:
+            logger.log("Not using previous verification results in %s: %s" % (location, e))
+
+    def _withPath(self, fn):
+        location = self.location
+        if location.startswith('nfs://'):
+            mount = util.TempMount(location[len('nfs://'):], 'verifycache-', ['rw', 'tcp'], 'nfs')
+        elif location.startswith('/dev/') or '=' in location:
+            mount = util.TempMount(location, 'verifycache-', ['rw'])
+        else:
+            return fn(os.path.join(location, VERIFY_CACHE_NAME))
+        try:
+            return fn(os.path.join(mount.mount_point, VERIFY_CACHE_NAME))
+        finally:
+            mount.unmount()
+
+    def _load(self, path):
+        if not os.path.exists(path):
+            return {}
+        with open(path, 'r') as f:
+            return json.load(f)
+
+    def _store(self, path):
+        tmp = path + '.tmp'
+        with open(tmp, 'w') as f:
+            json.dump(self.entries, f)
+        os.rename(tmp, path)
+
+    def passed(self, identity, sha256sum):
+        if identity is None:
+            return False
+        key, attrs = identity
+        with self.lock:
+            entry = self.entries.get(key)
+        return (entry is not None and entry['result'] and
+                entry['sha256'] == sha256sum and entry['attrs'] == attrs)
+
+    def record(self, identity, sha256sum, result):
+        if identity is None:
+            return
+        key, attrs = identity
+        with self.lock:
+            self.entries[key] = {'attrs': attrs, 'sha256': sha256sum, 'result': result}
+            self.dirty = True
+
+    def clear(self):
+        with self.lock:
+            self.entries = {}
+            self.dirty = True
+
+    def save(self):
+        with self.lock:
+            if not self.dirty:
+                return
+            try:
+                self._withPath(self._store)
+                self.dirty = False
+            except (IOError, OSError, util.MountFailureException) as e:
+                logger.log("Failed to save verification cache: %s" % e)
+
+_verificationCache = None
+def verificationCache():
+    global _verificationCache
+    if _verificationCache is None:
+        _verificationCache = VerificationCache(VERIFY_CACHE)
+    return _verificationCache
+
 class Accessor:
+    # number of files that may be read concurrently, e.g. when verifying
+    verify_streams = 1
+    # whether packages should be copied to the target before installing
+    prefetch = False
+
     def pathjoin(base, name):
         return os.path.join(base, name)
     pathjoin = staticmethod(pathjoin)
@@ -485,6 +644,12 @@ class Accessor:
         else:
             return True
 
+    def identity(self, name):
+        """ Return a (key, attributes) pair which changes whenever the
+        content of 'name' might have changed, or None if that cannot be
+        determined cheaply. """
+        return None
+
     def canEject(self):
         return False
 
@@ -505,6 +670,8 @@ class Accessor:
             return DriverUpdateYumRepository(self)
 
 class FilesystemAccessor(Accessor):
+    verify_streams = VERIFY_WORKERS
+
     def __init__(self, location):
         self.location = location
 
@@ -517,6 +684,18 @@ class FilesystemAccessor(Accessor):
     def openAddress(self, addr, mode="r"):
         return open(os.path.join(self.location, addr), mode)
 
+    def source(self):
+        """ Return a stable name for where the files come from. """
+        return self.location
+
+    def identity(self, name):
+        try:
+            st = os.stat(os.path.join(self.location, name))
+        except OSError:
+            return None
+        return ("%s:%s" % (self.source(), name),
+                {'size': st.st_size, 'mtime': st.st_mtime, 'ino': st.st_ino})
+
     def url(self):
         return util.URL("file://%s" % self.location)
 
@@ -530,6 +709,10 @@ class MountingAccessor(FilesystemAccessor):
         self.start_count = 0
         self.location = None
 
+    def source(self):
+        # The mount point changes each time the source is mounted
+        return self.mount_source
+
     def start(self):
         if self.start_count == 0:
             self.location = tempfile.mkdtemp(prefix="media-", dir="/tmp")
@@ -576,6 +759,12 @@ class DeviceAccessor(MountingAccessor):
     def canEject(self):
         return diskutil.removable(self.device)
 
+    def identity(self, name):
+        # Another copy of the same image, such as a second burn of an ISO,
+        # looks the same to stat() in the same drive yet may be damaged,
+        # so packages on devices are always verified
+        return None
+
     def eject(self):
         if self.canEject():
             self.finish()
@@ -585,12 +774,98 @@ class NFSAccessor(MountingAccessor):
     def __init__(self, nfspath):
         MountingAccessor.__init__(self, ['nfs'], nfspath, ['ro', 'tcp'])
 
-class URLFileWrapper:
-    "This wrapper emulate seek (forwards) for URL streams"
-    SEEK_SET = 0 # SEEK_CUR and SEEK_END not supported
+    prefetch = True
+
+class FTPSessionCache(object):
+    """ Logged in FTP sessions, one per (host, port, user), and the
+    listings of the directories looked at through them. """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.sessions = {}
+        self.session_locks = {}
+        self.listings = {}
 
-    def __init__(self, delegate):
+    def _session(self, key, password):
+        if key not in self.sessions:
+            hostname, port, username = key
+            logger.log("Opening FTP session to %s:%d" % (hostname, port))
+            ftp = ftplib.FTP()
+            ftp.connect(hostname, port)
+            ftp.login(username, password)
+            self.sessions[key] = ftp
+        return self.sessions[key]
+
+    def _drop(self, key):
+        ftp = self.sessions.pop(key, None)
+        if ftp:
+            try:
+                ftp.close()
+            except Exception:
+                pass
+
+    def listing(self, hostname, port, username, password, directory):
+        """ Return the set of names in directory, relative to the login
+        directory.  Only successful listings are remembered, so that a
+        directory the server refused to list is asked for again. """
+        key = (hostname, port, username)
+        with self.lock:
+            if key + (directory,) in self.listings:
+                return self.listings[key + (directory,)]
+            session_lock = self.session_locks.setdefault(key, threading.Lock())
+
+        with session_lock:
+            for attempt in range(2):
+                try:
+                    ftp = self._session(key, password)
+                    names = ftp.nlst(directory) if directory else ftp.nlst()
+                    break
+                except ftplib.error_perm as e:
+                    # e.g. 550: missing or empty directory, or no permission
+                    logger.log("Unable to list %s on %s:%d: %s" % (directory, hostname, port, e))
+                    return set()
+                except ftplib.all_errors:
+                    # The server may have dropped an idle session
+                    self._drop(key)
+                    if attempt:
+                        raise
+            names = set(os.path.basename(n.rstrip('/')) for n in names)
+
+        with self.lock:
+            self.listings[key + (directory,)] = names
+        return names
+
+    def close(self):
+        with self.lock:
+            for key in list(self.sessions):
+                self._drop(key)
+            self.listings = {}
+
+_ftpSessions = None
+def ftpSessions():
+    global _ftpSessions
+    if _ftpSessions is None:
+        _ftpSessions = FTPSessionCache()
+    return _ftpSessions
+
+class URLFileWrapper:
+    """This wrapper emulate seek for URL streams.  If the server supports
+    range requests, seeks backwards or far forwards switch to reading
+    through a RangeFile; otherwise forward seeks are emulated by discarding
+    data and backward seeks are not supported.  When the size of the stream
+    is known, seeks to or past its end read nothing rather than requesting
+    a range beyond it."""
+    SEEK_SET = 0
+    SEEK_CUR = 1
+    SEEK_END = 2
+
+    # forward seeks shorter than this are served by discarding data
+    DISCARD_LIMIT = httppool.RangeFile.blocksize
+
+    def __init__(self, delegate, ranged=None, size=None):
         self.delegate = delegate
+        self.ranged = ranged
+        self.size = size
         self.pos = 0
 
     def __getattr__(self, name):
@@ -601,15 +876,60 @@ class URLFileWrapper:
         self.pos += len(ret_val)
         return ret_val
 
+    def readinto(self, b):
+        n = self.delegate.readinto(b)
+        self.pos += n
+        return n
+
+    def tell(self):
+        return self.pos
+
+    def _switch_to_ranged(self, offset):
+        """ Try to continue reading from offset using range requests.
+        Returns whether the switch happened. """
+        try:
+            rf = self.ranged()
+            rf.seek(offset)
+            rf.probe()
+        except httppool.RangeNotSupported as e:
+            logger.log(str(e))
+            self.ranged = None
+            return False
+        self.delegate.close()
+        self.delegate = rf
+        self.ranged = None
+        self.size = rf.size
+        self.pos = offset
+        return True
+
     def seek(self, offset, whence=0):
-        consume = 0
-        if whence == self.SEEK_SET:
-            if offset >= self.pos:
-                consume = offset - self.pos
-            else:
+        if isinstance(self.delegate, httppool.RangeFile):
+            self.pos = self.delegate.seek(offset, whence)
+            return self.pos
+
+        if whence == self.SEEK_CUR:
+            offset += self.pos
+        elif whence == self.SEEK_END:
+            if self.size is None:
+                raise Exception('SEEK_END not supported')
+            offset += self.size
+        elif whence != self.SEEK_SET:
+            raise Exception('Invalid whence %d' % whence)
+
+        if self.size is not None and offset >= self.size:
+            # Nothing is left to read; a later backward seek can still
+            # switch to range requests
+            self.delegate.close()
+            self.delegate = io.BytesIO()
+            self.pos = offset
+            return self.pos
+
+        consume = offset - self.pos
+        if consume < 0 or consume > self.DISCARD_LIMIT:
+            if self.ranged and self._switch_to_ranged(offset):
+                return self.pos
+            if consume < 0:
                 raise Exception('Backward seek not supported')
-        else:
-            raise Exception('Only SEEK_SET supported')
 
         if consume > 0:
             step = 100000
@@ -619,8 +939,12 @@ class URLFileWrapper:
                 consume -= step
             if len(self.read(consume)) != consume: # Discard data
                 raise IOError('Seek beyond end of file')
+        return self.pos
 
 class URLAccessor(Accessor):
+    verify_streams = VERIFY_URL_STREAMS
+    prefetch = True
+
     def __init__(self, url):
         self._url = url
 
@@ -628,19 +952,22 @@ class URLAccessor(Accessor):
             raise Exception('Unsupported URL scheme')
 
         if self._url.getScheme() in ['http', 'https']:
-            username = self._url.getUsername()
-            if username is not None:
+            if self._url.getUsername() is not None:
                 logger.log("Using basic HTTP authentication")
-                hostname = self._url.getHostname()
-                password = self._url.getPassword()
-                self.passman = urllib.request.HTTPPasswordMgrWithDefaultRealm()
-                self.passman.add_password(None, hostname, username, password)
-                self.authhandler = urllib.request.HTTPBasicAuthHandler(self.passman)
-                self.opener = urllib.request.build_opener(self.authhandler)
-                urllib.request.install_opener(self.opener)
+        elif self._url.getScheme() == 'file':
+            self.prefetch = False
+
+        # Keep FTP connections open between files.  An FTP connection
+        # carries one transfer at a time, so each thread gets its own.
+        self.openers = threading.local()
 
         logger.log("Initializing URLRepositoryAccessor with base address %s" % str(self._url))
 
+    def _opener(self):
+        if not hasattr(self.openers, 'opener'):
+            self.openers.opener = urllib.request.build_opener(urllib.request.CacheFTPHandler)
+        return self.openers.opener
+
     def _url_concat(url1, end):
         url1 = url1.rstrip('/')
         end = end.lstrip('/')
@@ -666,48 +993,76 @@ class URLAccessor(Accessor):
     def finish(self):
         pass
 
+    def _http_url(self, path):
+        return self._url_concat(self._url.getPlainURL(), path)
+
     def access(self, path):
-        if not self._url.getScheme == 'ftp':
+        if self._url.getScheme() in ['http', 'https']:
+            return httppool.pool().exists(self._http_url(path), self._url.getUsername(),
+                                          self._url.getPassword())
+
+        if self._url.getScheme() != 'ftp':
             return Accessor.access(self, path)
 
         url = self._url_concat(self._url.getPlainURL(), path)
 
         # if FTP, override by actually checking the file exists because urllib2 seems
-        # to be not so good at this.
+        # to be not so good at this.  The answer comes from a cached listing
+        # of the directory, fetched over a reused session.
         try:
             (scheme, netloc, path, params, query) = urllib.parse.urlsplit(url)
             fname = os.path.basename(path)
             directory = self._url_decode(os.path.dirname(path[1:]))
-            hostname = self._url.getHostname()
-            username = self._url.getUsername()
-            password = self._url.getPassword()
+            port = urllib.parse.urlsplit(self._url.getPlainURL()).port or ftplib.FTP_PORT
 
-            # now open a connection to the server and verify that fname is in
-            ftp = ftplib.FTP(hostname)
-            ftp.login(username, password)
-            ftp.cwd(directory)
-            if ftp.size(fname) is not None:
-                return True
-            lst = ftp.nlst()
-            return fname in lst
-        except:
-            # couldn't parse the server name out:
+            return fname in ftpSessions().listing(self._url.getHostname(), port,
+                                                  self._url.getUsername(),
+                                                  self._url.getPassword(), directory)
+        except Exception as e:
+            logger.log("Failed to access %s: %s" % (url, e))
             return False
 
-    def openAddress(self, address):
+    def identity(self, name):
+        if self._url.getScheme() not in ['http', 'https']:
+            return None
+        try:
+            headers = httppool.pool().head(self._http_url(name), self._url.getUsername(),
+                                           self._url.getPassword())
+        except Exception:
+            return None
+        attrs = {'size': headers.get('Content-Length'),
+                 'etag': headers.get('ETag'),
+                 'mtime': headers.get('Last-Modified')}
+        if attrs['etag'] is None and attrs['mtime'] is None:
+            return None
+        return ("%s:%s" % (self._url.getPlainURL(), name), attrs)
+
+    def openAddress(self, address, mode="r"):
+        # URL streams are always binary; mode is accepted for compatibility
+        # with the other accessors.
+        ranged = None
         if self._url.getScheme() in ['http', 'https']:
-            ret_val = urllib.request.urlopen(self._url_concat(self._url.getPlainURL(), address))
+            url = self._http_url(address)
+            ret_val = httppool.pool().open(url, self._url.getUsername(), self._url.getPassword())
         else:
-            ret_val = urllib.request.urlopen(self._url_concat(self._url.getURL(), address))
-        return URLFileWrapper(ret_val)
+            ret_val = self._opener().open(self._url_concat(self._url.getURL(), address))
+        size = ret_val.headers.get('Content-Length')
+        if size is not None:
+            size = int(size)
+            if (self._url.getScheme() in ['http', 'https'] and
+                ret_val.headers.get('Accept-Ranges') == 'bytes'):
+                ranged = lambda: httppool.RangeFile(httppool.pool(), url, size,
+                                                    self._url.getUsername(),
+                                                    self._url.getPassword())
+        return URLFileWrapper(ret_val, ranged, size)
 
     def url(self):
         return self._url
 
-def repositoriesFromDefinition(media, address, drivers=False):
+def repositoriesFromDefinition(media, address, drivers=False, stop_at_main=False):
     if media == 'local':
         # this is a special case as we need to locate the media first
-        return findRepositoriesOnMedia(drivers)
+        return findRepositoriesOnMedia(drivers, stop_at_main)
     else:
         accessors = { 'filesystem': FilesystemAccessor,
                       'url': URLAccessor,
@@ -725,8 +1080,10 @@ def repositoriesFromDefinition(media, address, drivers=False):
         accessor.finish()
         return [rv] if rv else []
 
-def findRepositoriesOnMedia(drivers=False):
-    """ Returns a list of repositories available on local media. """
+def findRepositoriesOnMedia(drivers=False, stop_at_main=False):
+    """ Returns a list of repositories available on local media.  Devices
+    are filtered by filesystem signature, then probed in parallel; if
+    stop_at_main is set, probing stops once the main repository is found. """
 
     static_device_patterns = [ 'sd*', 'scd*', 'sr*', 'xvd*', 'nvme*n*', 'vd*' ]
     static_devices = []
@@ -751,118 +1108,395 @@ def findRepositoriesOnMedia(drivers=False):
                 if dev not in parent_devices:
                     parent_devices.append(dev)
 
-    da = None
+    candidates = []
+    for check in parent_devices + partitions:
+        device_path = "/dev/%s" % check
+        if os.path.exists(device_path):
+            fstype = diskutil.filesystemSignature(device_path)
+            if fstype:
+                candidates.append((device_path, fstype))
+    logger.log("Looking for repositories on %s" %
+               ', '.join("%s (%s)" % c for c in candidates))
+
+    found_main = threading.Event()
+
+    def probe(device_path, fstype):
+        if found_main.is_set():
+            return None
+        start = time.time()
+        da = DeviceAccessor(device_path, [fstype])
+        try:
+            da.start()
+        except util.MountFailureException:
+            logger.log("Looking for repositories: %s could not be mounted (%.2fs)" %
+                       (device_path, time.time() - start))
+            return None
+        try:
+            if drivers:
+                repo = da.findDriverRepository()
+            else:
+                repo = da.findRepository()
+        finally:
+            da.finish()
+        logger.log("Looking for repositories: %s %s (%.2fs)" %
+                   (device_path, repo or "no repository", time.time() - start))
+        if stop_at_main and repo and repo.identifier() == MAIN_REPOSITORY_NAME:
+            found_main.set()
+        return repo
+
     repos = []
+    if candidates:
+        workers = min(MEDIA_PROBE_WORKERS, len(candidates))
+        with concurrent.futures.ThreadPoolExecutor(max_workers=workers) as executor:
+            results = [executor.submit(probe, *c) for c in candidates]
+            for f in results:
+                repo = f.result()
+                if repo:
+                    repos.append(repo)
+    return repos
+
+def installFromYum(targets, mounts, progress_callback, cachedir, metrics):
+    """ Install targets into mounts['root'], recording per package times in
+    metrics, which the caller reports. """
+    if dnfapi.available():
+        try:
+            dnfapi.install(targets, mounts['root'], progress_callback, metrics)
+        except Exception as e:
+            logger.logException(e)
+            raise ErrorInstallingPackage("Error installing packages")
+    else:
+        _installFromDnfCommand(targets, mounts, progress_callback, metrics)
+
+    shutil.rmtree(os.path.join(mounts['root'], cachedir))
+
+def _installFromDnfCommand(targets, mounts, progress_callback, metrics):
+    # Use a temporary file to avoid deadlocking
+    stderr = tempfile.TemporaryFile()
+    dnf_cmd = ['dnf', '--releasever=/', '-c', '/root/yum.conf',
+               '--installroot', mounts['root'],
+               'install', '-y'] + targets
+    logger.log("Running : %s" % ' '.join(dnf_cmd))
+    p = subprocess.Popen(dnf_cmd, stdout=subprocess.PIPE, stderr=stderr, universal_newlines=True)
+    count = 0
+    total = 0
+    verify_count = 0
+    installing = None
+    while True:
+        line = p.stdout.readline()
+        if not line:
+            break
+        line = line.rstrip()
+        logger.log("DNF: %s" % line)
+        if line == 'Resolving Dependencies':
+            progress_callback(1)
+        elif line == 'Dependencies Resolved':
+            progress_callback(3)
+        elif line.startswith('-----------------------------------------'):
+            progress_callback(7)
+        elif line == 'Running transaction':
+            progress_callback(10)
+        elif line.endswith(' will be installed') or line.endswith(' will be updated'):
+            total += 1
+        elif line.startswith('  Installing : ') or line.startswith('  Updating : '):
+            count += 1
+            if installing:
+                metrics.install_done(installing)
+            installing = line.split(':', 1)[1].split()[0]
+            metrics.install_started(installing)
+            if total > 0:
+                progress_callback(10 + int((count * 80.0) / total))
+        elif line.startswith('  Verifying  : '):
+            if installing:
+                metrics.install_done(installing)
+                installing = None
+            verify_count += 1
+            progress_callback(90 + int((verify_count * 10.0) / total))
+    rv = p.wait()
+    stderr.seek(0)
+    stderr = stderr.read()
+    if stderr:
+        logger.log("DNF stderr: %s" % stderr.strip())
+
+    if rv:
+        logger.log("DNF exited with %d" % rv)
+        raise ErrorInstallingPackage("Error installing packages")
+
+def _writeYumConf(cachedir, repos, staged=None):
+    """ Write /root/yum.conf for repos.  Repositories with an entry in
+    staged are read from that local directory instead of their source. """
+    staged = staged or {}
+    with open('/root/yum.conf', 'w') as yum_conf:
+        yum_conf.write(_generateYumConf(cachedir))
+        for repo in repos:
+            url = repo._accessor.url()
+            if repo.identifier() in staged:
+                yum_conf.write("""
+[%s]
+name=%s
+baseurl=file://%s
+""" % (repo.identifier(), repo.identifier(), staged[repo.identifier()]))
+            else:
+                yum_conf.write("""
+[%s]
+name=%s
+baseurl=%s
+""" % (repo.identifier(), repo.identifier(), url.getPlainURL()))
+                username = url.getUsername()
+                if username is not None:
+                    yum_conf.write("username=%s\n" % (url.getUsername(),))
+                password = url.getPassword()
+                if password is not None:
+                    yum_conf.write("password=%s\n" % (url.getPassword(),))
+            repo_config = repo._repo_config()
+            if repo_config is not None:
+                yum_conf.write(repo_config)
+
+def _stageRepodata(repo, staging):
+    """ Copy the metadata of repo into staging. """
+    accessor = repo._accessor
+    names = [YumRepository.REPOMD_FILENAME]
+    repomdfp = accessor.openAddress(YumRepository.REPOMD_FILENAME)
     try:
-        for check in parent_devices + partitions:
-            device_path = "/dev/%s" % check
-            logger.log("Looking for repositories: %s" % device_path)
-            if os.path.exists(device_path):
-                da = DeviceAccessor(device_path)
-                try:
-                    da.start()
-                except util.MountFailureException:
-                    da = None
-                    continue
-                else:
-                    if drivers:
-                        repo = da.findDriverRepository()
-                    else:
-                        repo = da.findRepository()
-                    if repo:
-                        repos.append(repo)
-                    da.finish()
-                    da = None
+        repomd_xml = parse(repomdfp)
     finally:
-        if da:
-            da.finish()
+        repomdfp.close()
+    names += [node.getAttribute("href") for node in repomd_xml.getElementsByTagName("location")]
+    signature = YumRepository.REPOMD_FILENAME + ".asc"
+    if accessor.access(signature):
+        names.append(signature)
+
+    for name in names:
+        dest = os.path.join(staging, name)
+        os.makedirs(os.path.dirname(dest), exist_ok=True)
+        infh = accessor.openAddress(name, mode="rb")
+        try:
+            with open(dest, 'wb') as outfh:
+                shutil.copyfileobj(infh, outfh, VERIFY_BUFSIZE)
+        finally:
+            infh.close()
+
+def prefetchPackages(repos, targets, root, cachedir, progress_callback=lambda x: (), metrics=None):
+    """ Download the packages needed to install targets from remote
+    repositories into a staging directory under the target root, so that
+    dnf installs from local disk.  Packages are taken from the package
+    cache if one is configured, otherwise fetched over several parallel
+    streams and their checksums verified as they arrive.  Returns
+    a dict mapping repository identifiers to staging directories; if the
+    package set cannot be resolved nothing is staged, and a repository
+    for which a package or its metadata cannot be fetched is left out, so
+    that dnf installs its packages from the repository itself. """
+    remote = dict((repo.identifier(), repo) for repo in repos
+                  if repo._accessor.prefetch and getattr(repo, '_packages', None))
+    if not remote:
+        return {}
 
-    return repos
+    try:
+        resolved = dnfapi.resolve(targets, root)
+    except Exception as e:
+        logger.log("Not prefetching packages, unable to resolve %s: %s" % (' '.join(targets), e))
+        return {}
+
+    packages = dict(((repo.identifier(), p.name), p) for repo in remote.values() for p in repo)
+    needed = []
+    for repoid, location, _ in resolved:
+        if repoid not in remote:
+            continue
+        if (repoid, location) not in packages:
+            logger.log("Not prefetching packages, %s not found in %s" % (location, repoid))
+            return {}
+        needed.append((remote[repoid], packages[(repoid, location)]))
+    if not needed:
+        return {}
+
+    staged = {}
+    for repoid, repo in remote.items():
+        path = os.path.join(root, cachedir, 'prefetch', repoid)
+        try:
+            _stageRepodata(repo, path)
+        except Exception as e:
+            logger.log("Not prefetching packages from %s, unable to copy its metadata: %s" % (repoid, e))
+            shutil.rmtree(path, ignore_errors=True)
+            continue
+        staged[repoid] = path
+    needed = [(repo, pkg) for repo, pkg in needed if repo.identifier() in staged]
+    if not needed:
+        return staged
+
+    lock = threading.Lock()
+    total_read = [0]
+    cached = [0]
+    failed = set()
+
+    def progress_bytes(n):
+        with lock:
+            total_read[0] += n
+
+    def fetch(repo, pkg):
+        repoid = repo.identifier()
+        if repoid in failed:
+            return
+        dest = os.path.join(staged[repoid], pkg.name)
+        name = os.path.basename(pkg.name)
+        if metrics:
+            metrics.download_started(name, pkg.size)
+        try:
+            os.makedirs(os.path.dirname(dest), exist_ok=True)
+            if cache and cache.fetch(pkg.sha256sum, dest, progress_bytes):
+                with lock:
+                    cached[0] += 1
+                if metrics:
+                    metrics.download_done(name, cached=True)
+                return
+            pkg.fetch(dest, progress_bytes)
+        except Exception as e:
+            logger.log("Unable to prefetch %s from %s: %s" % (pkg.name, repoid, e))
+            with lock:
+                failed.add(repoid)
+            return
+        if metrics:
+            metrics.download_done(name)
+        if cache:
+            cache.add(pkg.sha256sum, dest)
+
+    total_size = sum(pkg.size for _, pkg in needed) or 1
+    logger.log("Prefetching %d packages (%d bytes) using %d streams" %
+               (len(needed), total_size, PREFETCH_STREAMS))
+    cache = pkgcache.openCache()
+    try:
+        with concurrent.futures.ThreadPoolExecutor(max_workers=PREFETCH_STREAMS) as executor:
+            pending = set(executor.submit(fetch, repo, pkg) for repo, pkg in needed)
+            while pending:
+                _, pending = concurrent.futures.wait(pending, timeout=0.5)
+                progress_callback(min(100, (total_read[0] * 100) // total_size))
+    finally:
+        if cache:
+            logger.log("%d of %d packages found in package cache" % (cached[0], len(needed)))
+            cache.close()
+    for repoid in failed:
+        logger.log("Installing packages of %s from the repository, as some could not be prefetched" % repoid)
+        shutil.rmtree(staged.pop(repoid), ignore_errors=True)
+    return staged
+
+def _copyImage(infh, outfh, size, progress_callback, m=None):
+    """ Copy the image from infh to outfh in blocks of IMAGE_BUFSIZE,
+    updating the hash m if given.  Returns the number of bytes copied. """
+    buf = bytearray(IMAGE_BUFSIZE)
+    view = memoryview(buf)
+    total = 0
+    while True:
+        n = infh.readinto(buf)
+        if not n:
+            break
+        if m:
+            m.update(view[:n])
+        outfh.write(view[:n])
+        total += n
+        if size > 0:
+            progress_callback(min(100, (total * 100) // size))
+    return total
+
+def installImage(repo, root, progress_callback=lambda x: ()):
+    """ Install the prebuilt root filesystem image of repo onto root.  The
+    image is a tar stream, optionally compressed.  It is first copied next
+    to root and checked against the sha256 from .treeinfo, so that nothing
+    is extracted from an image which does not match, and then piped through
+    tar in large blocks. """
+    image = repo.image
+    name = image['file']
+    tar_cmd = ['tar', '-x', '--numeric-owner', '--xattrs', '--xattrs-include=*',
+               '--acls', '-C', root, '-f', '-']
+    if name.endswith('.gz') or name.endswith('.tgz'):
+        tar_cmd.insert(1, '-z')
+    elif name.endswith('.xz'):
+        tar_cmd.insert(1, '-J')
+    elif name.endswith('.zst'):
+        tar_cmd.insert(1, '--zstd')
+
+    logger.log("Installing root filesystem image %s" % name)
+    fd, staged = tempfile.mkstemp(dir=root, prefix='.image-')
+    try:
+        m = hashlib.sha256()
+        with os.fdopen(fd, 'wb') as outfh:
+            infh = repo.accessor().openAddress(name, mode="rb")
+            try:
+                total_read = _copyImage(infh, outfh, image['size'],
+                                        _scaledProgress(progress_callback, 0, 50), m)
+            finally:
+                infh.close()
+        if m.hexdigest() != image['sha256']:
+            raise ErrorInstallingPackage("Checksum mismatch for image %s" % name)
 
-def installFromYum(targets, mounts, progress_callback, cachedir):
-        # Use a temporary file to avoid deadlocking
+        logger.log("Running : %s" % ' '.join(tar_cmd))
         stderr = tempfile.TemporaryFile()
-        dnf_cmd = ['dnf', '--releasever=/', '-c', '/root/yum.conf',
-                       '--installroot', mounts['root'],
-                       'install', '-y'] + targets
-        logger.log("Running : %s" % ' '.join(dnf_cmd))
-        p = subprocess.Popen(dnf_cmd, stdout=subprocess.PIPE, stderr=stderr, universal_newlines=True)
-        count = 0
-        total = 0
-        verify_count = 0
-        while True:
-            line = p.stdout.readline()
-            if not line:
-                break
-            line = line.rstrip()
-            logger.log("DNF: %s" % line)
-            if line == 'Resolving Dependencies':
-                progress_callback(1)
-            elif line == 'Dependencies Resolved':
-                progress_callback(3)
-            elif line.startswith('-----------------------------------------'):
-                progress_callback(7)
-            elif line == 'Running transaction':
-                progress_callback(10)
-            elif line.endswith(' will be installed') or line.endswith(' will be updated'):
-                total += 1
-            elif line.startswith('  Installing : ') or line.startswith('  Updating : '):
-                count += 1
-                if total > 0:
-                    progress_callback(10 + int((count * 80.0) / total))
-            elif line.startswith('  Verifying  : '):
-                verify_count += 1
-                progress_callback(90 + int((verify_count * 10.0) / total))
+        p = subprocess.Popen(tar_cmd, stdin=subprocess.PIPE, stderr=stderr)
+        try:
+            with open(staged, 'rb') as infh:
+                _copyImage(infh, p.stdin, total_read,
+                           _scaledProgress(progress_callback, 50, 100))
+        except BrokenPipeError:
+            pass
+        finally:
+            try:
+                p.stdin.close()
+            except BrokenPipeError:
+                pass
         rv = p.wait()
         stderr.seek(0)
         stderr = stderr.read()
         if stderr:
-            logger.log("DNF stderr: %s" % stderr.strip())
-
+            logger.log("tar stderr: %s" % stderr.strip())
         if rv:
-            logger.log("DNF exited with %d" % rv)
-            raise ErrorInstallingPackage("Error installing packages")
+            logger.log("tar exited with %d" % rv)
+            raise ErrorInstallingPackage("Error installing image %s" % name)
+    finally:
+        os.unlink(staged)
+    logger.log("Installed %d bytes from image %s" % (total_read, name))
 
-        shutil.rmtree(os.path.join(mounts['root'], cachedir))
+def _scaledProgress(progress_callback, start, end):
+    return lambda x: progress_callback(start + (x * (end - start)) // 100)
 
 def installFromRepos(progress_callback, repos, mounts):
     """Install from a stacked set of repositories"""
 
     cachedir = "var/cache/yum/installer"
+    metrics = PackageMetrics(", ".join(repo.name() for repo in repos))
     for repo in repos:
         repo._accessor.start()
 
     try:
         # Build a yum config
-        with open('/root/yum.conf', 'w') as yum_conf:
-            yum_conf.write(_generateYumConf(cachedir))
-            for repo in repos:
-                url = repo._accessor.url()
-                yum_conf.write("""
-[%s]
-name=%s
-baseurl=%s
-""" % (repo.identifier(), repo.identifier(), url.getPlainURL()))
-                username = url.getUsername()
-                if username is not None:
-                    yum_conf.write("username=%s\n" % (url.getUsername(),))
-                password = url.getPassword()
-                if password is not None:
-                    yum_conf.write("password=%s\n" % (url.getPassword(),))
-                repo_config = repo._repo_config()
-                if repo_config is not None:
-                    yum_conf.write(repo_config)
-
+        _writeYumConf(cachedir, repos)
 
         repos[0].disableInitrdCreation(mounts['root'])
+        image_repo = None
+        if IMAGE_INSTALL:
+            image_repo = next((repo for repo in repos if getattr(repo, 'image', None)), None)
+
         targets = []
         for repo in repos:
-            if repo._targets:
+            if repo._targets and repo is not image_repo:
                 targets += repo._targets
         targets = list(set(targets))
 
-        installFromYum(targets, mounts, progress_callback, cachedir)
+        start = 0
+        if image_repo:
+            start = IMAGE_PROGRESS_SHARE if targets else 100
+            installImage(image_repo, mounts['root'],
+                         _scaledProgress(progress_callback, 0, start))
+
+        if targets:
+            prefetched = start + ((100 - start) * PREFETCH_PROGRESS_SHARE) // 100
+            staged = prefetchPackages(repos, targets, mounts['root'], cachedir,
+                                      _scaledProgress(progress_callback, start, prefetched),
+                                      metrics)
+            if staged:
+                _writeYumConf(cachedir, repos, staged)
+                start = prefetched
+
+            installFromYum(targets, mounts,
+                           _scaledProgress(progress_callback, start, 100), cachedir, metrics)
         repos[0].enableInitrdCreation()
     finally:
         for repo in repos:
             repo._accessor.finish()
+        metrics.report()
@@ -9,16 +9,59 @@ import os
 import os.path
 import constants
 import re
+import blockimage
+import treecopy
 import tempfile
 import shutil
 import xcp.bootloader as bootloader
 from xcp import logger
 
+# files in the root of a backup that are not part of the backed up root
+BACKUP_FILES = ['.xen-backup-partition', '.xen-gpt.bin', treecopy.MANIFEST, blockimage.MARKER]
+
+def verifyRestore(backup_root, restore_root):
+    """ Check the restored files against the manifest written when the
+    backup was made, if it has one. """
+    entries = treecopy.readManifest(backup_root)
+    if entries is None:
+        logger.log("Backup has no manifest, not verifying restored files")
+        return
+    problems = treecopy.verifyManifest(restore_root, entries)
+    for problem in problems[:100]:
+        logger.log("Restore verification: %s" % problem)
+    if problems:
+        raise RuntimeError("%d restored files do not match the backup, e.g. %s" % (len(problems), problems[0]))
+    logger.log("Verified %d restored entries" % len(entries))
+
+def checkBackup(backup):
+    """ Wait for the verification of the backup started in the background,
+    if any, and refuse to restore a backup that does not match its
+    manifest. """
+    if backup.verifier is None:
+        return
+    problems = backup.verifier.result()
+    if problems is None:
+        logger.log("Backup on %s could not be verified" % backup.partition)
+        return
+    for problem in problems[:100]:
+        logger.log("Backup verification: %s" % problem)
+    if problems:
+        raise RuntimeError("%d files in the backup are damaged, e.g. %s" % (len(problems), problems[0]))
+
 def restoreFromBackup(backup, progress=lambda x: ()):
     """ Restore files from backup_partition to the root partition on disk.
     Call progress with a value between 0 and 100.  Re-install bootloader.  Fails if
     backup is not same version as the CD in use."""
 
+    # the backup partition is mounted once for the whole restore
+    util.beginMountSession()
+    try:
+        _restoreFromBackup(backup, progress)
+    finally:
+        util.endMountSession()
+
+def _restoreFromBackup(backup, progress):
+
     label = None
     bootlabel = None
     disk = backup.root_disk
@@ -27,13 +70,15 @@ def restoreFromBackup(backup, progress=lambda x: ()):
     create_sr_part = storage[0] is not None
     _, boot_partnum, primary_partnum, backup_partnum, logs_partnum, swap_partnum, _ = backend.inspectTargetDisk(disk, None, constants.PRESERVE_IF_UTILITY, create_sr_part)
 
-    backup_fs = util.TempMount(backup.partition, 'backup-', options=['ro'])
+    backup_fs = util.SessionMount(backup.partition, 'backup-', options=['ro'])
     inventory = util.readKeyValueFile(os.path.join(backup_fs.mount_point, constants.INVENTORY_FILE), strip_quotes=True)
     backup_partition_layout = inventory['PARTITION_LAYOUT'].split(',')
     backup_fs.unmount()
 
     logger.log("BACKUP DISK PARTITION LAYOUT: %s" % backup_partition_layout)
 
+    checkBackup(backup)
+
     backup_partition = backup.partition
 
     assert backup_partition.startswith('/dev/')
@@ -60,7 +105,7 @@ def restoreFromBackup(backup, progress=lambda x: ()):
         pass
 
     # mount the backup fs
-    backup_fs = util.TempMount(backup_partition, 'restore-backup-', options=['ro'])
+    backup_fs = util.SessionMount(backup_partition, 'restore-backup-', options=['ro'])
     try:
         # extract the bootloader config
         boot_config = bootloader.Bootloader.loadExisting(backup_fs.mount_point)
@@ -68,11 +113,23 @@ def restoreFromBackup(backup, progress=lambda x: ()):
             raise RuntimeError("Backup uses grub bootloader which is no longer supported - " + \
                 "to restore please use a version of the installer that matches the backup partition")
 
+        # a backup made by imaging the root filesystem is restored by
+        # imaging it back
+        block_image = os.path.exists(os.path.join(backup_fs.mount_point, blockimage.MARKER))
+        if block_image:
+            try:
+                blockimage.imageFilesystem(backup_partition, restore_partition,
+                                           lambda x: progress((x * 90) // 100))
+            except Exception as e:
+                logger.log("Block-level restore failed, copying files: %s" % e)
+                block_image = False
+
         # format the restore partition(s):
-        try:
-            util.mkfs(constants.rootfs_type, restore_partition)
-        except Exception as e:
-            raise RuntimeError("Failed to create root filesystem: %s" % e)
+        if not block_image:
+            try:
+                util.mkfs(constants.rootfs_type, restore_partition)
+            except Exception as e:
+                raise RuntimeError("Failed to create root filesystem: %s" % e)
 
         if efi_boot:
             try:
@@ -86,22 +143,35 @@ def restoreFromBackup(backup, progress=lambda x: ()):
         try:
             if efi_boot:
                 esp = os.path.join(dest_fs.mount_point, 'boot', 'efi')
+                if block_image:
+                    # the image has the files of the boot partition, which
+                    # are copied into it below
+                    shutil.rmtree(esp, ignore_errors=True)
                 os.makedirs(esp)
                 util.mount(boot_device, esp)
                 efi_mounted = True
 
-            # copy files from the backup partition to the restore partition:
-            objs = [x for x in os.listdir(backup_fs.mount_point) if x not in ['lost+found', '.xen-backup-partition', '.xen-gpt.bin']]
-            for i in range(len(objs)):
-                obj = objs[i]
-                logger.log("Restoring subtree %s..." % obj)
-                progress((i * 100) / len(objs))
-
-                # Use 'cp' here because Python's copying tools are useless and
-                # get stuck in an infinite loop when copying e.g. /dev/null.
-                if util.runCmd2(['cp', '-a', os.path.join(backup_fs.mount_point, obj),
-                                 dest_fs.mount_point]) != 0:
-                    raise RuntimeError("Failed to restore %s directory" % obj)
+            if block_image:
+                for name in BACKUP_FILES:
+                    if os.path.exists(os.path.join(dest_fs.mount_point, name)):
+                        os.unlink(os.path.join(dest_fs.mount_point, name))
+                if efi_boot:
+                    copier = treecopy.TreeCopy(os.path.join(backup_fs.mount_point, 'boot', 'efi'), esp)
+                    try:
+                        copier.scan()
+                        copier.copy(lambda x: progress(90 + (x * 10) // 100))
+                    except EnvironmentError as e:
+                        raise RuntimeError("Failed to restore boot partition: %s" % e)
+            else:
+                # copy files from the backup partition to the restore partition:
+                copier = treecopy.TreeCopy(backup_fs.mount_point, dest_fs.mount_point,
+                                           exclude=['lost+found'] + BACKUP_FILES)
+                try:
+                    copier.scan()
+                    copier.copy(lambda x: progress((x * 95) // 100))
+                except EnvironmentError as e:
+                    raise RuntimeError("Failed to restore files: %s" % e)
+                verifyRestore(backup_fs.mount_point, dest_fs.mount_point)
 
             logger.log("Data restoration complete.  About to re-install bootloader.")
 
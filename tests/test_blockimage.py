@@ -0,0 +1,78 @@
+# SPDX-License-Identifier: GPL-2.0-only
+
+import os
+import re
+import sys
+
+import pytest
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+import blockimage
+
+# trimmed output of dumpe2fs on a 1k-block filesystem with 3 groups
+DUMPE2FS = """\
+Filesystem volume name:   root
+Filesystem UUID:          5f1b3a8e-1c2d-4e5f-8a9b-0c1d2e3f4a5b
+Block count:              24576
+Reserved block count:     1228
+Free blocks:              20000
+First block:              1
+Block size:               1024
+
+
+Group 0: (Blocks 1-8192)
+  Primary superblock at 1, Group descriptors at 2-2
+  Block bitmap at 3 (+2), Inode bitmap at 4 (+3)
+  Inode table at 5-260 (+4)
+  7900 free blocks, 2037 free inodes, 2 directories
+  Free blocks: 293-300, 305, 310-8192
+  Free inodes: 12-2048
+Group 1: (Blocks 8193-16384)
+  Backup superblock at 8193, Group descriptors at 8194-8194
+  0 free blocks, 2048 free inodes, 0 directories
+  Free blocks:
+  Free inodes: 2049-4096
+Group 2: (Blocks 16385-24575)
+  Block bitmap at 16385 (+0), Inode bitmap at 16386 (+1)
+  8185 free blocks, 2048 free inodes, 0 directories
+  Free blocks: 16391-24575
+  Free inodes: 4097-6144
+"""
+
+def _usedExtents(monkeypatch, output, rc=0):
+    calls = []
+
+    def runCmd2(cmd, with_stdout=False):
+        calls.append(cmd)
+        return rc, output
+    monkeypatch.setattr(blockimage.util, 'runCmd2', runCmd2)
+    result = blockimage.usedExtents('/dev/sda1')
+    assert calls == [['dumpe2fs', '/dev/sda1']]
+    return result
+
+def test_used_extents(monkeypatch):
+    size, extents = _usedExtents(monkeypatch, DUMPE2FS)
+    assert size == 24576 * 1024
+    # the superblock's "Free blocks:" count is not a range; group 1 has no
+    # free blocks and 305 is a single free block
+    assert extents == [(0, 293 * 1024),
+                       (301 * 1024, 4 * 1024),
+                       (306 * 1024, 4 * 1024),
+                       (8193 * 1024, (16391 - 8193) * 1024)]
+
+def test_used_extents_full_to_the_end(monkeypatch):
+    output = DUMPE2FS.replace('Free blocks: 16391-24575', 'Free blocks: 16391-24000, 24574')
+    _, extents = _usedExtents(monkeypatch, output)
+    assert extents[-2:] == [(24001 * 1024, (24574 - 24001) * 1024),
+                            (24575 * 1024, 1024)]
+
+def test_used_extents_nothing_free(monkeypatch):
+    output = re.sub(r'(?m)^  Free blocks: .*$', '  Free blocks: ', DUMPE2FS)
+    size, extents = _usedExtents(monkeypatch, output)
+    assert extents == [(0, size)]
+
+def test_used_extents_failure(monkeypatch):
+    with pytest.raises(RuntimeError):
+        _usedExtents(monkeypatch, '', rc=1)
+    with pytest.raises(RuntimeError):
+        _usedExtents(monkeypatch, 'Group 0: (Blocks 0-8191)\n  Free blocks: 10-20\n')
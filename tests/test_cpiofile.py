@@ -0,0 +1,34 @@
+# SPDX-License-Identifier: GPL-2.0-only
+
+import bz2
+import gzip
+import io
+import lzma
+import os
+import sys
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+import cpiofile
+
+DATA = b'x' * 10 + os.urandom(100000)
+
+def _read_all(comptype, data):
+    return cpiofile._Stream('', 'r', comptype, io.BytesIO(data)).read()
+
+def test_read_all_plain():
+    assert _read_all('cpio', DATA) == DATA
+
+def test_read_all_gz():
+    assert _read_all('gz', gzip.compress(DATA)) == DATA
+
+def test_read_all_bz2():
+    assert _read_all('bz2', bz2.compress(DATA)) == DATA
+
+def test_read_all_xz():
+    assert _read_all('xz', lzma.compress(DATA)) == DATA
+
+def test_read_all_after_partial_read():
+    stream = cpiofile._Stream('', 'r', 'gz', io.BytesIO(gzip.compress(DATA)))
+    assert stream.read(5) == DATA[:5]
+    assert stream.read() == DATA[5:]
+    assert stream.read() == b''
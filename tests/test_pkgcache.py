@@ -0,0 +1,76 @@
+# SPDX-License-Identifier: GPL-2.0-only
+
+import hashlib
+import os
+import sys
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+import pkgcache
+
+def _add(cache, tmp_path, data, mtime=None):
+    src = tmp_path / 'src.rpm'
+    src.write_bytes(data)
+    sha256sum = hashlib.sha256(data).hexdigest()
+    cache.add(sha256sum, str(src))
+    if mtime is not None:
+        os.utime(cache.path(sha256sum), (mtime, mtime))
+    return sha256sum
+
+def test_fetch(tmp_path):
+    cache = pkgcache.PackageCache(str(tmp_path / 'cache'), 1 << 20)
+    sha256sum = _add(cache, tmp_path, b'rpm' * 1000)
+    copied = []
+    dest = tmp_path / 'a.rpm'
+    assert cache.fetch(sha256sum, str(dest), copied.append)
+    assert dest.read_bytes() == b'rpm' * 1000
+    assert copied == [3000]
+    assert not cache.fetch('0' * 64, str(tmp_path / 'b.rpm'))
+
+def test_fetch_drops_corrupt_copy(tmp_path):
+    cache = pkgcache.PackageCache(str(tmp_path / 'cache'), 1 << 20)
+    sha256sum = _add(cache, tmp_path, b'rpm' * 1000)
+    with open(cache.path(sha256sum), 'r+b') as f:
+        f.write(b'RPM')
+    dest = tmp_path / 'a.rpm'
+    assert not cache.fetch(sha256sum, str(dest))
+    assert not dest.exists()
+    assert cache.lookup(sha256sum) is None
+
+def test_fetch_keeps_copy_when_dest_fails(tmp_path):
+    cache = pkgcache.PackageCache(str(tmp_path / 'cache'), 1 << 20)
+    sha256sum = _add(cache, tmp_path, b'rpm' * 1000)
+    assert not cache.fetch(sha256sum, str(tmp_path / 'missing' / 'a.rpm'))
+    assert cache.lookup(sha256sum) is not None
+
+def test_lookup_counts_as_use(tmp_path):
+    cache = pkgcache.PackageCache(str(tmp_path / 'cache'), 1 << 20)
+    sha256sum = _add(cache, tmp_path, b'a' * 100, mtime=1000)
+    cache.lookup(sha256sum)
+    assert os.stat(cache.path(sha256sum)).st_mtime > 1000
+
+def test_evict_least_recently_used(tmp_path):
+    cache = pkgcache.PackageCache(str(tmp_path / 'cache'), 250)
+    old = _add(cache, tmp_path, b'a' * 100, mtime=1000)
+    new = _add(cache, tmp_path, b'b' * 100, mtime=3000)
+    used = _add(cache, tmp_path, b'c' * 100, mtime=2000)
+    cache.evict()
+    assert cache.lookup(old) is None
+    assert cache.lookup(used) is not None
+    assert cache.lookup(new) is not None
+
+def test_evict_enforces_size_limit(tmp_path):
+    cache = pkgcache.PackageCache(str(tmp_path / 'cache'), 1000)
+    sums = [_add(cache, tmp_path, bytes([i]) * 300, mtime=1000 + i) for i in range(6)]
+    part = tmp_path / 'cache' / 'ab' / 'x.rpm.part'
+    part.parent.mkdir(exist_ok=True)
+    part.write_bytes(b'x' * 10)
+    cache.evict()
+    kept = [s for s in sums if os.path.exists(cache.path(s))]
+    assert kept == sums[-3:]
+    assert not part.exists()
+
+def test_evict_within_limit_keeps_everything(tmp_path):
+    cache = pkgcache.PackageCache(str(tmp_path / 'cache'), 1000)
+    sums = [_add(cache, tmp_path, bytes([i]) * 100, mtime=1000 + i) for i in range(5)]
+    cache.evict()
+    assert all(os.path.exists(cache.path(s)) for s in sums)
@@ -0,0 +1,148 @@
+# SPDX-License-Identifier: GPL-2.0-only
+
+import concurrent.futures
+import http.server
+import io
+import os
+import socket
+import socketserver
+import sys
+import threading
+import time
+
+import pytest
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+import httppool
+import repository
+import util
+
+DATA = os.urandom(600000)
+
+class RangeHandler(http.server.BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    def log_message(self, *args):
+        pass
+
+    def do_GET(self):
+        start, end = self.headers['Range'][len('bytes='):].split('-')
+        body = DATA[int(start):int(end) + 1]
+        self.server.ranges.append((int(start), int(end) + 1))
+        self.send_response(206)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+@pytest.fixture
+def http_server():
+    srv = http.server.ThreadingHTTPServer(('127.0.0.1', 0), RangeHandler)
+    srv.ranges = []
+    thread = threading.Thread(target=srv.serve_forever, daemon=True)
+    thread.start()
+    yield srv
+    srv.shutdown()
+    srv.server_close()
+
+def _wrapper(srv):
+    url = 'http://127.0.0.1:%d/data' % srv.server_address[1]
+    pool = httppool.ConnectionPool(max_connections=2, timeout=5)
+    ranged = lambda: httppool.RangeFile(pool, url, len(DATA))
+    return repository.URLFileWrapper(io.BytesIO(DATA), ranged, len(DATA))
+
+def test_seek_to_end(http_server):
+    f = _wrapper(http_server)
+    assert f.seek(len(DATA)) == len(DATA)
+    assert f.read() == b''
+    assert f.readinto(bytearray(10)) == 0
+    assert http_server.ranges == []
+
+def test_seek_past_end(http_server):
+    f = _wrapper(http_server)
+    assert f.seek(len(DATA) + 1000) == len(DATA) + 1000
+    assert f.read(10) == b''
+    assert f.seek(10, repository.URLFileWrapper.SEEK_END) == len(DATA) + 10
+    assert f.read() == b''
+    assert http_server.ranges == []
+
+def test_seek_back_after_end(http_server):
+    f = _wrapper(http_server)
+    f.seek(len(DATA))
+    f.seek(100)
+    assert f.read(10) == DATA[100:110]
+    assert f.tell() == 110
+
+def test_seek_end_within_file(http_server):
+    f = _wrapper(http_server)
+    assert f.seek(-10, repository.URLFileWrapper.SEEK_END) == len(DATA) - 10
+    assert f.read() == DATA[-10:]
+
+FTP_FILES = dict(('pkg%d.rpm' % i, os.urandom(200000 + i)) for i in range(16))
+
+class FTPHandler(socketserver.StreamRequestHandler):
+    """ Just enough of an FTP server for urllib's ftpwrapper. """
+
+    def reply(self, line):
+        self.wfile.write(line.encode() + b'\r\n')
+
+    def handle(self):
+        data = None
+        self.reply('220 ready')
+        for line in self.rfile:
+            cmd, _, arg = line.decode().strip().partition(' ')
+            cmd = cmd.upper()
+            if cmd == 'USER':
+                self.reply('331 password please')
+            elif cmd == 'PASS':
+                self.reply('230 logged in')
+            elif cmd in ('CWD', 'TYPE', 'NOOP'):
+                self.reply('200 ok')
+            elif cmd == 'PASV':
+                data = socket.socket()
+                data.bind(('127.0.0.1', 0))
+                data.listen(1)
+                port = data.getsockname()[1]
+                self.reply('227 Entering Passive Mode (127,0,0,1,%d,%d)' % (port >> 8, port & 255))
+            elif cmd == 'RETR' and arg in FTP_FILES:
+                body = FTP_FILES[arg]
+                self.reply('150 Opening data connection (%d bytes)' % len(body))
+                conn, _ = data.accept()
+                for i in range(0, len(body), 65536):
+                    conn.sendall(body[i:i + 65536])
+                    time.sleep(0.001)
+                conn.close()
+                data.close()
+                self.reply('226 transfer complete')
+            elif cmd == 'QUIT':
+                self.reply('221 bye')
+                return
+            else:
+                self.reply('550 not found')
+
+@pytest.fixture
+def ftp_server():
+    srv = socketserver.ThreadingTCPServer(('127.0.0.1', 0), FTPHandler)
+    srv.daemon_threads = True
+    thread = threading.Thread(target=srv.serve_forever, daemon=True)
+    thread.start()
+    yield srv
+    srv.shutdown()
+    srv.server_close()
+
+def test_concurrent_ftp_opens(ftp_server):
+    accessor = repository.URLAccessor(util.URL('ftp://127.0.0.1:%d/repo' % ftp_server.server_address[1]))
+
+    def fetch(name):
+        f = accessor.openAddress(name)
+        try:
+            return f.read()
+        finally:
+            f.close()
+
+    executor = concurrent.futures.ThreadPoolExecutor(max_workers=4)
+    try:
+        results = dict(zip(FTP_FILES, executor.map(fetch, FTP_FILES)))
+    finally:
+        executor.shutdown(cancel_futures=True)
+    for name, body in FTP_FILES.items():
+        assert results[name] == body, name
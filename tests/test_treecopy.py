@@ -0,0 +1,204 @@
+# SPDX-License-Identifier: GPL-2.0-only
+
+import hashlib
+import os
+import stat
+import sys
+import threading
+
+import pytest
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+import treecopy
+
+def _describe(root):
+    """ Return what matters of each entry of the tree at root. """
+    tree = {}
+    for dirpath, dirnames, filenames in os.walk(root):
+        for name in dirnames + filenames:
+            path = os.path.join(dirpath, name)
+            rel = os.path.relpath(path, root)
+            if rel.startswith(treecopy.MANIFEST):
+                continue
+            st = os.lstat(path)
+            if stat.S_ISREG(st.st_mode):
+                with open(path, 'rb') as f:
+                    detail = f.read()
+            elif stat.S_ISLNK(st.st_mode):
+                detail = os.readlink(path)
+            else:
+                detail = None
+            mtime = None if stat.S_ISDIR(st.st_mode) else st.st_mtime_ns
+            tree[rel] = (stat.S_IFMT(st.st_mode), stat.S_IMODE(st.st_mode), detail, mtime)
+    return tree
+
+def _copy(src, dst, **kwargs):
+    copier = treecopy.TreeCopy(str(src), str(dst), workers=2, **kwargs)
+    copier.scan()
+    copier.copy()
+    treecopy.writeManifest(str(dst), str(src), copier.entries, True)
+    return copier
+
+@pytest.fixture
+def src(tmp_path):
+    root = tmp_path / 'src'
+    (root / 'etc' / 'sub').mkdir(parents=True)
+    (root / 'etc' / 'hosts').write_bytes(b'127.0.0.1 localhost\n')
+    (root / 'etc' / 'sub' / 'big').write_bytes(os.urandom(3 * 1024 * 1024 + 17))
+    os.chmod(root / 'etc' / 'hosts', 0o640)
+    with open(root / 'sparse', 'wb') as f:
+        f.seek(4 * 1024 * 1024)
+        f.write(b'end')
+    os.link(root / 'etc' / 'hosts', root / 'hosts-link')
+    os.symlink('etc/hosts', root / 'symlink')
+    os.mkfifo(root / 'fifo')
+    (root / 'proc').mkdir()
+    (root / 'proc' / 'cpuinfo').write_bytes(b'not copied')
+    (root / 'skip').write_bytes(b'not copied')
+    return root
+
+@pytest.fixture
+def dst(tmp_path):
+    root = tmp_path / 'dst'
+    root.mkdir()
+    return root
+
+def test_copy_tree(src, dst):
+    copier = _copy(src, dst, empty_dirs=['proc'], exclude=['skip'], hashes=True)
+    expected = _describe(src)
+    del expected['proc/cpuinfo']
+    del expected['skip']
+    assert _describe(dst) == expected
+    assert os.stat(dst / 'hosts-link').st_ino == os.stat(dst / 'etc' / 'hosts').st_ino
+    assert os.stat(dst / 'sparse').st_blocks < os.stat(src / 'sparse').st_blocks + 16
+    assert copier.entries['sparse'][7] == treecopy.hashFile(str(src / 'sparse'))
+    assert copier.entries['etc/sub/big'][7] == \
+        hashlib.sha256((src / 'etc' / 'sub' / 'big').read_bytes()).hexdigest()
+
+def test_copy_without_hashes(src, dst):
+    copier = _copy(src, dst)
+    assert _describe(dst) == _describe(src)
+    assert copier.entries['etc/sub/big'][7] is None
+
+def test_incremental_copy(src, dst):
+    first = _copy(src, dst, hashes=True)
+    (src / 'etc' / 'hosts').write_bytes(b'changed\n')
+    os.unlink(src / 'hosts-link')
+    os.unlink(src / 'skip')
+    (src / 'new').write_bytes(b'new file')
+    os.unlink(src / 'symlink')
+    (src / 'symlink' / 'now-a-dir').mkdir(parents=True)
+    for name in os.listdir(src / 'proc'):
+        os.unlink(src / 'proc' / name)
+    os.rmdir(src / 'proc')
+    (src / 'proc').write_bytes(b'now a file')
+
+    previous = treecopy.readManifest(str(dst), str(src))
+    assert previous == first.entries
+    second = _copy(src, dst, previous=previous, hashes=True)
+    assert _describe(dst) == _describe(src)
+    copied = sorted(rel for rel, _ in second.files)
+    assert copied == ['etc/hosts', 'new', 'proc']
+    # unchanged files keep the checksum recorded by the first copy
+    assert second.entries['etc/sub/big'] == first.entries['etc/sub/big']
+
+def test_manifest(dst):
+    entries = {'a': ['f', 1, 2, 3, 0o100644, 0, 0, None], 'd': ['d', 0o40755, 0, 0]}
+    assert treecopy.readManifest(str(dst)) is None
+    treecopy.writeManifest(str(dst), '/dev/sda1', entries, False)
+    assert treecopy.readManifest(str(dst)) is None
+    treecopy.writeManifest(str(dst), '/dev/sda1', entries, True)
+    assert treecopy.readManifest(str(dst)) == entries
+    assert treecopy.readManifest(str(dst), '/dev/sda1') == entries
+    assert treecopy.readManifest(str(dst), '/dev/sdb1') is None
+    (dst / treecopy.MANIFEST).write_text('{"version": 1, "complete": true, "entries": {}}')
+    assert treecopy.readManifest(str(dst)) is None
+    (dst / treecopy.MANIFEST).write_text('not json')
+    assert treecopy.readManifest(str(dst)) is None
+
+def test_verify_manifest(src, dst):
+    copier = _copy(src, dst)
+    assert treecopy.verifyManifest(str(dst), copier.entries) == []
+    os.unlink(dst / 'etc' / 'hosts')
+    (dst / 'etc' / 'sub' / 'big').write_bytes(b'short')
+    os.unlink(dst / 'sparse')
+    (dst / 'sparse').mkdir()
+    problems = treecopy.verifyManifest(str(dst), copier.entries)
+    assert sorted(problems) == ['etc/hosts is missing',
+                                'etc/sub/big has size 5, expected %d' % (3 * 1024 * 1024 + 17),
+                                'sparse is not of the expected type']
+
+def test_verify_files(src, dst):
+    copier = _copy(src, dst, hashes=True)
+    assert treecopy.verifyFiles(str(dst), copier.entries) == []
+    with open(dst / 'etc' / 'sub' / 'big', 'r+b') as f:
+        f.write(b'corrupt')
+    os.chmod(dst / 'sparse', 0o600)
+    assert sorted(treecopy.verifyFiles(str(dst), copier.entries)) == \
+        ['etc/sub/big does not match its checksum',
+         'sparse has a different size, mode or owner']
+    assert treecopy.verifyFiles(str(dst), copier.entries, paths=['/etc/sub']) == \
+        ['etc/sub/big does not match its checksum']
+    assert treecopy.verifyFiles(str(dst), copier.entries, paths=['etc/sub/bi']) == []
+
+def test_verify_files_hard_link(src, dst):
+    copier = _copy(src, dst, hashes=True)
+    (dst / 'etc' / 'hosts').write_bytes(b'127.0.0.1 localhosT\n')
+    # whichever of the two links was recorded first, selecting either one
+    # checks their data
+    for path in ('etc', 'hosts-link'):
+        problems = treecopy.verifyFiles(str(dst), copier.entries, paths=[path])
+        assert len(problems) == 1
+        assert problems[0].endswith('does not match its checksum')
+
+def test_verify_files_cancelled(src, dst):
+    copier = _copy(src, dst, hashes=True)
+    cancelled = threading.Event()
+    cancelled.set()
+    with pytest.raises(RuntimeError):
+        treecopy.verifyFiles(str(dst), copier.entries, cancelled=cancelled)
+
+class _FakeMount(object):
+    """ Stands in for util.SessionMount: the 'partition' is a directory. """
+    def __init__(self, device, tmp_prefix, options=None, fstype=None):
+        self.mount_point = device
+
+    def unmount(self):
+        pass
+
+def test_background_verify(src, dst, monkeypatch):
+    monkeypatch.setattr(treecopy.util, 'SessionMount', _FakeMount)
+    _copy(src, dst, hashes=True)
+    verifier = treecopy.BackgroundVerify(str(dst))
+    verifier.start()
+    assert verifier.result() == []
+
+    with open(dst / 'etc' / 'sub' / 'big', 'r+b') as f:
+        f.write(b'corrupt')
+    verifier = treecopy.BackgroundVerify(str(dst), paths=['etc'])
+    verifier.start()
+    assert verifier.result() == ['etc/sub/big does not match its checksum']
+
+    os.unlink(dst / treecopy.MANIFEST)
+    verifier = treecopy.BackgroundVerify(str(dst))
+    verifier.start()
+    assert verifier.result() is None
+
+def test_background_verify_cancel(src, dst, monkeypatch):
+    monkeypatch.setattr(treecopy.util, 'SessionMount', _FakeMount)
+    _copy(src, dst, hashes=True)
+    verifier = treecopy.BackgroundVerify(str(dst))
+    verifier.cancelled.set()
+    verifier.start()
+    verifier.cancel()
+    assert not verifier.is_alive()
+    assert verifier.problems is None
+
+@pytest.mark.skipif(os.geteuid() != 0, reason="changing ownership needs root")
+def test_copy_entry_maps_ids(src, dst):
+    os.chown(src / 'etc' / 'hosts', 1000, 1000)
+    treecopy.copyEntry(str(src / 'etc' / 'hosts'), str(dst / 'hosts'),
+                       id_map=lambda uid, gid: (uid + 1, gid + 2))
+    st = os.stat(dst / 'hosts')
+    assert (st.st_uid, st.st_gid) == (1001, 1002)
+    assert (dst / 'hosts').read_bytes() == (src / 'etc' / 'hosts').read_bytes()
@@ -0,0 +1,60 @@
+# SPDX-License-Identifier: GPL-2.0-only
+
+import os
+import re
+import sys
+
+import pytest
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+import util
+
+def test_rewrite_file(tmp_path):
+    path = tmp_path / 'grub.cfg'
+    path.write_bytes(b'root=/dev/sda1 console=tty0\nroot=/dev/sda1\n')
+    count = util.rewriteFile(str(path), [('/dev/sda1', '/dev/sdb1'),
+                                         (re.compile(r'console=(\w+)'), r'console=\1,hvc0')])
+    assert count == 3
+    assert path.read_bytes() == b'root=/dev/sdb1 console=tty0,hvc0\nroot=/dev/sdb1\n'
+
+def test_rewrite_file_leftmost_then_earliest(tmp_path):
+    path = tmp_path / 'f'
+    path.write_bytes(b'abcabc')
+    assert util.rewriteFile(str(path), [('bc', 'X'), ('abc', 'Y'), ('ab', 'Z')]) == 2
+    assert path.read_bytes() == b'YY'
+
+def test_rewrite_file_keeps_metadata(tmp_path):
+    path = tmp_path / 'f'
+    path.write_bytes(b'old')
+    os.chmod(path, 0o640)
+    os.utime(path, (1000, 1000))
+    assert util.rewriteFile(str(path), [('old', 'new')]) == 1
+    assert path.read_bytes() == b'new'
+    assert os.stat(path).st_mode & 0o777 == 0o640
+    assert os.listdir(tmp_path) == ['f']
+
+def test_rewrite_file_unchanged_without_matches(tmp_path, monkeypatch):
+    def fail(*args, **kwargs):
+        raise AssertionError("nothing should be written")
+    monkeypatch.setattr(util.tempfile, 'mkstemp', fail)
+    monkeypatch.setattr(util.os, 'fsync', fail)
+    path = tmp_path / 'f'
+    path.write_bytes(b'nothing to see' * 1000)
+    os.utime(path, (1000, 1000))
+    before = os.stat(path)
+    assert util.rewriteFile(str(path), [('absent', 'x')]) == 0
+    after = os.stat(path)
+    assert (after.st_ino, after.st_mtime_ns) == (before.st_ino, before.st_mtime_ns)
+    assert os.listdir(tmp_path) == ['f']
+
+@pytest.mark.parametrize('offset', range(0, 40))
+def test_rewrite_file_match_across_chunks(tmp_path, monkeypatch, offset):
+    monkeypatch.setattr(util, 'REWRITE_CHUNK_SIZE', 16)
+    monkeypatch.setattr(util, 'REWRITE_MAX_MATCH', 8)
+    data = b'.' * offset + b'needle' + b'.' * 7 + b'<tag a=1>' + b'.' * 20 + b'needle'
+    path = tmp_path / 'f'
+    path.write_bytes(data)
+    subs = [('needle', 'pin'), (re.compile(rb'<tag a=(\d)>'), rb'<tag b=\1>')]
+    expected = re.sub(rb'<tag a=(\d)>', rb'<tag b=\1>', data.replace(b'needle', b'pin'))
+    assert util.rewriteFile(str(path), subs) == 3
+    assert path.read_bytes() == expected
@@ -0,0 +1,518 @@
+# SPDX-License-Identifier: GPL-2.0-only
+
+"""treecopy - copy a directory tree using a pool of workers
+
+Used to back up the dom0 root filesystem.  The tree is scanned first so
+that progress can be reported in bytes copied rather than per directory,
+then the data of regular files is copied by several workers at once.  As
+with 'cp -a', ownership, permissions, timestamps, extended attributes (and
+so ACLs and SELinux labels), hard links, sparse files, symlinks and device
+nodes are preserved.
+
+A copy can also be brought up to date incrementally: a manifest of what
+was copied is kept with it, and the next copy only replaces entries whose
+type, size or times changed in the source, and deletes those that have
+gone, as 'rsync --delete' would.  The manifest can hold the sha256 of each
+file, computed as it is copied, against which the copy can be verified
+later."""
+
+import concurrent.futures
+import errno
+import hashlib
+import json
+import os
+import shutil
+import stat
+import threading
+import time
+
+import constants
+import util
+from xcp import logger
+
+# largest amount of data copied by one system call
+CHUNK_SIZE = 8 * 1024 * 1024
+
+MB = 1024.0 * 1024.0
+
+# kept in the root of the copy, describing it
+MANIFEST = '.xen-backup-manifest'
+MANIFEST_VERSION = 2
+
+# Manifest entries, by relative path:
+#   ['d', mode, uid, gid]                                    directory
+#   ['f', size, mtime, ctime, mode, uid, gid, sha256]        file
+#   ['h', first link]                                        hard link
+#   ['o', size, mtime, ctime, mode, uid, gid]                anything else
+# The sha256 is None if it was not computed.
+
+ZEROS = bytes(1024 * 1024)
+
+def _hashZeros(h, count):
+    """ Add count zero bytes, the contents of a hole, to hash h. """
+    while count > 0:
+        n = min(count, len(ZEROS))
+        h.update(ZEROS[:n])
+        count -= n
+
+def _within(rel, paths):
+    for path in paths:
+        path = path.strip('/')
+        if rel == path or rel.startswith(path + '/'):
+            return True
+    return False
+
+def readManifest(root, source=None):
+    """ Return the entries of the manifest of the copy at root, or None if
+    it has none, it was not completed or, if source is given, it was made
+    from something other than source. """
+    try:
+        with open(os.path.join(root, MANIFEST)) as f:
+            manifest = json.load(f)
+    except (IOError, ValueError) as e:
+        logger.log("No usable manifest in %s: %s" % (root, e))
+        return None
+    if manifest.get('version') != MANIFEST_VERSION:
+        logger.log("Manifest in %s has version %s" % (root, manifest.get('version')))
+        return None
+    if not manifest.get('complete'):
+        logger.log("Copy in %s was not completed" % root)
+        return None
+    if source is not None and manifest.get('source') != source:
+        logger.log("Copy in %s was made from %s, not %s" % (root, manifest.get('source'), source))
+        return None
+    return manifest['entries']
+
+def verifyManifest(root, entries):
+    """ Check the tree at root against manifest entries: each must be
+    there, of the same type and, for files, of the same size and
+    modification time (to the two seconds FAT can record).  Returns a
+    description of each difference. """
+    problems = []
+    for rel, entry in entries.items():
+        try:
+            st = os.lstat(os.path.join(root, rel))
+        except OSError:
+            problems.append("%s is missing" % rel)
+            continue
+        kind = entry[0]
+        if kind == 'd':
+            same_type = stat.S_ISDIR(st.st_mode)
+        elif kind in ('f', 'h'):
+            same_type = stat.S_ISREG(st.st_mode)
+        else:
+            same_type = not stat.S_ISDIR(st.st_mode) and not stat.S_ISREG(st.st_mode)
+        if not same_type:
+            problems.append("%s is not of the expected type" % rel)
+        elif kind == 'f' and st.st_size != entry[1]:
+            problems.append("%s has size %d, expected %d" % (rel, st.st_size, entry[1]))
+        elif kind == 'f' and abs(st.st_mtime_ns - entry[2]) >= 2 * 10**9:
+            problems.append("%s has a different modification time" % rel)
+    return problems
+
+def hashFile(path, cancelled=None):
+    """ Return the sha256 of the contents of path. """
+    h = hashlib.sha256()
+    buf = bytearray(CHUNK_SIZE)
+    view = memoryview(buf)
+    with open(path, 'rb', buffering=0) as f:
+        while True:
+            if cancelled and cancelled.is_set():
+                raise RuntimeError("Verification cancelled")
+            n = f.readinto(buf)
+            if not n:
+                break
+            h.update(view[:n])
+    return h.hexdigest()
+
+def verifyFiles(root, entries, paths=None, workers=constants.COPY_WORKERS, cancelled=None):
+    """ Check the files of the copy at root against the sha256 recorded in
+    its manifest entries, hashing them on a pool of workers.  If paths is
+    given, only files at or below those relative paths, and the first links
+    of hard links among them, are checked.  Size,
+    mode and ownership are compared first, and only files that match them
+    are hashed.  Returns a description of each difference. """
+    if paths is None:
+        wanted = set(entries)
+    else:
+        wanted = set(rel for rel in entries if _within(rel, paths))
+        # the data of a hard link is checked through its first link
+        wanted.update([entries[rel][1] for rel in wanted if entries[rel][0] == 'h'])
+    selected = [(rel, entry) for rel, entry in entries.items()
+                if entry[0] == 'f' and rel in wanted]
+
+    def check(rel, entry):
+        path = os.path.join(root, rel)
+        try:
+            st = os.lstat(path)
+        except OSError:
+            return "%s is missing" % rel
+        if (st.st_size, st.st_mode, st.st_uid, st.st_gid) != tuple(entry[1:2] + entry[4:7]):
+            return "%s has a different size, mode or owner" % rel
+        if entry[7] is not None and hashFile(path, cancelled) != entry[7]:
+            return "%s does not match its checksum" % rel
+        return None
+
+    start = time.time()
+    with concurrent.futures.ThreadPoolExecutor(max_workers=workers) as executor:
+        results = executor.map(lambda item: check(*item), selected)
+        problems = [r for r in results if r]
+    logger.log("Verified %d files in %s in %.1fs: %d problems" %
+               (len(selected), root, time.time() - start, len(problems)))
+    return problems
+
+class BackgroundVerify(threading.Thread):
+    """ Verify the copy on a partition against its manifest in a separate
+    thread, e.g. while the user is still making choices. """
+
+    def __init__(self, partition, paths=None):
+        threading.Thread.__init__(self, name='verify-%s' % os.path.basename(partition))
+        self.daemon = True
+        self.partition = partition
+        self.paths = paths
+        self.cancelled = threading.Event()
+        self.problems = None
+
+    def run(self):
+        try:
+            mnt = util.SessionMount(self.partition, 'verify-', ['ro'])
+            try:
+                entries = readManifest(mnt.mount_point)
+                if entries is not None:
+                    self.problems = verifyFiles(mnt.mount_point, entries, self.paths,
+                                                cancelled=self.cancelled)
+            finally:
+                mnt.unmount()
+        except Exception as e:
+            logger.log("Unable to verify %s: %s" % (self.partition, e))
+
+    def result(self):
+        """ Wait for the verification to finish.  Returns the differences
+        found, or None if the copy could not be verified. """
+        self.join()
+        return self.problems
+
+    def cancel(self):
+        self.cancelled.set()
+        self.join()
+
+def writeManifest(root, source, entries, complete):
+    """ Replace the manifest of the copy at root. """
+    path = os.path.join(root, MANIFEST)
+    with open(path + '.tmp', 'w') as f:
+        json.dump({'version': MANIFEST_VERSION, 'source': source,
+                   'complete': complete, 'entries': entries}, f)
+        f.flush()
+        os.fsync(f.fileno())
+    os.rename(path + '.tmp', path)
+
+def copyEntry(src, dst, id_map=None):
+    """ Copy the file, symbolic link or device node src to dst, replacing
+    whatever is there, as TreeCopy does for each entry of a tree. """
+    copier = TreeCopy(os.path.dirname(src), os.path.dirname(dst), id_map=id_map)
+    st = os.lstat(src)
+    if stat.S_ISREG(st.st_mode):
+        copier._copyContents(src, dst, st)
+    else:
+        copier._createNode(src, dst, st)
+    copier._applyMetadata(src, dst, st)
+
+class TreeCopy(object):
+    """ Copy of the tree at src into the existing directory dst.  For the
+    relative paths in empty_dirs (e.g. 'proc'), only the directory itself
+    is copied, not its contents, and those in exclude are not copied at
+    all.  If previous holds the manifest entries of an earlier copy from
+    src into dst, only what has changed is copied.  With hashes, the sha256
+    of each file copied is recorded in its manifest entry.  id_map, if
+    given, maps the (uid, gid) of each source entry to those of its copy. """
+
+    def __init__(self, src, dst, empty_dirs=(), workers=constants.COPY_WORKERS,
+                 previous=None, exclude=(), hashes=False, id_map=None):
+        self.src = src
+        self.dst = dst
+        self.empty_dirs = set(empty_dirs)
+        self.exclude = set(exclude)
+        self.workers = workers
+        self.previous = previous
+        self.hashes = hashes
+        self.id_map = id_map
+        self.lock = threading.Lock()
+        self.local = threading.local()
+        self.copy_file_range = hasattr(os, 'copy_file_range')
+
+        # relative paths and lstat results, directories parents first
+        self.dirs = []
+        self.files = []
+        self.others = []
+        # (relative path, relative path of the first link to the inode)
+        self.links = []
+        # relative path -> manifest entry
+        self.entries = {}
+        self.unchanged = 0
+        self.total_bytes = 0
+        self.copied_bytes = 0
+
+    def _changed(self, rel, entry):
+        """ Record the manifest entry of rel, and return whether its type,
+        size or times differ from the earlier copy. """
+        previous = self.previous.get(rel) if self.previous is not None else None
+        if previous is not None and previous[:4] == entry[:4]:
+            # keeps the sha256 computed then
+            self.entries[rel] = previous
+            self.unchanged += 1
+            return False
+        self.entries[rel] = entry
+        return True
+
+    def scan(self):
+        """ Walk the source tree, recording what is to be copied.  Returns
+        the number of bytes of file data. """
+        inodes = {}
+        stack = ['']
+        while stack:
+            rel = stack.pop()
+            path = os.path.join(self.src, rel)
+            self.dirs.append((rel, os.lstat(path)))
+            if rel:
+                st = self.dirs[-1][1]
+                self.entries[rel] = ['d', st.st_mode, st.st_uid, st.st_gid]
+            if rel in self.empty_dirs:
+                continue
+            with os.scandir(path) as it:
+                for entry in it:
+                    entry_rel = os.path.join(rel, entry.name)
+                    if entry_rel in self.exclude:
+                        continue
+                    st = entry.stat(follow_symlinks=False)
+                    if stat.S_ISDIR(st.st_mode):
+                        stack.append(entry_rel)
+                    elif stat.S_ISREG(st.st_mode):
+                        if st.st_nlink > 1:
+                            key = (st.st_dev, st.st_ino)
+                            if key in inodes:
+                                self.links.append((entry_rel, inodes[key]))
+                                self.entries[entry_rel] = ['h', inodes[key]]
+                                continue
+                            inodes[key] = entry_rel
+                        if self._changed(entry_rel, ['f', st.st_size, st.st_mtime_ns, st.st_ctime_ns,
+                                                     st.st_mode, st.st_uid, st.st_gid, None]):
+                            self.files.append((entry_rel, st))
+                            self.total_bytes += st.st_size
+                    elif self._changed(entry_rel, ['o', st.st_size, st.st_mtime_ns, st.st_ctime_ns,
+                                                   st.st_mode, st.st_uid, st.st_gid]):
+                        self.others.append((entry_rel, st))
+        logger.log("Scanned %s: %d directories, %d files to copy (%d bytes), %d hard links, "
+                   "%d other, %d unchanged" %
+                   (self.src, len(self.dirs), len(self.files), self.total_bytes,
+                    len(self.links), len(self.others), self.unchanged))
+        return self.total_bytes
+
+    def copy(self, progress_callback=lambda x: ()):
+        """ Copy the scanned tree.  progress_callback is given the
+        percentage of the file data copied so far. """
+        start = time.time()
+        if self.previous is not None:
+            self._removeStale()
+        for rel, _ in self.dirs:
+            try:
+                os.mkdir(os.path.join(self.dst, rel), 0o700)
+            except FileExistsError:
+                pass
+
+        with concurrent.futures.ThreadPoolExecutor(max_workers=self.workers) as executor:
+            pending = [executor.submit(self._copyFile, rel, st) for rel, st in self.files]
+            pending += [executor.submit(self._copyOther, rel, st) for rel, st in self.others]
+            while pending:
+                done, pending = concurrent.futures.wait(pending, timeout=0.5,
+                                                        return_when=concurrent.futures.FIRST_EXCEPTION)
+                for f in done:
+                    if f.exception():
+                        for p in pending:
+                            p.cancel()
+                        raise f.exception()
+                progress_callback(self._percent())
+
+        copied = set(rel for rel, _ in self.files)
+        for rel, first in self.links:
+            if first not in copied and self.previous is not None and \
+                    self.previous.get(rel) == self.entries[rel]:
+                continue
+            path = os.path.join(self.dst, rel)
+            self._unlink(path)
+            os.link(os.path.join(self.dst, first), path)
+
+        # children first, so that copying them does not change the times
+        for rel, st in reversed(self.dirs):
+            self._setMetadata(rel, st)
+        progress_callback(100)
+
+        elapsed = time.time() - start
+        logger.log("Copied %s to %s: %d bytes in %.1fs (%.1f MB/s)" %
+                   (self.src, self.dst, self.copied_bytes, elapsed,
+                    self.copied_bytes / MB / elapsed if elapsed > 0 else 0.0))
+
+    def _removeStale(self):
+        """ Delete what the earlier copy has but the source no longer does,
+        or has as a different type of file.  Children go before their
+        parents. """
+        removed = 0
+        for rel in sorted(self.previous, reverse=True):
+            kind = self.previous[rel][0]
+            entry = self.entries.get(rel)
+            # other changes of type are dealt with by replacing the file
+            if entry is not None and (entry[0] == 'd') == (kind == 'd'):
+                continue
+            path = os.path.join(self.dst, rel)
+            try:
+                if kind == 'd':
+                    shutil.rmtree(path)
+                else:
+                    os.unlink(path)
+                removed += 1
+            except FileNotFoundError:
+                pass
+        logger.log("Removed %d entries from %s" % (removed, self.dst))
+
+    def _percent(self):
+        if self.total_bytes == 0:
+            return 100
+        with self.lock:
+            return min(100, (self.copied_bytes * 100) // self.total_bytes)
+
+    def _progress(self, n):
+        with self.lock:
+            self.copied_bytes += n
+
+    def _unlink(self, path):
+        """ Remove a non-directory left at path, so that it is replaced
+        rather than written through. """
+        try:
+            os.unlink(path)
+        except FileNotFoundError:
+            pass
+
+    def _copyFile(self, rel, st):
+        src = os.path.join(self.src, rel)
+        path = os.path.join(self.dst, rel)
+        h = hashlib.sha256() if self.hashes else None
+        self._copyContents(src, path, st, h)
+        if h:
+            self.entries[rel][7] = h.hexdigest()
+        self._setMetadata(rel, st)
+
+    def _copyContents(self, src, path, st, h=None):
+        self._unlink(path)
+        infd = os.open(src, os.O_RDONLY | os.O_NOFOLLOW)
+        try:
+            outfd = os.open(path, os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0o600)
+            try:
+                self._copyData(infd, outfd, st.st_size, h)
+            finally:
+                os.close(outfd)
+        finally:
+            os.close(infd)
+
+    def _copyData(self, infd, outfd, size, h=None):
+        """ Copy the data regions of infd, leaving holes in outfd where
+        infd has them, and add the contents to hash h if given.  Holes
+        count as copied for progress. """
+        offset = 0
+        while offset < size:
+            try:
+                data = os.lseek(infd, offset, os.SEEK_DATA)
+                hole = min(size, os.lseek(infd, data, os.SEEK_HOLE))
+            except OSError as e:
+                if e.errno == errno.ENXIO:
+                    # nothing but a hole up to the end of the file
+                    break
+                if e.errno != errno.EINVAL:
+                    raise
+                # holes are not reported by this filesystem
+                data, hole = offset, size
+            if h:
+                _hashZeros(h, data - offset)
+            self._progress(data - offset)
+            self._copyRange(infd, outfd, data, hole - data, h)
+            offset = hole
+        if h:
+            _hashZeros(h, max(0, size - offset))
+        self._progress(max(0, size - offset))
+        os.ftruncate(outfd, size)
+
+    def _copyRange(self, infd, outfd, offset, count, h=None):
+        """ Copy count bytes at offset.  The data only passes through
+        userspace if it is to be hashed, or the kernel cannot copy it. """
+        while count > 0:
+            n = min(count, CHUNK_SIZE)
+            if self.copy_file_range and h is None:
+                try:
+                    n = os.copy_file_range(infd, outfd, n, offset, offset)
+                except OSError as e:
+                    if e.errno not in (errno.EXDEV, errno.ENOSYS, errno.EINVAL, errno.EOPNOTSUPP):
+                        raise
+                    # e.g. not between these filesystems: copy through
+                    # userspace from now on
+                    self.copy_file_range = False
+                    continue
+            else:
+                buf = getattr(self.local, 'buf', None)
+                if buf is None:
+                    buf = self.local.buf = bytearray(CHUNK_SIZE)
+                view = memoryview(buf)[:n]
+                n = os.preadv(infd, [view], offset)
+                if h:
+                    h.update(view[:n])
+                written = 0
+                while written < n:
+                    written += os.pwrite(outfd, view[written:n], offset + written)
+            if n == 0:
+                # the source file shrank while it was copied
+                break
+            offset += n
+            count -= n
+            self._progress(n)
+
+    def _copyOther(self, rel, st):
+        self._createNode(os.path.join(self.src, rel), os.path.join(self.dst, rel), st)
+        self._setMetadata(rel, st)
+
+    def _createNode(self, src, path, st):
+        self._unlink(path)
+        if stat.S_ISLNK(st.st_mode):
+            os.symlink(os.readlink(src), path)
+        elif stat.S_ISFIFO(st.st_mode):
+            os.mkfifo(path, 0o600)
+        else:
+            os.mknod(path, stat.S_IFMT(st.st_mode) | 0o600, st.st_rdev)
+
+    def _setMetadata(self, rel, st):
+        self._applyMetadata(os.path.join(self.src, rel), os.path.join(self.dst, rel), st)
+
+    def _applyMetadata(self, src, path, st):
+        """ Apply the ownership, extended attributes, mode and times of the
+        source to the copy.  Ownership comes first as changing it clears
+        setuid bits and capabilities. """
+        if self.id_map:
+            uid, gid = self.id_map(st.st_uid, st.st_gid)
+        else:
+            uid, gid = st.st_uid, st.st_gid
+        os.chown(path, uid, gid, follow_symlinks=False)
+        self._copyXattrs(src, path)
+        if not stat.S_ISLNK(st.st_mode):
+            os.chmod(path, stat.S_IMODE(st.st_mode))
+        os.utime(path, ns=(st.st_atime_ns, st.st_mtime_ns), follow_symlinks=False)
+
+    def _copyXattrs(self, src, path):
+        try:
+            names = os.listxattr(src, follow_symlinks=False)
+        except OSError as e:
+            if e.errno == errno.ENOTSUP:
+                return
+            raise
+        for name in names:
+            try:
+                value = os.getxattr(src, name, follow_symlinks=False)
+                os.setxattr(path, name, value, follow_symlinks=False)
+            except OSError as e:
+                if e.errno not in (errno.ENOTSUP, errno.ENODATA):
+                    raise
@@ -292,6 +292,10 @@ def get_installation_type(answers):
     if button == 'back':
         return LEFT_BACKWARDS
 
+    # a backup is only checked while it is the one to be restored
+    keep = entry[0] if entry and isinstance(entry[0], product.XenServerBackup) else None
+    product.cancelBackupVerifiers(answers['backups'], keep)
+
     if entry is None:
         answers['install-type'] = constants.INSTALL_TYPE_FRESH
         answers['preserve-settings'] = False
@@ -311,6 +315,7 @@ def get_installation_type(answers):
     elif isinstance(entry[0], product.XenServerBackup):
         answers['install-type'] = constants.INSTALL_TYPE_RESTORE
         answers['backup-to-restore'], _ = entry
+        entry[0].verifyInBackground()
 
     return RIGHT_FORWARDS
 
@@ -35,7 +35,8 @@ def check_repo_def(definition, require_base_repo):
     repositories. """
     try:
         tui.progress.showMessageDialog("Please wait", "Searching for repository...")
-        repos = repository.repositoriesFromDefinition(*definition)
+        # Only whether there is a main repository matters here
+        repos = repository.repositoriesFromDefinition(*definition, stop_at_main=require_base_repo)
         tui.progress.clearModelessDialog()
     except Exception as e:
         logger.log("Exception trying to access repository: %s" % e)
@@ -292,9 +293,10 @@ def verify_source(answers, label, require_base_repo):
         media = 'local'
         address = ''
     done = False
-    SKIP, VERIFY = list(range(2))
+    SKIP, VERIFY, FULL_VERIFY = list(range(3))
     entries = [ ("Skip verification", SKIP),
-                ("Verify %s source" % label, VERIFY), ]
+                ("Verify %s source" % label, VERIFY),
+                ("Verify %s source, ignoring previous results" % label, FULL_VERIFY), ]
 
     if media == 'local':
         text = "Would you like to test your media?"
@@ -310,7 +312,7 @@ def verify_source(answers, label, require_base_repo):
 
         if button == 'back': return LEFT_BACKWARDS
 
-        if entry == VERIFY:
+        if entry in (VERIFY, FULL_VERIFY):
             # we need to do the verification:
             try:
                 tui.progress.showMessageDialog("Please wait", "Searching for repository...")
@@ -323,7 +325,7 @@ def verify_source(answers, label, require_base_repo):
                         """A base installation repository was not found.  Please check the address was valid and/or that the media was inserted correctly, and try again.""",
                         ['Ok'])
                 else:
-                    done = interactive_source_verification(repos, label)
+                    done = interactive_source_verification(repos, label, entry == FULL_VERIFY)
             except Exception as e:
                 logger.logException(e)
                 ButtonChoiceWindow(
@@ -335,7 +337,7 @@ def verify_source(answers, label, require_base_repo):
 
     return RIGHT_FORWARDS
 
-def interactive_source_verification(repos, label):
+def interactive_source_verification(repos, label, force=False):
     cap_label = ' '.join([a.capitalize() for a in label.split()])
     errors = []
     pd = tui.progress.initProgressDialog(
@@ -348,7 +350,7 @@ def interactive_source_verification(repos, label):
         def progress(x):
             #print i * 100 + x
             tui.progress.displayProgressDialog(i*100 + x, pd, "Checking %s..." % r.name())
-        errors.extend(r.check(progress))
+        errors.extend(r.check(progress, force))
 
     tui.progress.clearModelessDialog()
 
@@ -3,6 +3,7 @@
 import os
 import re
 import shutil
+import stat
 
 import diskutil
 import product
@@ -10,6 +11,8 @@ from xcp.version import *
 from xcp import logger
 from disktools import *
 from netinterface import *
+import blockimage
+import treecopy
 import util
 import constants
 import version
@@ -71,6 +74,24 @@ class Upgrader(object):
         completeUpgrade(). """
         return
 
+    def verifyRestoreList(self, backup_root):
+        """ Check the files to be restored against the checksums recorded
+        when the backup was made.  Damaged files are only logged, as the
+        backup is all there is to restore them from. """
+        entries = treecopy.readManifest(backup_root)
+        if entries is None:
+            return
+        paths = []
+        for f in self.restore_list:
+            if isinstance(f, str):
+                paths.append(f)
+            elif 'src' in f:
+                paths.append(f['src'])
+            else:
+                paths.append(f['dir'])
+        for problem in treecopy.verifyFiles(backup_root, entries, paths):
+            logger.error("Backup verification: %s" % problem)
+
     completeUpgradeArgs = ['mounts', 'primary-disk', 'backup-partnum']
     def completeUpgrade(self, mounts, target_disk, backup_partnum):
         """ Write any data back into the new filesystem as needed to follow
@@ -120,49 +141,51 @@ class Upgrader(object):
                         logger.error('Failed to parse: ' + line)
                         logger.logException(e)
 
-        # Copy ownership from a path in a source root to another path in a
-        # destination root. The ownership is copied such that it is not
-        # affected by changes in the underlying uid/gid.
-        def copy_ownership(src_root, src_path, dst_root, dst_path):
-            st = os.lstat('%s/%s' % (src_root, src_path))
+        unmapped = set()
+
+        # The ownership of restored files is mapped by user and group name
+        # so that it is not affected by changes in the underlying uid/gid.
+        def map_ids(uid, gid):
             try:
-                new_uid = dst_uid_map[src_uid_map[st.st_uid]]
-                new_gid = dst_gid_map[src_gid_map[st.st_gid]]
-            except IndexError as e:
-                logger.error('Failed to copy ownership')
-                logger.logException(e)
-                return
-            if st.st_uid != new_uid or st.st_gid != new_gid:
-                os.lchown('%s/%s' % (dst_root, dst_path), new_uid, new_gid)
+                uid = dst_uid_map[src_uid_map[uid]]
+            except KeyError:
+                unmapped.add('uid %d' % uid)
+            try:
+                gid = dst_gid_map[src_gid_map[gid]]
+            except KeyError:
+                unmapped.add('gid %d' % gid)
+            return uid, gid
+
+        restored = []
+        missing = []
 
         def restore_file(src_base, f, d=None):
             if not d: d = f
             src = os.path.join(src_base, f)
             dst = os.path.join(mounts['root'], d)
-            if os.path.exists(src):
-                logger.log("Restoring /%s" % f)
+            try:
+                st = os.lstat(src)
+            except FileNotFoundError:
+                missing.append(f)
+                return
+            try:
                 util.assertDir(os.path.dirname(dst))
-                if os.path.isdir(src):
-                    util.runCmd2(['cp', '-a', src, os.path.dirname(dst)])
+                if stat.S_ISDIR(st.st_mode):
+                    copier = treecopy.TreeCopy(src, dst, id_map=map_ids)
+                    copier.scan()
+                    copier.copy()
                 else:
-                    util.runCmd2(['cp', '-a', src, dst])
-
-                abs_f = os.path.join('/', f)
-                abs_d = os.path.join('/', d)
-                copy_ownership(src_base, abs_f, mounts['root'], abs_d)
-                for dirpath, dirnames, filenames in os.walk(src):
-                    for i in dirnames + filenames:
-                        src_path = os.path.join(dirpath, i)[len(src_base):]
-                        dst_path = os.path.join(abs_d, src_path[len(abs_f) + 1:])
-                        copy_ownership(src_base, src_path, mounts['root'], dst_path)
-            else:
-                logger.log("WARNING: /%s did not exist in the backup image." % f)
+                    treecopy.copyEntry(src, dst, map_ids)
+                restored.append(f)
+            except EnvironmentError as e:
+                logger.error("Failed to restore /%s: %s" % (f, e))
 
         backup_volume = partitionDevice(target_disk, backup_partnum)
         tds = util.TempMount(backup_volume, 'upgrade-src-', options=['ro'])
         try:
             self.buildRestoreList()
             init_id_maps(tds.mount_point, mounts['root'])
+            self.verifyRestoreList(tds.mount_point)
 
             logger.log("Restoring preserved files")
             for f in self.restore_list:
@@ -180,6 +203,11 @@ class Upgrader(object):
                                 fn = os.path.join(f['dir'], ff)
                                 if not pat or pat.match(fn):
                                     restore_file(tds.mount_point, fn)
+            logger.log("Restored %d entries: %s" % (len(restored), ' '.join('/' + f for f in restored)))
+            if missing:
+                logger.log("WARNING: not in the backup image: %s" % ' '.join('/' + f for f in missing))
+            if unmapped:
+                logger.log("Kept ownership of restored files with unknown %s" % ', '.join(sorted(unmapped)))
         finally:
             tds.unmount()
 
@@ -194,7 +222,7 @@ class ThirdGenUpgrader(Upgrader):
 
     def __init__(self, source):
         Upgrader.__init__(self, source)
-        primary_fs = util.TempMount(self.source.root_device, 'primary-', options=['ro'])
+        primary_fs = util.SessionMount(self.source.root_device, 'primary-', options=['ro'])
         safe2upgrade_path = os.path.join(primary_fs.mount_point, constants.SAFE_2_UPGRADE)
         default_storage_conf_path = os.path.join(primary_fs.mount_point, "etc/firstboot.d/data/default-storage.conf")
 
@@ -297,6 +325,7 @@ class ThirdGenUpgrader(Upgrader):
         logs_partition = tool.getPartition(logs_partnum)
 
         self.testUpgradeForbidden(tool)
+        resized = False
 
         # Check if possible to create new partition layout, increasing the size, using plugin result
         if self.safe2upgrade and logs_partition is None: 
@@ -321,61 +350,159 @@ class ThirdGenUpgrader(Upgrader):
             tool.resizePartition(number=backup_partnum, sizeBytes=constants.backup_size * 2**20)
             # Write partition table
             tool.commit(log=True)
+            resized = True
 
-        # format the backup partition:
+        # A complete backup of this root filesystem left by an earlier
+        # upgrade is brought up to date, rather than copied again.
         backup_partition = partitionDevice(target_disk, backup_partnum)
-        try:
-            util.mkfs('ext3', backup_partition)
-        except Exception as e:
-            raise RuntimeError("Backup: Failed to format filesystem on %s: %s" % (backup_partition, e))
-        progress_callback(10)
+        source = self.backupSource()
+        previous = None
+        if constants.BLOCK_BACKUP:
+            progress_callback(10)
+            try:
+                self.imageToBackup(backup_partition, target_disk, boot_device, progress_callback)
+                return
+            except Exception as e:
+                logger.log("Block-level backup failed, copying files: %s" % e)
+        elif constants.INCREMENTAL_BACKUP and not resized and source:
+            previous = self.readBackupManifest(backup_partition, source)
 
-        # copy the files across:
         primary_fs = util.TempMount(self.source.root_device, 'primary-', options=['ro'], boot_device=boot_device)
         try:
-            backup_fs = util.TempMount(backup_partition, 'backup-')
+            if previous is not None:
+                progress_callback(10)
+                try:
+                    self.copyToBackup(primary_fs.mount_point, backup_partition, target_disk,
+                                      source, previous, progress_callback)
+                    return
+                except Exception as e:
+                    logger.log("Incremental backup failed, copying everything: %s" % e)
+
+            # format the backup partition:
             try:
-                just_dirs = ['dev', 'proc', 'lost+found', 'sys']
-                top_dirs = os.listdir(primary_fs.mount_point)
-                val = 10
-                for x in top_dirs:
-                    if x in just_dirs:
-                        path = os.path.join(backup_fs.mount_point, x)
-                        if not os.path.exists(path):
-                            os.mkdir(path, 0o755)
-                    else:
-                        cmd = ['cp', '-a'] + \
-                              [ os.path.join(primary_fs.mount_point, x) ] + \
-                              ['%s/' % backup_fs.mount_point]
-                        if util.runCmd2(cmd) != 0:
-                            raise RuntimeError("Backup of %s directory failed" % x)
-                    val += 90 / len(top_dirs)
-                    progress_callback(val)
-
-                # save the GPT table
-                rc, err = util.runCmd2(["sgdisk", "-b", os.path.join(backup_fs.mount_point, '.xen-gpt.bin'), target_disk], with_stderr=True)
-                if rc != 0:
-                    raise RuntimeError("Failed to save partition layout: %s" % err)
-            finally:
-                # replace rolling pool upgrade bootloader config
-                def replace_config(config_file, destination):
-                    src = os.path.join(backup_fs.mount_point, constants.ROLLING_POOL_DIR, config_file)
-                    if os.path.exists(src):
-                        util.runCmd2(['cp', '-f', src, os.path.join(backup_fs.mount_point, destination)])
-
-                configMaps = [("efi-grub.cfg", "boot/efi/EFI/xenserver/grub.cfg"),
-                                ("grub.cfg", "boot/grub"),
-                                ("menu.lst", "boot/grub"),
-                                ("extlinux.conf", "boot")]
-                for config_file, destination in configMaps:
-                    replace_config(config_file, destination)
-
-                fh = open(os.path.join(backup_fs.mount_point, '.xen-backup-partition'), 'w')
-                fh.close()
-                backup_fs.unmount()
+                util.mkfs('ext3', backup_partition)
+            except Exception as e:
+                raise RuntimeError("Backup: Failed to format filesystem on %s: %s" % (backup_partition, e))
+            progress_callback(10)
+
+            self.copyToBackup(primary_fs.mount_point, backup_partition, target_disk,
+                              source, None, progress_callback)
         finally:
             primary_fs.unmount()
 
+    def backupSource(self):
+        """ Identify the root filesystem being backed up, so that a backup
+        is only updated incrementally from the filesystem it was made of. """
+        fs_uuid = diskutil.readFilesystemUUID(self.source.root_device)
+        install_uuid = self.source.inventory.get('INSTALLATION_UUID')
+        if not fs_uuid or not install_uuid:
+            return None
+        return "%s:%s" % (install_uuid, fs_uuid)
+
+    def readBackupManifest(self, backup_partition, source):
+        """ Return the manifest entries of the backup on backup_partition if
+        it can be updated incrementally, else None. """
+        try:
+            backup_fs = util.TempMount(backup_partition, 'backup-', ['ro'])
+        except Exception as e:
+            logger.log("No existing backup on %s: %s" % (backup_partition, e))
+            return None
+        try:
+            if not os.path.exists(os.path.join(backup_fs.mount_point, '.xen-backup-partition')):
+                return None
+            return treecopy.readManifest(backup_fs.mount_point, source)
+        finally:
+            backup_fs.unmount()
+
+    def copyToBackup(self, primary_root, backup_partition, target_disk, source, previous, progress_callback):
+        """ Copy the files across, or only those that changed if previous
+        holds the manifest entries of the backup already there. """
+        backup_fs = util.TempMount(backup_partition, 'backup-')
+        complete = False
+        try:
+            # until the copy is complete, the backup cannot be trusted
+            treecopy.writeManifest(backup_fs.mount_point, source, {}, False)
+
+            just_dirs = ['dev', 'proc', 'lost+found', 'sys']
+            copier = treecopy.TreeCopy(primary_root, backup_fs.mount_point, just_dirs,
+                                       previous=previous, hashes=constants.BACKUP_CHECKSUMS)
+            try:
+                copier.scan()
+                copier.copy(lambda x: progress_callback(10 + (x * 90) // 100))
+            except EnvironmentError as e:
+                raise RuntimeError("Backup of root filesystem failed: %s" % e)
+
+            self.savePartitionLayout(backup_fs.mount_point, target_disk)
+            complete = True
+        finally:
+            replaced = self.replaceBootConfig(backup_fs.mount_point)
+            fh = open(os.path.join(backup_fs.mount_point, '.xen-backup-partition'), 'w')
+            fh.close()
+            if complete:
+                # the replaced files no longer match the root filesystem
+                for path in replaced:
+                    copier.entries.pop(path, None)
+                treecopy.writeManifest(backup_fs.mount_point, source, copier.entries, True)
+            backup_fs.unmount()
+
+    def imageToBackup(self, backup_partition, target_disk, boot_device, progress_callback):
+        """ Image the used blocks of the root filesystem onto the backup
+        partition, then add the files of the boot partition, which is
+        mounted within it. """
+        blockimage.imageFilesystem(self.source.root_device, backup_partition,
+                                   lambda x: progress_callback(10 + (x * 80) // 100))
+        backup_fs = util.TempMount(backup_partition, 'backup-')
+        try:
+            open(os.path.join(backup_fs.mount_point, blockimage.MARKER), 'w').close()
+            if boot_device:
+                primary_fs = util.TempMount(self.source.root_device, 'primary-', options=['ro'], boot_device=boot_device)
+                try:
+                    if primary_fs.boot_mount_point:
+                        boot_dir = os.path.relpath(primary_fs.boot_mount_point, primary_fs.mount_point)
+                        copier = treecopy.TreeCopy(primary_fs.boot_mount_point,
+                                                   os.path.join(backup_fs.mount_point, boot_dir))
+                        copier.scan()
+                        copier.copy(lambda x: progress_callback(90 + (x * 10) // 100))
+                except EnvironmentError as e:
+                    raise RuntimeError("Backup of boot partition failed: %s" % e)
+                finally:
+                    primary_fs.unmount()
+            self.savePartitionLayout(backup_fs.mount_point, target_disk)
+        finally:
+            self.replaceBootConfig(backup_fs.mount_point)
+            fh = open(os.path.join(backup_fs.mount_point, '.xen-backup-partition'), 'w')
+            fh.close()
+            backup_fs.unmount()
+
+    def savePartitionLayout(self, backup_root, target_disk):
+        """ Save the GPT table with the backup. """
+        rc, err = util.runCmd2(["sgdisk", "-b", os.path.join(backup_root, '.xen-gpt.bin'), target_disk], with_stderr=True)
+        if rc != 0:
+            raise RuntimeError("Failed to save partition layout: %s" % err)
+
+    def replaceBootConfig(self, backup_root):
+        """ Replace the bootloader config in the backup with that saved for
+        a rolling pool upgrade.  Returns the paths replaced, relative to
+        backup_root. """
+        replaced = []
+
+        def replace_config(config_file, destination):
+            src = os.path.join(backup_root, constants.ROLLING_POOL_DIR, config_file)
+            if os.path.exists(src):
+                dst = os.path.join(backup_root, destination)
+                if os.path.isdir(dst):
+                    destination = os.path.join(destination, config_file)
+                util.runCmd2(['cp', '-f', src, dst])
+                replaced.append(destination)
+
+        configMaps = [("efi-grub.cfg", "boot/efi/EFI/xenserver/grub.cfg"),
+                        ("grub.cfg", "boot/grub"),
+                        ("menu.lst", "boot/grub"),
+                        ("extlinux.conf", "boot")]
+        for config_file, destination in configMaps:
+            replace_config(config_file, destination)
+        return replaced
+
     prepUpgradeArgs = ['installation-uuid', 'control-domain-uuid']
     prepStateChanges = ['installation-uuid', 'control-domain-uuid']
     def prepareUpgrade(self, progress_callback, installID, controlID):
@@ -469,10 +596,11 @@ class ThirdGenUpgrader(Upgrader):
         state.close()
 
         # The existence of the static-rules.conf is used to detect upgrade from Boston or newer
-        if os.path.exists(os.path.join(mounts['root'], 'etc/sysconfig/network-scripts/interface-rename-data/static-rules.conf')):
+        static_rules = os.path.join(mounts['root'], 'etc/sysconfig/network-scripts/interface-rename-data/static-rules.conf')
+        if os.path.exists(static_rules):
             # CA-82901 - convert any old style ppn referenced to new style ppn references
-            util.runCmd2(['sed', r's/pci\([0-9]\+p[0-9]\+\)/p\1/g', '-i',
-                          os.path.join(mounts['root'], 'etc/sysconfig/network-scripts/interface-rename-data/static-rules.conf')])
+            n = util.rewriteFile(static_rules, [(re.compile(r'pci([0-9]+p[0-9]+)'), r'p\1')])
+            logger.log("Converted %d old style ppn references in %s" % (n, static_rules))
 
         net_dict = util.readKeyValueFile(os.path.join(mounts['root'], 'etc/sysconfig/network'))
         if net_dict.get('NETWORKING_IPV6', 'no') == 'no':
@@ -489,8 +617,10 @@ class ThirdGenUpgrader(Upgrader):
                 primary_disk != target_link:
             for i in (os.path.join(constants.FIRSTBOOT_DATA_DIR, 'default-storage.conf'),
                       constants.XAPI_DB):
-                util.runCmd2(['sed', '-i', '-e', "s#%s#%s#g" % (primary_disk, target_link),
-                              os.path.join(mounts['root'], i)])
+                path = os.path.join(mounts['root'], i)
+                if os.path.exists(path):
+                    n = util.rewriteFile(path, [(primary_disk, target_link)])
+                    logger.log("Replaced %s with %s %d times in %s" % (primary_disk, target_link, n, path))
 
 class InCloudSphereUpgrader(ThirdGenUpgrader):
     """Upgrader which supports upgrading from releases of InCloud Sphere with
@@ -12,6 +12,8 @@ import random
 import string
 import tempfile
 import errno
+import threading
+import httppool
 from version import *
 from xcp import logger
 
@@ -48,6 +50,120 @@ def copyFilesFromDir(sourcedir, dest):
     for f in files:
         assert runCmd2(['cp', '-a', '%s/%s' % (sourcedir, f), '%s/' % dest]) == 0
 
+###
+# in-place editing
+
+# amount of a file read at a time by rewriteFile
+REWRITE_CHUNK_SIZE = 1024 * 1024
+# longest match rewriteFile will find, kept between chunks
+REWRITE_MAX_MATCH = 64 * 1024
+
+def _compileSubstitution(pattern, replacement):
+    """ Return a bytes regular expression and a function giving the
+    replacement text for its matches. """
+    if isinstance(replacement, str):
+        replacement = replacement.encode()
+    if isinstance(pattern, (str, bytes)):
+        if isinstance(pattern, str):
+            pattern = pattern.encode()
+        return re.compile(re.escape(pattern)), lambda m: replacement
+    if isinstance(pattern.pattern, str):
+        pattern = re.compile(pattern.pattern.encode(), pattern.flags & ~re.UNICODE)
+    return pattern, lambda m: m.expand(replacement)
+
+def rewriteFile(filename, substitutions):
+    """ Apply substitutions, a list of (pattern, replacement) pairs, to the
+    file in a single pass, as 'sed -i -e s/../../g -e ...' would.  A pattern
+    given as a string is replaced literally; a compiled regular expression
+    is replaced by its template, which may refer to groups.  Where
+    patterns overlap, the leftmost match is replaced, and the earliest
+    pattern if several start there.  The file is read in chunks, so
+    matches must be shorter than REWRITE_MAX_MATCH.  The file is only
+    replaced, atomically, if something was substituted; until then nothing
+    is written.  Returns the number of replacements made. """
+    subs = [_compileSubstitution(p, r) for p, r in substitutions]
+    count = 0
+    # Until the first substitution the output is the input unchanged, so
+    # the copy is only started then, from the bytes passed over so far
+    outfh = None
+    passed = 0
+    tmp = None
+    try:
+        with open(filename, 'rb') as infh:
+            def write(data):
+                nonlocal passed
+                if outfh is None:
+                    passed += len(data)
+                else:
+                    outfh.write(data)
+
+            def startCopy():
+                nonlocal outfh, tmp
+                dirname = os.path.dirname(os.path.abspath(filename))
+                fd, tmp = tempfile.mkstemp(dir=dirname, prefix='.' + os.path.basename(filename))
+                outfh = os.fdopen(fd, 'wb')
+                with open(filename, 'rb') as prefix:
+                    remaining = passed
+                    while remaining > 0:
+                        data = prefix.read(min(remaining, REWRITE_CHUNK_SIZE))
+                        if not data:
+                            raise IOError("%s shrank while it was rewritten" % filename)
+                        outfh.write(data)
+                        remaining -= len(data)
+
+            buf = b''
+            eof = False
+            while not eof:
+                chunk = infh.read(REWRITE_CHUNK_SIZE)
+                eof = not chunk
+                buf += chunk
+                # only matches starting before limit are sure to be whole
+                limit = len(buf) if eof else len(buf) - REWRITE_MAX_MATCH
+                if limit <= 0:
+                    continue
+                pos = 0
+                found = [None] * len(subs)
+                while True:
+                    best = None
+                    for i, (pattern, _) in enumerate(subs):
+                        m = found[i]
+                        if m is None or m.start() < pos:
+                            m = found[i] = pattern.search(buf, pos)
+                        if m and (best is None or m.start() < found[best].start()):
+                            best = i
+                    if best is None or found[best].start() >= limit:
+                        break
+                    m = found[best]
+                    write(buf[pos:m.start()])
+                    if outfh is None:
+                        startCopy()
+                    write(subs[best][1](m))
+                    count += 1
+                    pos = m.end()
+                    if m.end() == m.start():
+                        # an empty match: move past the next byte
+                        write(buf[pos:pos + 1])
+                        pos += 1
+                keep = max(pos, limit)
+                write(buf[pos:keep])
+                buf = buf[keep:]
+
+        if outfh is not None:
+            outfh.flush()
+            os.fsync(outfh.fileno())
+            outfh.close()
+            outfh = None
+            shutil.copystat(filename, tmp)
+            st = os.stat(filename)
+            os.chown(tmp, st.st_uid, st.st_gid)
+            os.rename(tmp, filename)
+    finally:
+        if outfh is not None:
+            outfh.close()
+        if tmp is not None and os.path.exists(tmp):
+            os.unlink(tmp)
+    return count
+
 ###
 # shell
 
@@ -214,6 +330,115 @@ class TempMount:
         if os.path.isdir(self.mount_point):
             os.rmdir(self.mount_point)
 
+# Filesystems mounted with SessionMount are shared by all SessionMounts of
+# the same device while any of them is in use, and while a mount session is
+# open, e.g. while existing installations are inspected, they also stay
+# mounted when released.  They are mounted read-only, and remounted
+# read-write only when asked.  _session_lock only guards the bookkeeping;
+# mounting and unmounting are done outside it.
+_session_lock = threading.Lock()
+_session_open = False
+# device -> _SharedMount, for every shared mount in use or kept
+_session_mounts = {}
+
+class _SharedMount:
+    def __init__(self, device):
+        self.device = device
+        self.fs = None
+        self.error = None
+        self.rw = False
+        self.users = 0
+        # set once the mount has been attempted
+        self.ready = threading.Event()
+        # serialises remounting read-write
+        self.lock = threading.Lock()
+
+    def mount(self, tmp_prefix, fstype):
+        try:
+            self.fs = TempMount(self.device, tmp_prefix, ['ro'], fstype)
+        except Exception as e:
+            self.error = e
+            # so that the next SessionMount tries again
+            with _session_lock:
+                if _session_mounts.get(self.device) is self:
+                    del _session_mounts[self.device]
+        self.ready.set()
+
+    def makeWritable(self):
+        with self.lock:
+            if not self.rw:
+                mount(self.device, self.fs.mount_point, ['remount', 'rw'])
+                self.rw = True
+
+def _releaseShared(shared):
+    """ Drop a user of shared, returning whether it is to be unmounted. """
+    with _session_lock:
+        shared.users -= 1
+        if shared.users > 0 or (_session_open and shared.fs):
+            return False
+        if _session_mounts.get(shared.device) is shared:
+            del _session_mounts[shared.device]
+        return shared.fs is not None
+
+class SessionMount:
+    """ Mount of device, used like TempMount, that is shared with other
+    SessionMounts of the device.  It is read-only unless options include
+    'rw'. """
+
+    def __init__(self, device, tmp_prefix, options=None, fstype=None):
+        with _session_lock:
+            shared = _session_mounts.get(device)
+            first = shared is None
+            if first:
+                shared = _session_mounts[device] = _SharedMount(device)
+            shared.users += 1
+        if first:
+            shared.mount(tmp_prefix, fstype)
+        else:
+            shared.ready.wait()
+        if shared.error:
+            _releaseShared(shared)
+            raise shared.error
+        self.shared = shared
+        self.mount_point = shared.fs.mount_point
+        if options and 'rw' in options:
+            try:
+                shared.makeWritable()
+            except:
+                self.unmount()
+                raise
+
+    def unmount(self):
+        shared, self.shared = self.shared, None
+        if shared and _releaseShared(shared):
+            shared.fs.unmount()
+
+def beginMountSession():
+    """ Keep filesystems mounted with SessionMount until endMountSession(). """
+    global _session_open
+    with _session_lock:
+        _session_open = True
+
+def endMountSession():
+    """ Unmount the filesystems kept by the mount session, if one is open.
+    Those still in use stay tracked, and are unmounted by their last user
+    (or shared by a later session).  This must be called before the
+    devices are written to other than through the mounts. """
+    global _session_open
+    with _session_lock:
+        if not _session_open:
+            return
+        _session_open = False
+        idle = [m for m in _session_mounts.values() if m.users == 0]
+        for shared in idle:
+            del _session_mounts[shared.device]
+        in_use = sorted(_session_mounts)
+    logger.log("Ending mount session, unmounting: %s" % (', '.join(sorted(m.device for m in idle)) or 'nothing'))
+    if in_use:
+        logger.log("Still in use after mount session: %s" % ', '.join(in_use))
+    for shared in idle:
+        shared.fs.unmount()
+
 ###
 # fetching of remote files
 
@@ -253,22 +478,18 @@ def fetchFile(source, dest):
                source[:6] == 'https:' or \
                source[:5] == 'file:' or \
                source[:4] == 'ftp:':
-            # This something that can be fetched using urllib
-            request = source
-
+            # This something that can be fetched using urllib, or the
+            # connection pool for HTTP(s)
             url = URL(source)
-            if url.getScheme() in ['http', 'https'] and url.getUsername(): # Auth HTTP(s)
-                passman = urllib2.HTTPPasswordMgrWithDefaultRealm()
-                passman.add_password(None, url.getHostname(), url.getUsername(), url.getPassword())
-                handler = urllib2.HTTPBasicAuthHandler(passman)
-                urllib2.install_opener(urllib2.build_opener(handler))
-                request = url.getPlainURL()
-
-            fd = urllib.request.urlopen(request)
-            fd_dest = open(dest, 'w')
-            shutil.copyfileobj(fd, fd_dest)
-            fd_dest.close()
-            fd.close()
+            if url.getScheme() in ['http', 'https']:
+                fd = httppool.pool().open(url.getPlainURL(), url.getUsername(), url.getPassword())
+            else:
+                fd = urllib.request.urlopen(source)
+            try:
+                with open(dest, 'wb') as fd_dest:
+                    shutil.copyfileobj(fd, fd_dest)
+            finally:
+                fd.close()
         else:
             raise InvalidSource("Unknown source type.")
 
@@ -8,6 +8,7 @@ import sys
 import fcntl
 import datetime
 import traceback
+import json
 import constants
 
 
@@ -29,6 +30,13 @@ def collectLogs(dst, tarball_dir=None):
     os.system("vgscan -P >%s/vgscan-log 2>&1" % dst)
     os.system("cat /var/log/multipathd >%s/multipathd-log 2>&1" % dst)
     os.system("rpm -qa >%s/rpm-qa-log 2>&1" % dst)
+    with open(os.path.join(dst, 'hardware-facts-log'), 'w') as f:
+        try:
+            # imported here so that logs can be collected without it
+            import hardware
+            json.dump(hardware.facts().toDict(), f, indent=2, sort_keys=True)
+        except Exception as e:
+            f.write("Unable to collect hardware facts: %s\n" % e)
 
     if not tarball_dir:
         tarball_dir = dst
@@ -36,6 +44,8 @@ def collectLogs(dst, tarball_dir=None):
     if dst != '/tmp':
         if os.path.exists("/tmp/install-log"):
             shutil.copy("/tmp/install-log", dst)
+        if os.path.exists(constants.TIMING_SUMMARY_LOG):
+            shutil.copy(constants.TIMING_SUMMARY_LOG, dst)
         if os.path.exists(constants.SCRIPTS_DIR):
             os.system("cp -r "+constants.SCRIPTS_DIR+" %s/" % dst)
     logs = [x for x in os.listdir(dst) if x.endswith('-log') or x == 'answerfile' or